@@ -4,7 +4,16 @@
 Требует прав root для некоторых операций
 """
 
+import argparse
+import asyncio
+import collections
+import contextlib
+import itertools
 import os
+import platform
+import random
+import socket
+import struct
 import sys
 import subprocess
 import time
@@ -13,6 +22,866 @@ import json
 import shutil
 from pathlib import Path
 
+# DNS-клиент: запросы в wire-формате (RFC 1035) по UDP, при TC - по TCP
+DNS_PORT = 53
+DNS_TIMEOUT = 2.0
+DNS_CONCURRENCY = 64
+EDNS_PAYLOAD = 1232       # размер UDP ответа, который мы готовы принять (EDNS0)
+DNS_SERVERS = [
+    "127.0.0.1",  # Локальный DNSCrypt
+    "9.9.9.9",    # Quad9
+    "1.1.1.1",    # Cloudflare
+    "8.8.8.8",    # Google
+]
+TEST_DOMAINS = ["google.com", "yandex.ru", "github.com"]
+# Бенчмарк резолверов
+BENCH_DOMAINS = TEST_DOMAINS + [
+    "wikipedia.org", "mozilla.org", "debian.org", "cloudflare.com", "quad9.net",
+    "torproject.org", "geti2p.net", "python.org", "kernel.org", "openstreetmap.org",
+    "mail.ru", "vk.com", "habr.com", "stackoverflow.com", "archive.org", "duckduckgo.com",
+]
+BENCH_RATE = 50.0         # запросов в секунду при воспроизведении списка
+BENCH_SECONDS = 5.0
+BENCH_MAX_QPS = 1000.0    # потолок поиска максимального QPS; 0 - не искать
+BENCH_STEP_SECONDS = 2.0
+BENCH_MAX_LOSS = 0.01     # доля таймаутов и ошибок, при которой QPS ещё держится
+# Кэширующий DNS перед dnscrypt-proxy: он слушает 127.0.0.1:53, а dnscrypt уходит на 5353
+DNSCRYPT_LISTEN = '127.0.0.1:53'
+FORWARDER_LISTEN = ('127.0.0.1', 53)
+FORWARDER_UPSTREAM = ('127.0.0.1', 5353)
+FORWARDER_CACHE_SIZE = 10000
+FORWARDER_MAX_TTL = 86400
+FORWARDER_NEGATIVE_TTL = 60     # для отрицательного ответа без SOA
+FORWARDER_PREFETCH_HITS = 3     # попаданий, после которых запись обновляем заранее
+FORWARDER_PREFETCH_RATIO = 0.1  # ... когда от TTL остаётся меньше этой доли
+FORWARDER_STATS_INTERVAL = 60.0
+FORWARDER_STATS = '/run/dns-forwarder.json'
+FORWARDER_UNIT = '/etc/systemd/system/dns-forwarder.service'
+QTYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'PTR': 12, 'MX': 15, 'TXT': 16, 'AAAA': 28}
+QTYPE_NAMES = {value: name for name, value in QTYPES.items()}
+RCODES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED'}
+TYPE_OPT = 41
+
+
+def parse_server(value, port=DNS_PORT):
+    """'9.9.9.9' или '127.0.0.1:5353' -> (хост, порт)"""
+    host, sep, tail = value.rpartition(':')
+    if sep and tail.isdigit() and ':' not in host:
+        return host, int(tail)
+    return value, port
+
+def encode_name(name):
+    out = bytearray()
+    for label in name.rstrip('.').split('.') if name.strip('.') else []:
+        raw = label.encode('idna')
+        if not 0 < len(raw) < 64:
+            raise ValueError(f"неверная метка в имени: {name!r}")
+        out.append(len(raw))
+        out += raw
+    out.append(0)
+    return bytes(out)
+
+def decode_name(data, offset):
+    """Имя с учётом сжатия; возвращает (имя, смещение после имени)"""
+    labels = []
+    end = None
+    for _ in range(128):    # защита от петель указателей
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+        elif length:
+            labels.append(data[offset + 1:offset + 1 + length].decode('ascii', 'replace'))
+            offset += 1 + length
+        else:
+            return '.'.join(labels), end if end is not None else offset + 1
+    raise ValueError("петля в сжатом имени")
+
+def build_query(name, qtype='A', qid=None, edns=EDNS_PAYLOAD):
+    """(id, запрос) с флагом RD и, если edns, записью OPT"""
+    qid = random.getrandbits(16) if qid is None else qid
+    header = struct.pack('!6H', qid, 0x0100, 1, 0, 0, 1 if edns else 0)
+    question = encode_name(name) + struct.pack('!HH', QTYPES.get(qtype, qtype), 1)
+    opt = b'\0' + struct.pack('!HHIH', TYPE_OPT, edns, 0, 0) if edns else b''
+    return qid, header + question + opt
+
+
+class DnsRecord:
+    __slots__ = ('name', 'type', 'ttl', 'value')
+
+    def __init__(self, name, rtype, ttl, value):
+        self.name = name
+        self.type = rtype
+        self.ttl = ttl
+        self.value = value
+
+    def __str__(self):
+        return f"{self.name} {self.ttl} {QTYPE_NAMES.get(self.type, self.type)} {self.value}"
+
+
+class DnsMessage:
+    """Разобранный DNS ответ; записи OPT отбрасываются"""
+    __slots__ = ('id', 'flags', 'questions', 'answers', 'authority', 'additional')
+
+    def __init__(self, qid, flags, questions, answers, authority, additional):
+        self.id = qid
+        self.flags = flags
+        self.questions = questions      # [(имя, тип)]
+        self.answers = answers
+        self.authority = authority
+        self.additional = additional
+
+    @property
+    def rcode(self):
+        return self.flags & 0xF
+
+    @property
+    def truncated(self):
+        return bool(self.flags & 0x0200)
+
+
+def decode_rdata(data, rtype, offset, length):
+    if rtype == 1 and length == 4:
+        return socket.inet_ntop(socket.AF_INET, data[offset:offset + 4])
+    if rtype == 28 and length == 16:
+        return socket.inet_ntop(socket.AF_INET6, data[offset:offset + 16])
+    if rtype in (2, 5, 12):
+        return decode_name(data, offset)[0]
+    if rtype == 15:
+        return f"{struct.unpack_from('!H', data, offset)[0]} {decode_name(data, offset + 2)[0]}"
+    if rtype == 6:
+        mname, position = decode_name(data, offset)
+        rname, position = decode_name(data, position)
+        return (mname, rname) + struct.unpack_from('!5I', data, position)
+    if rtype == 16:
+        strings, position = [], offset
+        while position < offset + length:
+            size = data[position]
+            strings.append(data[position + 1:position + 1 + size].decode('utf-8', 'replace'))
+            position += 1 + size
+        return ''.join(strings)
+    return data[offset:offset + length].hex()
+
+def parse_message(data):
+    """Разобрать DNS сообщение; ValueError - если оно битое"""
+    try:
+        qid, flags, qdcount, ancount, nscount, arcount = struct.unpack_from('!6H', data)
+        offset = 12
+        questions = []
+        for _ in range(qdcount):
+            name, offset = decode_name(data, offset)
+            qtype, _ = struct.unpack_from('!HH', data, offset)
+            questions.append((name.lower(), qtype))
+            offset += 4
+        sections = []
+        for count in (ancount, nscount, arcount):
+            records = []
+            for _ in range(count):
+                name, offset = decode_name(data, offset)
+                rtype, _, ttl, length = struct.unpack_from('!HHIH', data, offset)
+                offset += 10
+                if offset + length > len(data):
+                    raise ValueError("запись выходит за конец сообщения")
+                if rtype != TYPE_OPT:
+                    records.append(DnsRecord(name, rtype, ttl,
+                                             decode_rdata(data, rtype, offset, length)))
+                offset += length
+            sections.append(records)
+    except (struct.error, IndexError, UnicodeError) as e:
+        raise ValueError(f"битое DNS сообщение: {e}") from None
+    return DnsMessage(qid, flags, questions, *sections)
+
+
+class DnsResult:
+    """Итог одного запроса: rcode и ответы или ошибка, задержка в секундах"""
+    __slots__ = ('server', 'name', 'qtype', 'rcode', 'latency', 'answers', 'transport', 'error')
+
+    def __init__(self, server, name, qtype):
+        self.server = server
+        self.name = name
+        self.qtype = qtype
+        self.rcode = None
+        self.latency = None
+        self.answers = []
+        self.transport = 'udp'
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None and self.rcode == 0 and bool(self.answers)
+
+    def status(self):
+        if self.error:
+            return self.error
+        return RCODES.get(self.rcode, f'RCODE{self.rcode}')
+
+    def __str__(self):
+        mark = "✓" if self.ok else "✗"
+        values = ', '.join(str(record.value) for record in self.answers
+                           if QTYPE_NAMES.get(record.type) == self.qtype)
+        via = ' tcp' if self.transport == 'tcp' else ''
+        return (f"{self.name}: {mark} {self.latency * 1000:.1f} мс {self.status()}{via}"
+                + (f" {values}" if values else ""))
+
+
+class UdpExchange(asyncio.DatagramProtocol):
+    """Один запрос по UDP: ждём датаграмму с нашим id, чужие отбрасываем"""
+
+    def __init__(self, qid):
+        self.qid = qid
+        self.future = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if len(data) >= 12 and int.from_bytes(data[:2], 'big') == self.qid \
+                and not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        # ICMP port unreachable: резолвер не слушает, ждать таймаут незачем
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+    def connection_lost(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc or ConnectionError("сокет закрыт"))
+
+
+async def udp_exchange(server, qid, query, timeout):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: UdpExchange(qid), remote_addr=server)
+    try:
+        transport.sendto(query)
+        return await asyncio.wait_for(protocol.future, timeout)
+    finally:
+        transport.close()
+
+async def tcp_exchange(server, query, timeout):
+    async def exchange():
+        reader, writer = await asyncio.open_connection(*server)
+        try:
+            writer.write(len(query).to_bytes(2, 'big') + query)
+            size = int.from_bytes(await reader.readexactly(2), 'big')
+            return await reader.readexactly(size)
+        finally:
+            writer.close()
+    return await asyncio.wait_for(exchange(), timeout)
+
+async def exchange(server, name, qtype='A', timeout=DNS_TIMEOUT, tcp=False):
+    """Запрос к server=(хост, порт); усечённый UDP ответ повторяется по TCP.
+    Возвращает (разобранный ответ, сырые байты, транспорт)"""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    qid, query = build_query(name, qtype)
+    transport = 'tcp' if tcp else 'udp'
+    if tcp:
+        data = await tcp_exchange(server, query, timeout)
+    else:
+        data = await udp_exchange(server, qid, query, timeout)
+        if parse_message(data).truncated:
+            transport = 'tcp'
+            data = await tcp_exchange(server, query, max(timeout - (loop.time() - start), 0.001))
+    message = parse_message(data)
+    # В вопросе ответа имя в том виде, в каком ушло: IDN - в punycode
+    wire_name = decode_name(encode_name(name), 0)[0].lower()
+    if message.id != qid or message.questions[:1] != [(wire_name, QTYPES.get(qtype, qtype))]:
+        raise ValueError("ответ не на наш запрос")
+    return message, data, transport
+
+async def dns_query(server, name, qtype='A', timeout=DNS_TIMEOUT, tcp=False):
+    """Запрос с замером задержки. Исключений не бросает: ошибка - в DnsResult"""
+    result = DnsResult(server, name, qtype)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    try:
+        message, _, result.transport = await exchange(server, name, qtype, timeout, tcp)
+        result.rcode = message.rcode
+        result.answers = message.answers
+    except asyncio.TimeoutError:
+        result.error = 'timeout'
+    except (OSError, EOFError, ValueError) as e:
+        result.error = str(e) or type(e).__name__
+    result.latency = loop.time() - start
+    return result
+
+async def query_all(servers, domains, qtype='A', timeout=DNS_TIMEOUT, concurrency=DNS_CONCURRENCY):
+    """Все пары сервер x домен одновременно; результаты в порядке перебора"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(server, domain):
+        async with semaphore:
+            return await dns_query(server, domain, qtype, timeout)
+
+    return await asyncio.gather(*(limited(server, domain)
+                                  for server in servers for domain in domains))
+
+
+class DnsStub:
+    """Локальный DNS сервер для проверок: UDP и TCP на одном порту.
+
+    records - {имя: [IPv4 или IPv6, ...]}; неизвестные имена получают
+    NXDOMAIN с SOA. delay задерживает ответ, truncate отдаёт по UDP только
+    TC, drop не отвечает вовсе. queries считает принятые запросы.
+    miss_delay изображает кэширующий резолвер: столько ждёт первый запрос
+    каждого имени, повторные - только delay.
+    """
+
+    def __init__(self, records=None, ttl=300, delay=0.0, truncate=False, drop=False,
+                 miss_delay=None):
+        self.records = {name.lower(): list(values) for name, values in (records or {}).items()}
+        self.ttl = ttl
+        self.delay = delay
+        self.miss_delay = miss_delay
+        self.seen = set()
+        self.truncate = truncate
+        self.drop = drop
+        self.queries = 0
+        self.udp = None
+        self.tcp = None
+
+    async def start(self, host='127.0.0.1'):
+        loop = asyncio.get_running_loop()
+        for _ in range(20):
+            self.udp, _ = await loop.create_datagram_endpoint(
+                lambda: StubProtocol(self), local_addr=(host, 0))
+            port = self.udp.get_extra_info('sockname')[1]
+            try:
+                self.tcp = await asyncio.start_server(self.handle_tcp, host, port)
+                return host, port
+            except OSError:
+                self.udp.close()
+        raise OSError("не нашли свободный порт для UDP и TCP")
+
+    def close(self):
+        self.udp.close()
+        self.tcp.close()
+
+    def respond(self, data, udp):
+        self.queries += 1
+        try:
+            qid, flags = struct.unpack_from('!HH', data)
+            name, offset = decode_name(data, 12)
+            qtype = struct.unpack_from('!H', data, offset)[0]
+        except (struct.error, IndexError, ValueError):
+            return None
+        question = data[12:offset + 4]
+        answers = []
+        rcode = 0
+        authority = b''
+        values = self.records.get(name.lower())
+        if values is None:
+            rcode = 3
+            soa = (encode_name('ns.stub') + encode_name('hostmaster.stub')
+                   + struct.pack('!5I', 1, 3600, 600, 86400, self.ttl))
+            authority = (encode_name(name) + struct.pack('!HHIH', 6, 1, self.ttl, len(soa)) + soa)
+        elif not (udp and self.truncate):
+            family, wanted = (socket.AF_INET, 1) if qtype == 1 else (socket.AF_INET6, 28)
+            for value in values:
+                if (':' in value) == (family == socket.AF_INET6) and qtype == wanted:
+                    rdata = socket.inet_pton(family, value)
+                    answers.append(b'\xc0\x0c' + struct.pack('!HHIH', qtype, 1, self.ttl,
+                                                             len(rdata)) + rdata)
+        flags = 0x8180 | (flags & 0x0100) | rcode | (0x0200 if udp and self.truncate else 0)
+        header = struct.pack('!6H', qid, flags, 1, len(answers), 1 if authority else 0, 0)
+        return header + question + b''.join(answers) + authority
+
+    def delay_for(self, data):
+        key = data[12:]     # вопрос вместе с OPT, без id
+        if self.miss_delay is None or key in self.seen:
+            return self.delay
+        self.seen.add(key)
+        return self.miss_delay
+
+    async def reply(self, data, addr):
+        await asyncio.sleep(self.delay_for(data))
+        response = self.respond(data, True)
+        if response and not self.drop:
+            self.udp.sendto(response, addr)
+
+    async def handle_tcp(self, reader, writer):
+        try:
+            while True:
+                size = int.from_bytes(await reader.readexactly(2), 'big')
+                data = await reader.readexactly(size)
+                await asyncio.sleep(self.delay_for(data))
+                response = self.respond(data, False)
+                if response is None or self.drop:
+                    break
+                writer.write(len(response).to_bytes(2, 'big') + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class StubProtocol(asyncio.DatagramProtocol):
+    def __init__(self, stub):
+        self.stub = stub
+
+    def datagram_received(self, data, addr):
+        asyncio.ensure_future(self.stub.reply(data, addr))
+
+
+def record_layout(data):
+    """Смещения полей TTL всех записей и границы OPT (или None) в ответе"""
+    qdcount, ancount, nscount, arcount = struct.unpack_from('!4H', data, 4)
+    offset = 12
+    for _ in range(qdcount):
+        offset = decode_name(data, offset)[1] + 4
+    ttls = []
+    opt = None
+    for _ in range(ancount + nscount + arcount):
+        start = offset
+        offset = decode_name(data, offset)[1]
+        rtype = struct.unpack_from('!H', data, offset)[0]
+        length = struct.unpack_from('!H', data, offset + 8)[0]
+        if rtype == TYPE_OPT:
+            opt = (start, offset + 10 + length)
+        else:
+            ttls.append(offset + 4)
+        offset += 10 + length
+    return ttls, opt
+
+def cache_ttl(message):
+    """Сколько держать ответ: минимальный TTL ответов, для NXDOMAIN и пустого
+    ответа - min(TTL, minimum) из SOA (RFC 2308); None - не кэшировать"""
+    if message.truncated or message.rcode not in (0, 3):
+        return None
+    if message.rcode == 0 and message.answers:
+        ttl = min(record.ttl for record in message.answers)
+    else:
+        soa = [record for record in message.authority if record.type == 6]
+        ttl = min(soa[0].ttl, soa[0].value[6]) if soa else FORWARDER_NEGATIVE_TTL
+    return min(ttl, FORWARDER_MAX_TTL)
+
+def error_response(query, rcode, truncated=False):
+    """Пустой ответ с rcode на запрос клиента: заголовок и вопрос, если он цел"""
+    qid, flags, qdcount = struct.unpack_from('!3H', query)
+    question = b''
+    if qdcount:
+        try:
+            offset = decode_name(query, 12)[1] + 4
+            if offset <= len(query):
+                question = query[12:offset]
+        except (IndexError, ValueError):
+            pass
+    flags = 0x8080 | (flags & 0x0100) | rcode | (0x0200 if truncated else 0)
+    return struct.pack('!6H', qid, flags, 1 if question else 0, 0, 0, 0) + question
+
+
+class CacheEntry:
+    __slots__ = ('data', 'ttls', 'opt', 'stored', 'ttl', 'cost', 'hits', 'negative')
+
+    def __init__(self, data, ttl, cost, negative):
+        self.data = data
+        self.ttls, self.opt = record_layout(data)
+        self.stored = time.monotonic()
+        self.ttl = ttl
+        self.cost = cost          # задержка upstream, которую экономит каждое попадание
+        self.hits = 0
+        self.negative = negative
+
+    def remaining(self):
+        return self.ttl - (time.monotonic() - self.stored)
+
+    def render(self, qid, question, edns):
+        """Ответ клиенту: его id и вопрос (регистр букв), TTL уменьшены на
+        время в кэше; без EDNS у клиента убираем OPT"""
+        data = bytearray(self.data)
+        data[:2] = qid.to_bytes(2, 'big')
+        data[12:12 + len(question)] = question
+        age = int(time.monotonic() - self.stored)
+        for offset in self.ttls:
+            ttl = int.from_bytes(data[offset:offset + 4], 'big')
+            data[offset:offset + 4] = max(ttl - age, 0).to_bytes(4, 'big')
+        if self.opt and not edns:
+            start, end = self.opt
+            del data[start:end]
+            data[10:12] = (int.from_bytes(data[10:12], 'big') - 1).to_bytes(2, 'big')
+        return bytes(data)
+
+
+class DnsForwarder:
+    """Кэширующий DNS перед dnscrypt-proxy.
+
+    LRU по (имя, тип) с учётом TTL, отрицательный кэш по SOA, одинаковые
+    запросы в полёте сливаются в один запрос наверх, а популярные записи
+    обновляются заранее, когда от TTL остаётся меньше prefetch_ratio.
+    """
+
+    def __init__(self, upstream=FORWARDER_UPSTREAM, capacity=FORWARDER_CACHE_SIZE,
+                 timeout=DNS_TIMEOUT, prefetch_hits=FORWARDER_PREFETCH_HITS,
+                 prefetch_ratio=FORWARDER_PREFETCH_RATIO):
+        self.upstream = upstream
+        self.capacity = capacity
+        self.timeout = timeout
+        self.prefetch_hits = prefetch_hits
+        self.prefetch_ratio = prefetch_ratio
+        self.cache = collections.OrderedDict()
+        self.inflight = {}
+        self.counters = collections.Counter()
+        self.saved = 0.0          # секунд задержки upstream, сэкономленных кэшем
+        self.upstream_time = 0.0
+        self.udp = None
+        self.tcp = None
+
+    async def start(self, listen=FORWARDER_LISTEN):
+        loop = asyncio.get_running_loop()
+        self.udp, _ = await loop.create_datagram_endpoint(lambda: ForwarderProtocol(self),
+                                                          local_addr=listen)
+        # TCP на том же порту, что достался UDP (важно для порта 0)
+        address = self.udp.get_extra_info('sockname')[:2]
+        self.tcp = await asyncio.start_server(self.handle_tcp, *address)
+        return address
+
+    def close(self):
+        self.udp.close()
+        self.tcp.close()
+
+    async def answer(self, query, udp):
+        """Ответ на сырой запрос клиента; None - отвечать нечего"""
+        if len(query) < 12:
+            return None
+        qid, flags, qdcount = struct.unpack_from('!3H', query)
+        if flags & 0x8000:
+            return None
+        if not qdcount:
+            return error_response(query, 1)     # вопроса нет: FORMERR
+        try:
+            name, offset = decode_name(query, 12)
+            qtype, qclass = struct.unpack_from('!HH', query, offset)
+        except (struct.error, IndexError, ValueError):
+            return error_response(query, 1)     # битый вопрос: FORMERR
+        if qdcount != 1 or flags & 0x7800 or qclass != 1:
+            return error_response(query, 4)
+        self.counters['queries'] += 1
+        question = query[12:offset + 4]
+        # OPT клиента обычно идёт сразу за вопросом: из него берём размер UDP ответа
+        edns = query[offset + 4:offset + 7] == b'\0\0\x29'
+        if edns and len(query) < offset + 4 + 11:
+            return error_response(query, 1)     # OPT обрезан: FORMERR
+        limit = max(struct.unpack_from('!H', query, offset + 7)[0], 512) if edns else 512
+        key = (name.lower(), qtype)
+        entry = self.lookup(key)
+        if entry is None:
+            self.counters['misses'] += 1
+            try:
+                entry = await self.resolve(key)
+            except (asyncio.TimeoutError, OSError, EOFError, ValueError):
+                self.counters['upstream_errors'] += 1
+                return error_response(query, 2)
+        response = entry.render(qid, question, edns)
+        if udp and len(response) > limit:
+            return error_response(query, 0, truncated=True)
+        return response
+
+    def lookup(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        remaining = entry.remaining()
+        if remaining <= 0:
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        entry.hits += 1
+        self.counters['hits'] += 1
+        if entry.negative:
+            self.counters['negative_hits'] += 1
+        self.saved += entry.cost
+        if (entry.hits >= self.prefetch_hits and remaining < entry.ttl * self.prefetch_ratio
+                and key not in self.inflight):
+            self.counters['prefetches'] += 1
+            asyncio.ensure_future(self.prefetch(key))
+        return entry
+
+    async def prefetch(self, key):
+        try:
+            await self.resolve(key)
+        except (asyncio.TimeoutError, OSError, EOFError, ValueError):
+            self.counters['upstream_errors'] += 1
+
+    async def resolve(self, key):
+        """Запрос наверх; одинаковые запросы в полёте ждут один и тот же"""
+        future = self.inflight.get(key)
+        if future is not None:
+            self.counters['coalesced'] += 1
+            return await asyncio.shield(future)
+        # Отдельная задача: отмена одного клиента не обрывает запрос для остальных
+        future = asyncio.ensure_future(self.fetch(key))
+        self.inflight[key] = future
+        future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def fetch(self, key):
+        name, qtype = key
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        message, data, _ = await exchange(self.upstream, name, qtype, self.timeout)
+        cost = loop.time() - start
+        self.counters['upstream'] += 1
+        self.upstream_time += cost
+        ttl = cache_ttl(message)
+        entry = CacheEntry(data, ttl or 0, cost, message.rcode == 3 or not message.answers)
+        if ttl:
+            # Новый ответ занимает место старого с его числом попаданий
+            old = self.cache.pop(key, None)
+            if old is not None:
+                entry.hits = old.hits
+            self.cache[key] = entry
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        return entry
+
+    def stats(self):
+        queries = self.counters['queries']
+        upstream = self.counters['upstream']
+        return {
+            'queries': queries,
+            'hits': self.counters['hits'],
+            'hit_rate': round(self.counters['hits'] / queries, 4) if queries else None,
+            'negative_hits': self.counters['negative_hits'],
+            'coalesced': self.counters['coalesced'],
+            'prefetches': self.counters['prefetches'],
+            'upstream': upstream,
+            'upstream_errors': self.counters['upstream_errors'],
+            'upstream_avg_ms': round(self.upstream_time / upstream * 1000, 2) if upstream else None,
+            'saved_ms': round(self.saved * 1000, 1),
+            'cached': len(self.cache),
+        }
+
+    async def handle_tcp(self, reader, writer):
+        try:
+            while True:
+                size = int.from_bytes(await reader.readexactly(2), 'big')
+                response = await self.answer(await reader.readexactly(size), False)
+                if response is None:
+                    break
+                writer.write(len(response).to_bytes(2, 'big') + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def reply(self, query, addr):
+        response = await self.answer(query, True)
+        if response is not None:
+            self.udp.sendto(response, addr)
+
+
+class ForwarderProtocol(asyncio.DatagramProtocol):
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+
+    def datagram_received(self, data, addr):
+        asyncio.ensure_future(self.forwarder.reply(data, addr))
+
+
+def print_forwarder_stats(stats):
+    rate = f"{stats['hit_rate'] * 100:.1f}%" if stats['hit_rate'] is not None else "-"
+    print(f"Запросов {stats['queries']}, попаданий {rate} (отрицательных "
+          f"{stats['negative_hits']}), слито {stats['coalesced']}, заранее обновлено "
+          f"{stats['prefetches']}, наверх {stats['upstream']} "
+          f"(ошибок {stats['upstream_errors']}), сэкономлено {stats['saved_ms'] / 1000:.1f} с, "
+          f"в кэше {stats['cached']}")
+
+def write_stats(path, stats):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(stats, f)
+    os.replace(tmp, path)
+
+async def run_forwarder(listen, upstream, capacity, stats_interval, stats_file=None):
+    forwarder = DnsForwarder(upstream, capacity)
+    address = await forwarder.start(listen)
+    print(f"Кэширующий DNS слушает {address[0]}:{address[1]}, "
+          f"наверх {upstream[0]}:{upstream[1]}")
+    try:
+        while True:
+            await asyncio.sleep(stats_interval)
+            stats = forwarder.stats()
+            print_forwarder_stats(stats)
+            if stats_file:
+                try:
+                    write_stats(stats_file, stats)
+                except OSError as e:
+                    print(f"Не удалось записать статистику: {e}")
+    finally:
+        forwarder.close()
+
+def latency_percentiles(values):
+    """p50/p95/p99 в миллисекундах"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {f'p{q}': round(ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))] * 1000, 2)
+            for q in (50, 95, 99)}
+
+def summarize(results, target_rate, send_time):
+    answered = [result for result in results if result.error is None]
+    timeouts = sum(result.error == 'timeout' for result in results)
+    return {
+        'target_qps': target_rate,
+        'achieved_qps': round(len(results) / send_time, 1) if send_time > 0 else None,
+        'sent': len(results),
+        'answered': len(answered),
+        'timeouts': timeouts,
+        'errors': len(results) - len(answered) - timeouts,
+        'rcodes': dict(collections.Counter(result.status() for result in answered)),
+        'latency_ms': latency_percentiles([result.latency for result in answered]),
+    }
+
+def loss(stats):
+    return (stats['timeouts'] + stats['errors']) / max(stats['sent'], 1)
+
+async def replay(server, domains, rate, seconds, qtype='A', timeout=DNS_TIMEOUT):
+    """Открытый цикл: запрос i уходит в момент start + i/rate, не дожидаясь
+    ответов на прежние, - медленный резолвер не снижает нагрузку на себя"""
+    loop = asyncio.get_running_loop()
+    count = max(1, int(rate * seconds))
+    names = itertools.islice(itertools.cycle(domains), count)
+    tasks = []
+    start = loop.time()
+    for i, name in enumerate(names):
+        delay = start + i / rate - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(dns_query(server, name, qtype, timeout)))
+    send_time = max(loop.time() - start, (count - 1) / rate)
+    return summarize(await asyncio.gather(*tasks), rate, send_time)
+
+async def cache_latency(server, domains, qtype='A', timeout=DNS_TIMEOUT):
+    """Холодный кэш - имя со случайной меткой, которого у резолвера точно нет
+    (ему приходится идти наверх); тёплый - тот же запрос сразу следом"""
+    async def pair(domain):
+        name = f'{random.getrandbits(48):012x}.{domain}'
+        cold = await dns_query(server, name, qtype, timeout)
+        warm = await dns_query(server, name, qtype, timeout)
+        return cold, warm
+
+    pairs = await asyncio.gather(*(pair(domain) for domain in domains))
+    cold = [c.latency for c, _ in pairs if c.error is None]
+    warm = [w.latency for c, w in pairs if c.error is None and w.error is None]
+    return latency_percentiles(cold), latency_percentiles(warm)
+
+async def max_qps(server, domains, start_rate, limit, seconds, qtype='A', timeout=DNS_TIMEOUT):
+    """Удваиваем темп, пока держатся потери, темп отправки и p99 < timeout/2"""
+    steps = []
+    best = None
+    rate = start_rate
+    while rate <= limit:
+        stats = await replay(server, domains, rate, seconds, qtype, timeout)
+        steps.append(stats)
+        latency = stats['latency_ms']
+        if (loss(stats) > BENCH_MAX_LOSS or stats['achieved_qps'] < 0.95 * rate
+                or latency is None or latency['p99'] > timeout * 500):
+            break
+        best = rate
+        rate *= 2
+    return best, steps
+
+async def bench_resolver(server, domains, args):
+    cold, warm = await cache_latency(server, domains, args.qtype, args.dns_timeout)
+    stats = await replay(server, domains, args.rate, args.bench_seconds, args.qtype,
+                         args.dns_timeout)
+    best, steps = None, []
+    if args.max_qps and loss(stats) <= BENCH_MAX_LOSS:
+        best, steps = await max_qps(server, domains, args.rate * 2, args.max_qps,
+                                    args.step_seconds, args.qtype, args.dns_timeout)
+        best = best or args.rate
+    return {
+        'server': f'{server[0]}:{server[1]}',
+        'replay': stats,
+        'cold_ms': cold,
+        'warm_ms': warm,
+        'max_qps': best,
+        'ramp': steps,
+    }
+
+def print_resolver(report):
+    stats, latency = report['replay'], report['replay']['latency_ms']
+    print(f"\nDNS сервер: {report['server']}")
+    if latency:
+        print(f"  задержка: p50 {latency['p50']} мс, p95 {latency['p95']} мс, "
+              f"p99 {latency['p99']} мс при {stats['achieved_qps']} запр/с")
+    print(f"  ответов {stats['answered']}/{stats['sent']}, таймаутов {stats['timeouts']}, "
+          f"ошибок {stats['errors']}, коды: {stats['rcodes']}")
+    if report['cold_ms'] and report['warm_ms']:
+        print(f"  кэш: холодный p50 {report['cold_ms']['p50']} мс, "
+              f"тёплый p50 {report['warm_ms']['p50']} мс")
+    if report['max_qps']:
+        print(f"  держит до {report['max_qps']:g} запр/с")
+
+async def bench_dns(servers, domains, args):
+    """Резолверы по очереди, чтобы не мешали друг другу"""
+    reports = []
+    for server in servers:
+        report = await bench_resolver(parse_server(server), domains, args)
+        print_resolver(report)
+        reports.append(report)
+    ranked = sorted((report for report in reports if report['replay']['latency_ms']),
+                    key=lambda report: report['replay']['latency_ms']['p50'])
+    if ranked:
+        print("\nПо p50: " + ", ".join(f"{report['server']} {report['replay']['latency_ms']['p50']} мс"
+                                       for report in ranked))
+    return reports
+
+def write_report(path, args, reports):
+    """Отчёт вместе с условиями запуска; '-' - в stdout"""
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': {key: value for key, value in vars(args).items() if key != 'json'},
+        'resolvers': reports,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if path == '-':
+        print(text)
+    else:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+        print(f"Отчёт записан в {path}")
+
+def load_domains(path):
+    """Домен на строку; из CSV вида 'ранг,домен' берём последнее поле"""
+    domains = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                domains.append(line.rsplit(',', 1)[-1])
+    return domains
+
+async def stub_bench(domains, args):
+    """Офлайн: кэширующий локальный резолвер, медленный upstream и молчащий"""
+    records = {domain: ['127.0.0.1'] for domain in domains}
+    stubs = [DnsStub(records, miss_delay=0.03), DnsStub(records, delay=0.02, miss_delay=0.08),
+             DnsStub(records, drop=True)]
+    servers = [f'{host}:{port}' for host, port in [await stub.start() for stub in stubs]]
+    try:
+        return await bench_dns(servers, domains, args)
+    finally:
+        for stub in stubs:
+            stub.close()
+
+def run_bench(args):
+    domains = load_domains(args.domains_file) if args.domains_file else args.domain or BENCH_DOMAINS
+    # С --json - таблица уходит в stderr, чтобы stdout был чистым JSON
+    with contextlib.redirect_stdout(sys.stderr if args.json == '-' else sys.stdout):
+        print(f"Бенчмарк DNS: {len(domains)} доменов, {args.rate:g} запр/с, "
+              f"{args.bench_seconds:g} с на сервер")
+        if args.stub:
+            reports = asyncio.run(stub_bench(domains, args))
+        else:
+            reports = asyncio.run(bench_dns(args.dns_server or DNS_SERVERS, domains, args))
+    if args.json:
+        write_report(args.json, args, reports)
+
+
 class PrivacyTools:
     def __init__(self):
         self.dnscrypt_installed = False
@@ -65,7 +934,7 @@ class PrivacyTools:
             print(f"✗ Ошибка установки: {e}")
             return False
     
-    def configure_dnscrypt(self):
+    def configure_dnscrypt(self, listen=DNSCRYPT_LISTEN):
         """Настраиваем DNSCrypt-proxy"""
         print("\nНастраиваем DNSCrypt...")
         
@@ -76,8 +945,8 @@ class PrivacyTools:
                 shutil.copy(config_path, f"{config_path}.backup")
             
             # Простая конфигурация
-            config = """# Простая конфигурация DNSCrypt
-listen_addresses = ['127.0.0.1:53']
+            config = f"""# Простая конфигурация DNSCrypt
+listen_addresses = ['{listen}']
 server_names = ['cloudflare', 'quad9-doh-ip4-filter-pri']
 
 # Используем DNS-over-HTTPS
@@ -133,35 +1002,52 @@ server_names = ['cloudflare', 'quad9-doh-ip4-filter-pri']
             print(f"Ошибка запуска: {e}")
             return False
     
-    def test_dns(self):
-        """Тестируем DNS"""
+    def test_dns(self, servers=DNS_SERVERS, domains=TEST_DOMAINS, qtype='A', timeout=DNS_TIMEOUT):
+        """Тестируем DNS: все серверы и домены одновременно, без dig"""
         print("\n=== Тестирование DNS ===\n")
         
-        dnscrypt_servers = [
-            "127.0.0.1",  # Локальный DNSCrypt
-            "9.9.9.9",    # Quad9
-            "1.1.1.1",    # Cloudflare
-            "8.8.8.8",    # Google
-        ]
-        
-        test_domains = ["google.com", "yandex.ru", "github.com"]
+        addresses = [parse_server(server) for server in servers]
+        start = time.monotonic()
+        results = asyncio.run(query_all(addresses, domains, qtype, timeout))
+        elapsed = time.monotonic() - start
         
-        for server in dnscrypt_servers:
+        for i, server in enumerate(servers):
             print(f"\nDNS сервер: {server}")
-            for domain in test_domains:
-                try:
-                    result = subprocess.run(
-                        ["dig", f"@{server}", domain, "+short"],
-                        capture_output=True,
-                        text=True,
-                        timeout=5
-                    )
-                    if result.stdout.strip():
-                        print(f"  {domain}: ✓")
-                    else:
-                        print(f"  {domain}: ✗")
-                except:
-                    print(f"  {domain}: ✗ (ошибка)")
+            for result in results[i * len(domains):(i + 1) * len(domains)]:
+                print(f"  {result}")
+        
+        print(f"\n{len(results)} запросов за {elapsed:.2f} с (таймаут {timeout:g} с)")
+        return results
+    
+    def install_forwarder(self):
+        """Кэширующий DNS на 127.0.0.1:53, dnscrypt-proxy переезжает на 5353"""
+        print("\n=== Установка кэширующего DNS ===\n")
+        
+        upstream = ':'.join(map(str, FORWARDER_UPSTREAM))
+        listen = ':'.join(map(str, FORWARDER_LISTEN))
+        unit = f"""[Unit]
+Description=Кэширующий DNS перед dnscrypt-proxy
+After=dnscrypt-proxy.service
+Wants=dnscrypt-proxy.service
+
+[Service]
+ExecStart={sys.executable} {os.path.abspath(__file__)} --forwarder --listen {listen} --upstream {upstream} --stats-file {FORWARDER_STATS}
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+"""
+        try:
+            self.configure_dnscrypt(upstream)
+            with open(FORWARDER_UNIT, 'w') as f:
+                f.write(unit)
+            subprocess.run(["systemctl", "daemon-reload"], check=True)
+            subprocess.run(["systemctl", "enable", "--now", "dns-forwarder"], check=True)
+            print(f"✓ Кэширующий DNS слушает {listen}, наверх - dnscrypt-proxy на {upstream}")
+            return True
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"✗ Ошибка установки: {e}")
+            return False
     
     def install_i2p(self):
         """Устанавливаем I2P"""
@@ -391,6 +1277,15 @@ user_pref("network.proxy.failover_timeout", 300);
         except:
             print("✗ Не установлен/не доступен")
         
+        # Кэширующий DNS пишет статистику в файл раз в минуту
+        if os.path.exists(FORWARDER_STATS):
+            print("\nКэширующий DNS:")
+            try:
+                with open(FORWARDER_STATS) as f:
+                    print_forwarder_stats(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"✗ Статистика недоступна: {e}")
+        
         # Проверяем I2P
         print("\nI2P:")
         try:
@@ -425,10 +1320,11 @@ def main_menu():
         print("4. Тестировать соединение")
         print("5. Настроить браузер для I2P")
         print("6. Показать статус")
-        print("7. Выход")
+        print("7. Кэширующий DNS перед DNSCrypt")
+        print("8. Выход")
         print("="*50)
         
-        choice = input("\nВыберите действие (1-7): ").strip()
+        choice = input("\nВыберите действие (1-8): ").strip()
         
         if choice == "1":
             if tools.check_root():
@@ -459,18 +1355,92 @@ def main_menu():
             tools.show_status()
         
         elif choice == "7":
+            if tools.check_root():
+                tools.install_forwarder()
+        
+        elif choice == "8":
             print("\nВыход...")
             break
         
         else:
             print("Неверный выбор")
 
+async def stub_test(tools, domains, qtype, timeout):
+    """Проверка DNS-клиента без сети: живая заглушка, медленная, только-TCP
+    и молчащая; всё вместе должно занять около одного таймаута"""
+    records = {domain: ['127.0.0.1', '::1'] for domain in domains}
+    stubs = [DnsStub(records), DnsStub(records, delay=0.2), DnsStub(records, truncate=True),
+             DnsStub(records, drop=True)]
+    addresses = [await stub.start() for stub in stubs]
+    try:
+        servers = [f'{host}:{port}' for host, port in addresses]
+        await asyncio.get_running_loop().run_in_executor(
+            None, tools.test_dns, servers, domains + ['nonexistent.invalid'], qtype, timeout)
+    finally:
+        for stub in stubs:
+            stub.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Настройка DNSCrypt и I2P")
+    parser.add_argument('--test-dns', action='store_true',
+                        help="только проверить DNS серверы и выйти")
+    parser.add_argument('--dns-server', action='append',
+                        help="DNS сервер (хост или хост:порт), можно несколько раз")
+    parser.add_argument('--domain', action='append', help="домен для проверки")
+    parser.add_argument('--qtype', default='A', choices=sorted(QTYPES))
+    parser.add_argument('--dns-timeout', type=float, default=DNS_TIMEOUT)
+    parser.add_argument('--stub', action='store_true',
+                        help="проверить DNS-клиент на локальных заглушках, без сети")
+    parser.add_argument('--bench-dns', action='store_true',
+                        help="бенчмарк резолверов: задержка, кэш, таймауты, максимум QPS")
+    parser.add_argument('--domains-file', help="список доменов для бенчмарка, по одному в строке")
+    parser.add_argument('--rate', type=float, default=BENCH_RATE,
+                        help="темп воспроизведения списка, запросов в секунду")
+    parser.add_argument('--bench-seconds', type=float, default=BENCH_SECONDS,
+                        help="длительность воспроизведения на сервер")
+    parser.add_argument('--max-qps', type=float, default=BENCH_MAX_QPS,
+                        help="потолок поиска максимального QPS (0 - не искать)")
+    parser.add_argument('--step-seconds', type=float, default=BENCH_STEP_SECONDS,
+                        help="длительность каждой ступени поиска QPS")
+    parser.add_argument('--json', metavar='PATH',
+                        help="записать отчёт бенчмарка в JSON ('-' - в stdout)")
+    parser.add_argument('--forwarder', action='store_true',
+                        help="запустить кэширующий DNS перед dnscrypt-proxy")
+    parser.add_argument('--listen', type=parse_server, default=FORWARDER_LISTEN,
+                        help="адрес кэширующего DNS, хост:порт")
+    parser.add_argument('--upstream', type=parse_server, default=FORWARDER_UPSTREAM,
+                        help="куда пересылать промахи (dnscrypt-proxy), хост:порт")
+    parser.add_argument('--cache-size', type=int, default=FORWARDER_CACHE_SIZE)
+    parser.add_argument('--stats-interval', type=float, default=FORWARDER_STATS_INTERVAL)
+    parser.add_argument('--stats-file', help="куда писать статистику кэша в JSON")
+    return parser.parse_args()
+
 if __name__ == "__main__":
     # Проверяем Python версию
-    if sys.version_info < (3, 6):
-        print("Требуется Python 3.6 или выше")
+    if sys.version_info < (3, 7):
+        print("Требуется Python 3.7 или выше")
         sys.exit(1)
     
+    args = parse_args()
+    domains = args.domain or TEST_DOMAINS
+    if args.bench_dns:
+        run_bench(args)
+        sys.exit(0)
+    if args.forwarder:
+        try:
+            asyncio.run(run_forwarder(args.listen, args.upstream, args.cache_size,
+                                      args.stats_interval, args.stats_file))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    if args.stub:
+        asyncio.run(stub_test(PrivacyTools(), domains, args.qtype, args.dns_timeout))
+        sys.exit(0)
+    if args.test_dns:
+        PrivacyTools().test_dns(args.dns_server or DNS_SERVERS, domains, args.qtype,
+                                args.dns_timeout)
+        sys.exit(0)
+    
     print("Скрипт для настройки DNSCrypt и I2P")
     print("Некоторые операции требуют прав root")
     
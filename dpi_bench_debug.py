@@ -0,0 +1,768 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк локального релея dpi_started_debug.py
+Сравнивает режимы threaded и asyncio: соединений в секунду и память (RSS),
+скорость больших загрузок и процессорное время релея на гигабайт,
+цену стратегий фрагментации ClientHello для первого обмена
+задержку рукопожатия SOCKS5 / HTTP CONNECT, скорость правил маршрутизации,
+память релея при медленных клиентах и цену сбора метрик.
+С --json результаты пишутся файлом, чтобы сравнивать версии и режимы
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import ssl
+import subprocess
+import sys
+import time
+import zlib
+
+from dpi_started_debug import FRAGMENT_STRATEGIES, Router, SniFragmenter
+
+RELAY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dpi_started_debug.py')
+
+# Имя режима бенчмарка -> аргументы релея
+MODES = {
+    'threaded': ['--mode', 'threaded'],
+    'threaded-copy': ['--mode', 'threaded', '--no-splice'],
+    'asyncio': ['--mode', 'asyncio'],
+    'asyncio-pool': ['--mode', 'asyncio', '--pool-min', '32'],
+    'asyncio-2w': ['--mode', 'asyncio', '--workers', '2'],
+    'asyncio-4w': ['--mode', 'asyncio', '--workers', '4'],
+}
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+# Неоднородный шаблон, чтобы перепутанные куски были видны по crc32
+DOWNLOAD_CHUNK = bytes(range(256)) * 1024
+
+
+def expected_crc(size):
+    crc = 0
+    for offset in range(0, size, len(DOWNLOAD_CHUNK)):
+        crc = zlib.crc32(DOWNLOAD_CHUNK[:size - offset], crc)
+    return crc
+
+
+def raise_nofile_limit():
+    """Поднимаем лимит файловых дескрипторов до максимума"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_tree(pid):
+    """pid и все его потомки (воркеры релея в режиме --workers)"""
+    pids = [pid]
+    for current in pids:
+        try:
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def read_proc_status(pid):
+    """RSS, пиковый RSS (КБ) и число потоков процесса с потомками из /proc"""
+    stats = {}
+    for current in process_tree(pid):
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ('VmRSS', 'VmHWM'):
+                        stats[key] = stats.get(key, 0) + int(value.split()[0])
+                    elif key == 'Threads':
+                        stats[key] = stats.get(key, 0) + int(value)
+        except OSError:
+            pass
+    return stats
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def read_cpu_seconds(pid):
+    """utime + stime процесса с потомками в секундах"""
+    total = 0
+    for current in process_tree(pid):
+        try:
+            with open(f'/proc/{current}/stat') as f:
+                fields = f.read().rpartition(')')[2].split()
+            total += int(fields[11]) + int(fields[12])
+        except OSError:
+            pass
+    return total / CLOCK_TICKS
+
+
+class EchoServer:
+    """Локальная замена удалённого сервера: возвращаем всё обратно.
+    Если задан download, на первый запрос отдаём столько байт и закрываем;
+    с sink читаем всё до EOF и отвечаем числом принятых байт (8 байт)"""
+
+    def __init__(self, download=0, sink=False):
+        self.server = None
+        self.writers = set()
+        self.download = download
+        self.sink = sink
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            if self.download:
+                await reader.read(65536)
+                await self.send_download(writer)
+                return
+            if self.sink:
+                total = 0
+                while data := await reader.read(262144):
+                    total += len(data)
+                writer.write(total.to_bytes(8, 'big'))
+                await writer.drain()
+                return
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def send_download(self, writer):
+        chunk = memoryview(DOWNLOAD_CHUNK)
+        left = self.download
+        while left > 0:
+            writer.write(chunk[:min(left, len(chunk))])
+            left -= len(chunk)
+            await writer.drain()
+
+    async def close(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await asyncio.sleep(0.1)
+
+
+async def wait_port(port, deadline=10.0):
+    start = time.monotonic()
+    while time.monotonic() - start < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return True
+        except OSError:
+            await asyncio.sleep(0.05)
+    return False
+
+
+async def one_connection(port, payload, latencies, errors, requests=1, timeout=10.0, rtts=None):
+    """requests эхо-обменов на одном соединении; первый считается от подключения"""
+    start = time.perf_counter()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection('127.0.0.1', port), timeout)
+        for i in range(requests):
+            writer.write(payload)
+            await writer.drain()
+            await asyncio.wait_for(reader.readexactly(len(payload)), timeout)
+            now = time.perf_counter()
+            if i == 0:
+                latencies.append(now - start)
+            elif rtts is not None:
+                rtts.append(now - start)
+            start = now
+    except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+        errors.append(1)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run_load(port, total, concurrency, payload, pid, requests=1):
+    """Гоняем total соединений не более concurrency одновременно.
+
+    requests - обменов на соединение: 1 - максимальная текучка соединений,
+    больше - долгие соединения и задержка обмена без подключения (rtt).
+    """
+    latencies, errors, rtts = [], [], []
+    peak = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with semaphore:
+            await one_connection(port, payload, latencies, errors, requests, rtts=rtts)
+
+    async def sample():
+        while True:
+            stats = read_proc_status(pid)
+            for key, value in stats.items():
+                peak[key] = max(peak.get(key, 0), value)
+            await asyncio.sleep(0.1)
+
+    sampler = asyncio.ensure_future(sample())
+    start = time.perf_counter()
+    await asyncio.gather(*(limited() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+
+    exchanged = (len(latencies) + len(rtts)) * len(payload)
+    return {
+        'connections': len(latencies),
+        'errors': len(errors),
+        'payload': len(payload),
+        'requests': requests,
+        'seconds': round(elapsed, 3),
+        'conn_per_sec': round(len(latencies) / elapsed, 1),
+        # Эхо: каждый байт проходит релей дважды
+        'mb_per_sec': round(2 * exchanged / 2 ** 20 / elapsed, 2),
+        # Время до первого байта ответа: подключение + соединение релея с сервером + эхо
+        'ttfb_p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'ttfb_p90_ms': round(percentile(latencies, 90) * 1000, 2),
+        'ttfb_p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'rtt_p50_ms': round(percentile(rtts, 50) * 1000, 2) if rtts else None,
+        'rtt_p99_ms': round(percentile(rtts, 99) * 1000, 2) if rtts else None,
+        'peak_rss_kb': max(peak.get('VmRSS', 0), read_proc_status(pid).get('VmHWM', 0)),
+        'peak_threads': peak.get('Threads', 0),
+    }
+
+
+async def one_upload(port, size, sent, mismatched, chunk=b'x' * 262144):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    left = size
+    while left > 0:
+        writer.write(chunk[:left])
+        left -= len(chunk)
+        await writer.drain()
+    writer.write_eof()
+    reply = await reader.readexactly(8)
+    writer.close()
+    received = int.from_bytes(reply, 'big')
+    sent.append(received)
+    if received != size:
+        mismatched.append(1)
+
+
+async def run_upload(port, size, streams, pid):
+    """streams параллельных отправок по size байт в сток через релей"""
+    sent, mismatched = [], []
+    cpu_before = read_cpu_seconds(pid)
+    start = time.perf_counter()
+    await asyncio.gather(*(one_upload(port, size, sent, mismatched) for _ in range(streams)))
+    elapsed = time.perf_counter() - start
+    cpu = read_cpu_seconds(pid) - cpu_before
+    total = sum(sent)
+    gigabytes = total / 2 ** 30
+    return {
+        'bytes': total,
+        'lost_bytes': size * streams - total,
+        'corrupted_streams': len(mismatched),
+        'seconds': round(elapsed, 3),
+        'mb_per_sec': round(total / 2 ** 20 / elapsed, 1),
+        'cpu_sec_per_gb': round(cpu / gigabytes, 3) if gigabytes else None,
+    }
+
+
+async def one_download(port, size, received, corrupted, read_size=262144, pause=0.0):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET')
+    await writer.drain()
+    crc = 0
+    while True:
+        data = await reader.read(read_size)
+        if not data:
+            break
+        crc = zlib.crc32(data, crc)
+        received.append(len(data))
+        if pause:
+            await asyncio.sleep(pause)
+    writer.close()
+    if crc != expected_crc(size):
+        corrupted.append(1)
+
+
+async def run_download(port, size, streams, pid):
+    """streams параллельных загрузок по size байт через релей"""
+    received, corrupted = [], []
+    cpu_before = read_cpu_seconds(pid)
+    start = time.perf_counter()
+    await asyncio.gather(*(one_download(port, size, received, corrupted) for _ in range(streams)))
+    elapsed = time.perf_counter() - start
+    cpu = read_cpu_seconds(pid) - cpu_before
+    total = sum(received)
+    gigabytes = total / 2 ** 30
+    return {
+        'bytes': total,
+        'lost_bytes': size * streams - total,
+        'corrupted_streams': len(corrupted),
+        'seconds': round(elapsed, 3),
+        'mb_per_sec': round(total / 2 ** 20 / elapsed, 1),
+        'cpu_sec_per_gb': round(cpu / gigabytes, 3) if gigabytes else None,
+    }
+
+
+def make_client_hello(server_name='www.example.com'):
+    """Настоящий ClientHello от модуля ssl, без сети"""
+    context = ssl.create_default_context()
+    outgoing = ssl.MemoryBIO()
+    tls = context.wrap_bio(ssl.MemoryBIO(), outgoing, server_hostname=server_name)
+    try:
+        tls.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return outgoing.read()
+
+
+def bench_split(hello, rounds=20000):
+    """Микробенчмарк: мкс на разбор и разрезание одного ClientHello"""
+    results = {}
+    view = memoryview(hello)
+    for strategy in FRAGMENT_STRATEGIES:
+        fragmenter = SniFragmenter(strategy)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fragmenter.split(view)
+        results[strategy] = round((time.perf_counter() - start) / rounds * 1e6, 2)
+    return results
+
+
+def bench_routes(count, lookups=100000):
+    """Мкс на решение маршрута при count правилах: без кэша и с LRU"""
+    rng = random.Random(1)
+    labels = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(8))
+              for _ in range(2000)]
+    domains = [f'{rng.choice(labels)}.{rng.choice(labels)}.{rng.choice(("com", "ru", "org"))}'
+               for _ in range(count)]
+    start = time.perf_counter()
+    router = Router('\n'.join(f'{domain} direct' for domain in domains))
+    build = time.perf_counter() - start
+    hosts = [f'www.{rng.choice(domains)}' if i % 2 else f'cdn.{rng.choice(labels)}.net'
+             for i in range(1000)]
+    results = {'rules': router.rules, 'build_ms': round(build * 1000, 1)}
+    for name, lookup in (('match_us', router.match), ('cached_us', router.route)):
+        start = time.perf_counter()
+        for i in range(lookups):
+            lookup(hosts[i % len(hosts)])
+        results[name] = round((time.perf_counter() - start) / lookups * 1e6, 3)
+    return results
+
+
+async def first_round_trip(port, hello, samples):
+    """Время от подключения до возврата всего ClientHello от эхо-сервера"""
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(hello)
+    received = 0
+    while received < len(hello):
+        data = await reader.read(65536)
+        if not data:
+            break
+        received += len(data)
+    writer.close()
+    samples.append(time.perf_counter() - start)
+
+
+async def bench_fragment(mode, strategy, args):
+    echo = EchoServer()
+    echo_port = await echo.start()
+    extra = ['--fragment', strategy, '--fragment-delay', str(args.fragment_delay)]
+    relay, relay_port = await start_relay(mode, echo_port, extra)
+    hello = make_client_hello()
+    samples = []
+    try:
+        for _ in range(args.rounds):
+            await first_round_trip(relay_port, hello, samples)
+    finally:
+        relay.terminate()
+        relay.wait()
+        await echo.close()
+    return {
+        'mode': mode,
+        'strategy': strategy,
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+    }
+
+
+async def proxy_handshake(kind, port, target_port, samples, errors):
+    """Время от подключения до ответа прокси «соединение установлено»"""
+    writer = None
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        if kind == 'socks5':
+            writer.write(b'\x05\x01\x00')
+            await reader.readexactly(2)
+            writer.write(b'\x05\x01\x00\x03\x09localhost' + target_port.to_bytes(2, 'big'))
+            reply = await reader.readexactly(10)
+            ok = reply[1] == 0
+        else:
+            writer.write(f'CONNECT 127.0.0.1:{target_port} HTTP/1.1\r\n'
+                         f'Host: 127.0.0.1:{target_port}\r\n\r\n'.encode())
+            reply = await reader.readuntil(b'\r\n\r\n')
+            ok = reply.startswith(b'HTTP/1.1 200')
+        elapsed = time.perf_counter() - start
+        # Проверяем, что туннель действительно работает
+        writer.write(b'ping')
+        ok = ok and await reader.readexactly(4) == b'ping'
+        if ok:
+            samples.append(elapsed)
+        else:
+            errors.append(1)
+    except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        errors.append(1)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def bench_handshake(mode, kind, args):
+    echo = EchoServer()
+    echo_port = await echo.start()
+    relay, relay_port = await start_relay(mode, echo_port)
+    samples, errors = [], []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited():
+        async with semaphore:
+            await proxy_handshake(kind, relay_port, echo_port, samples, errors)
+
+    try:
+        await asyncio.gather(*(limited() for _ in range(args.connections)))
+    finally:
+        relay.terminate()
+        relay.wait()
+        await echo.close()
+    return {
+        'mode': mode,
+        'kind': kind,
+        'errors': len(errors),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+    }
+
+
+async def bench_slow_reader(mode, args):
+    """Быстрый сервер и медленные клиенты: RSS релея должен стоять на месте"""
+    size = args.download * 2 ** 20
+    source = EchoServer(download=size)
+    source_port = await source.start()
+    extra = ['--mem-limit', str(args.mem_limit)]
+    relay, relay_port = await start_relay(mode, source_port, extra)
+    received, corrupted, rss = [], [], []
+
+    async def sample():
+        while True:
+            rss.append(read_proc_status(relay.pid).get('VmRSS', 0))
+            await asyncio.sleep(0.2)
+
+    sampler = asyncio.ensure_future(sample())
+    start = time.perf_counter()
+    try:
+        # ~16 КБ за 10 мс на поток - намного медленнее сервера
+        await asyncio.gather(*(one_download(relay_port, size, received, corrupted, 16384, 0.01)
+                               for _ in range(args.streams)))
+    finally:
+        sampler.cancel()
+        relay.terminate()
+        relay.wait()
+        await source.close()
+    return {
+        'mode': mode,
+        'seconds': round(time.perf_counter() - start, 1),
+        'lost_bytes': size * args.streams - sum(received),
+        'corrupted_streams': len(corrupted),
+        'rss_start_mb': round(rss[min(len(rss) - 1, 5)] / 1024, 1),
+        'rss_peak_mb': round(max(rss) / 1024, 1),
+        'rss_end_mb': round(rss[-1] / 1024, 1),
+    }
+
+
+async def start_relay(mode, upstream_port, extra=()):
+    relay_port = free_port()
+    relay = subprocess.Popen(
+        [sys.executable, RELAY_SCRIPT, *MODES[mode], *extra, '--port', str(relay_port),
+         '--remote', f'127.0.0.1:{upstream_port}'],
+        stdout=subprocess.DEVNULL,
+    )
+    if not await wait_port(relay_port):
+        relay.terminate()
+        raise RuntimeError(f"релей в режиме {mode} не запустился")
+    return relay, relay_port
+
+
+async def fetch_metrics(port, path='/metrics.json'):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode())
+    response = await reader.read()
+    writer.close()
+    return response.partition(b'\r\n\r\n')[2]
+
+
+async def with_metrics(upstream, scrape, run):
+    """Релей asyncio с --metrics-port; run(relay_port, pid) под опросом /metrics или без"""
+    upstream_port = await upstream.start()
+    metrics_port = free_port()
+    relay, relay_port = await start_relay('asyncio', upstream_port,
+                                          ['--metrics-port', str(metrics_port)])
+    scrapes = []
+
+    async def scraper():
+        while True:
+            start = time.perf_counter()
+            await fetch_metrics(metrics_port, '/metrics')
+            scrapes.append(time.perf_counter() - start)
+            await asyncio.sleep(0.1)
+
+    task = asyncio.ensure_future(scraper()) if scrape else None
+    try:
+        result = await run(relay_port, relay.pid)
+        result['snapshot'] = json.loads(await fetch_metrics(metrics_port))
+        result['scrapes'] = scrapes
+        return result
+    finally:
+        if task is not None:
+            task.cancel()
+        relay.terminate()
+        relay.wait()
+        await upstream.close()
+
+
+async def bench_metrics(scrape, args):
+    """Соединения и загрузки при опросе /metrics раз в 100 мс и без него"""
+    size = args.download * 2 ** 20
+    payload = b'x' * args.payload[0]
+    load = await with_metrics(EchoServer(), scrape, lambda port, pid: run_load(
+        port, args.connections, args.concurrency, payload, pid))
+    download = await with_metrics(EchoServer(download=size), scrape, lambda port, pid: run_download(
+        port, size, args.streams, pid))
+    scrapes = load['scrapes'] + download['scrapes']
+    return {
+        'scrape': scrape,
+        'conn_per_sec': load['conn_per_sec'],
+        'mb_per_sec': download['mb_per_sec'],
+        'cpu_sec_per_gb': download['cpu_sec_per_gb'],
+        'scrape_p50_ms': round(percentile(scrapes, 50) * 1000, 2) if scrapes else '-',
+        # Счётчики релея должны сойтись с тем, что насчитали клиенты (wait_port тоже подключается)
+        'counters_ok': (load['snapshot']['accepted'] >= args.connections
+                        and load['snapshot']['bytes_in'] == args.connections * len(payload)
+                        and download['snapshot']['bytes_out'] == download['bytes']),
+    }
+
+
+async def bench_mode(mode, size, args):
+    echo = EchoServer()
+    echo_port = await echo.start()
+    relay, relay_port = await start_relay(mode, echo_port)
+    try:
+        payload = b'x' * size
+        result = await run_load(relay_port, args.connections, args.concurrency, payload,
+                                relay.pid, args.requests)
+        result['mode'] = mode
+        return result
+    finally:
+        relay.terminate()
+        relay.wait()
+        await echo.close()
+
+
+async def bench_upload(mode, args):
+    size = args.upload * 2 ** 20
+    sink = EchoServer(sink=True)
+    sink_port = await sink.start()
+    relay, relay_port = await start_relay(mode, sink_port)
+    try:
+        result = await run_upload(relay_port, size, args.streams, relay.pid)
+        result['mode'] = mode
+        return result
+    finally:
+        relay.terminate()
+        relay.wait()
+        await sink.close()
+
+
+async def bench_download(mode, args):
+    size = args.download * 2 ** 20
+    source = EchoServer(download=size)
+    source_port = await source.start()
+    relay, relay_port = await start_relay(mode, source_port)
+    try:
+        result = await run_download(relay_port, size, args.streams, relay.pid)
+        result['mode'] = mode
+        return result
+    finally:
+        relay.terminate()
+        relay.wait()
+        await source.close()
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+def write_json(path, args, results):
+    """Результаты вместе с условиями запуска; '-' - в stdout"""
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': {key: value for key, value in vars(args).items() if key != 'json'},
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if path == '-':
+        print(text)
+    else:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+        print(f"Результаты записаны в {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк режимов релея")
+    parser.add_argument('--modes', default='threaded,asyncio',
+                        help="через запятую: " + ', '.join(MODES))
+    parser.add_argument('--connections', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--payload', type=parse_sizes, default=[1024],
+                        help="размер запроса в байтах, можно несколько через запятую")
+    parser.add_argument('--requests', type=int, default=1,
+                        help="обменов на соединение: 1 - новое соединение на каждый запрос")
+    parser.add_argument('--download', type=int, default=0,
+                        help="МБ на поток: вместо теста соединений меряем скорость загрузки")
+    parser.add_argument('--upload', type=int, default=0,
+                        help="МБ на поток: вместо теста соединений меряем отправку в сток")
+    parser.add_argument('--streams', type=int, default=4,
+                        help="параллельных потоков в тестах --download и --upload")
+    parser.add_argument('--fragment', action='store_true',
+                        help="вместо теста соединений меряем цену фрагментации ClientHello")
+    parser.add_argument('--fragment-delay', type=float, default=0.0)
+    parser.add_argument('--rounds', type=int, default=300,
+                        help="подключений на стратегию в тесте --fragment")
+    parser.add_argument('--handshake', action='store_true',
+                        help="вместо теста соединений меряем рукопожатие SOCKS5 и HTTP CONNECT")
+    parser.add_argument('--slow-reader', action='store_true',
+                        help="с --download: клиенты читают медленно, следим за RSS релея")
+    parser.add_argument('--mem-limit', type=int, default=8,
+                        help="--mem-limit релея в тесте --slow-reader, МБ")
+    parser.add_argument('--metrics', action='store_true',
+                        help="меряем цену метрик: asyncio с опросом /metrics и без; "
+                             "--download задаёт МБ на поток (по умолчанию 64)")
+    parser.add_argument('--routes', type=int, default=0,
+                        help="число правил: меряем поиск маршрута вместо теста соединений")
+    parser.add_argument('--json', metavar='PATH',
+                        help="записать все результаты в JSON ('-' - в stdout)")
+    args = parser.parse_args()
+
+    results = []
+    # С --json - таблица уходит в stderr, чтобы stdout был чистым JSON
+    with contextlib.redirect_stdout(sys.stderr if args.json == '-' else sys.stdout):
+        run_scenario(args, results)
+    if args.json:
+        write_json(args.json, args, results)
+
+
+def run_scenario(args, results):
+    """Печатает таблицу выбранного теста; каждый результат добавляется в results"""
+    if args.routes:
+        result = bench_routes(args.routes)
+        results.append(dict(result, scenario='routes'))
+        print(' '.join(f"{key}={value}" for key, value in result.items()))
+        return
+
+    raise_nofile_limit()
+    if args.metrics:
+        args.download = args.download or 64
+        print(f"{'опрос':<8} {'соед/с':>10} {'МБ/с':>10} {'CPU с/ГБ':>9} "
+              f"{'опрос, мс':>10} {'счётчики':>9}")
+        for scrape in (False, True):
+            result = asyncio.run(bench_metrics(scrape, args))
+            results.append(dict(result, scenario='metrics'))
+            print(f"{'да' if scrape else 'нет':<8} {result['conn_per_sec']:>10} "
+                  f"{result['mb_per_sec']:>10} {result['cpu_sec_per_gb']:>9} "
+                  f"{result['scrape_p50_ms']:>10} {'ok' if result['counters_ok'] else 'ошибка':>9}")
+        return
+    if args.handshake:
+        print(f"{'режим':<14} {'прокси':<8} {'ошибок':>8} {'p50, мс':>8} {'p99, мс':>8}")
+        for mode in args.modes.split(','):
+            if 'threaded' in MODES[mode]:
+                # Потоковый релей шлёт всё на --remote и не понимает SOCKS5/CONNECT
+                print(f"{mode:<14} пропущен: нет фронтенда прокси")
+                continue
+            for kind in ('socks5', 'connect'):
+                result = asyncio.run(bench_handshake(mode, kind, args))
+                results.append(dict(result, scenario='handshake', mode=mode, proxy=kind))
+                print(f"{mode:<14} {kind:<8} {result['errors']:>8} "
+                      f"{result['p50_ms']:>8} {result['p99_ms']:>8}")
+        return
+    if args.fragment:
+        split_cost = bench_split(make_client_hello())
+        print(f"{'режим':<14} {'стратегия':<11} {'разбор, мкс':>11} {'p50, мс':>8} {'p99, мс':>8}")
+        for mode in args.modes.split(','):
+            for strategy in FRAGMENT_STRATEGIES:
+                result = asyncio.run(bench_fragment(mode, strategy, args))
+                results.append(dict(result, scenario='fragment', mode=mode, strategy=strategy,
+                                    split_us=split_cost[strategy]))
+                print(f"{mode:<14} {strategy:<11} {split_cost[strategy]:>11} "
+                      f"{result['p50_ms']:>8} {result['p99_ms']:>8}")
+        return
+    if args.download and args.slow_reader:
+        print(f"{'режим':<14} {'секунд':>7} {'потеряно':>9} {'битых':>6} "
+              f"{'RSS старт':>10} {'пик':>6} {'конец':>6}")
+        for mode in args.modes.split(','):
+            result = asyncio.run(bench_slow_reader(mode, args))
+            results.append(dict(result, scenario='slow-reader', mode=mode))
+            print(f"{mode:<14} {result['seconds']:>7} {result['lost_bytes']:>9} "
+                  f"{result['corrupted_streams']:>6} {result['rss_start_mb']:>10} "
+                  f"{result['rss_peak_mb']:>6} {result['rss_end_mb']:>6}")
+        return
+    if args.download or args.upload:
+        scenario, bench = ('download', bench_download) if args.download else ('upload', bench_upload)
+        print(f"{'режим':<14} {'МБ/с':>10} {'потеряно':>9} {'битых':>6} {'CPU с/ГБ':>9}")
+        for mode in args.modes.split(','):
+            result = asyncio.run(bench(mode, args))
+            results.append(dict(result, scenario=scenario))
+            print(f"{result['mode']:<14} {result['mb_per_sec']:>10} {result['lost_bytes']:>9} "
+                  f"{result['corrupted_streams']:>6} {result['cpu_sec_per_gb']:>9}")
+        return
+
+    print(f"{'режим':<14} {'байт':>7} {'соед/с':>10} {'МБ/с':>8} {'ошибок':>8} {'p50, мс':>8} "
+          f"{'p99, мс':>8} {'RSS, МБ':>9} {'потоков':>8}")
+    for mode in args.modes.split(','):
+        for size in args.payload:
+            result = asyncio.run(bench_mode(mode, size, args))
+            results.append(dict(result, scenario='load'))
+            print(f"{result['mode']:<14} {size:>7} {result['conn_per_sec']:>10} "
+                  f"{result['mb_per_sec']:>8} {result['errors']:>8} "
+                  f"{result['ttfb_p50_ms']:>8} {result['ttfb_p99_ms']:>8} "
+                  f"{result['peak_rss_kb'] / 1024:>9.1f} {result['peak_threads']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,1522 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import bisect
+import collections
+import functools
+import json
+import os
+import signal
 import socket
 import ssl
+import sys
 import threading
+import time
+import traceback
 
 LOCAL_HOST = '127.0.0.1'
 LOCAL_PORT = 8888
+REMOTE_HOST = '8.8.8.8'  # или другой сервер
+REMOTE_PORT = 443
+BUFFER_SIZE = 65536
+LISTEN_BACKLOG = 4096  # ядро всё равно обрежет до net.core.somaxconn
 
-def handle_client(client_socket):
+# Управление потоком (asyncio режим)
+MEMORY_LIMIT = 64 << 20  # все буферы чтения вместе
+HIGH_WATER = 256 << 10   # очередь записи одного соединения
+LOW_WATER = 64 << 10
+STARVE_POLL = 0.01       # как часто искать освободившиеся буферы при исчерпании
+# До 3.12 транспорт копирует неотправленный хвост, с 3.12 держит ссылку на наш буфер
+TRANSPORT_KEEPS_VIEWS = sys.version_info >= (3, 12)
+
+# Таймауты соединений (asyncio режим), секунды; 0 - без ограничения
+CONNECT_TIMEOUT = 10.0   # соединение с сервером, включая рукопожатие с Tor/I2P
+HANDSHAKE_TIMEOUT = 10.0 # рукопожатие клиента SOCKS5/CONNECT
+IDLE_TIMEOUT = 300.0     # ни байта ни в одну сторону
+LIFETIME = 0.0           # общее время жизни соединения
+TIMER_TICK = 0.25
+TIMER_SLOTS = 512
+
+# Метрики (asyncio режим): границы гистограмм задержек, секунды
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ACCEPT_WINDOW = 10  # за сколько секунд считать accept_rate
+# Накопительные числа из stats() - в Prometheus это counter с суффиксом _total,
+# остальное (текущие размеры и лимиты) - gauge
+METRICS_COUNTERS = ('hits', 'misses', 'evicted', 'dead', 'starvations',
+                    'reaped_', 'route_', 'cache_hits', 'cache_misses')
+
+# os.splice есть только на Linux и с Python 3.10
+SPLICE_AVAILABLE = hasattr(os, 'splice')
+SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0)
+
+# Пул заранее открытых соединений с сервером (asyncio режим)
+POOL_MIN = 0        # 0 - пул выключен
+POOL_MAX = 64
+POOL_IDLE = 30.0    # секунд простоя до закрытия
+POOL_CHECK = 1.0    # период обслуживания пула
+
+# Фрагментация TLS ClientHello для обхода DPI
+TLS_HANDSHAKE = 0x16
+TLS_CLIENT_HELLO = 0x01
+TLS_EXT_SERVER_NAME = 0x0000
+TLS_MAX_RECORD = 5 + 16384
+FRAGMENT_STRATEGIES = ('none', 'record', 'tcp', 'record+tcp')
+
+# Фронтенд прокси: SOCKS5 и HTTP CONNECT
+SOCKS_VERSION = 0x05
+SOCKS_NO_AUTH = 0x00
+SOCKS_CMD_CONNECT = 0x01
+HTTP_CONNECT_PREFIX = b'CONNECT '
+HTTP_MAX_HEADER = 8192
+
+# Маршрутизация по адресу назначения: напрямую, через Tor или I2P
+TOR_SOCKS = ('127.0.0.1', 9050)   # tor_started_debug.py
+I2P_HTTP = ('127.0.0.1', 4444)    # HTTP прокси I2P из DNScrypt_I2P_started_debug.py
+ROUTES = ('direct', 'tor', 'i2p')
+ROUTE_CACHE = 65536
+DEFAULT_RULES = """
+.i2p     i2p
+.onion   tor
+*        tor
+"""
+
+
+class ClientHello:
+    """Что нашли в ClientHello; смещения считаются от начала TLS записи"""
+    __slots__ = ('record_length', 'sni', 'sni_offset', 'sni_length')
+
+    def __init__(self, record_length, sni=None, sni_offset=0, sni_length=0):
+        self.record_length = record_length
+        self.sni = sni
+        self.sni_offset = sni_offset
+        self.sni_length = sni_length
+
+
+def parse_client_hello(view):
+    """Разбираем ClientHello прямо по memoryview, без копирования.
+
+    Возвращает ClientHello, None если байт пока не хватает,
+    или False если это не TLS ClientHello.
+    """
+    if len(view) < 5:
+        # Не торопимся с ответом, пока префикс похож на TLS
+        if len(view) and view[0] != TLS_HANDSHAKE or len(view) > 1 and view[1] != 3:
+            return False
+        return None
+    if view[0] != TLS_HANDSHAKE or view[1] != 3:
+        return False
+    record_length = view[3] << 8 | view[4]
+    end = 5 + record_length
+    if len(view) < end:
+        return None
     try:
-        request = client_socket.recv(4096)
-        # Просто перенаправляем трафик
-        remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        remote_socket.connect(('8.8.8.8', 443))  # или другой сервер
-        remote_socket.send(request)
-        
+        if view[5] != TLS_CLIENT_HELLO:
+            return False
+        pos = 5 + 4 + 2 + 32                        # заголовок, версия, random
+        pos += 1 + view[pos]                        # session_id
+        pos += 2 + (view[pos] << 8 | view[pos + 1]) # cipher_suites
+        pos += 1 + view[pos]                        # compression_methods
+        extensions_end = min(end, pos + 2 + (view[pos] << 8 | view[pos + 1]))
+        pos += 2
+        while pos + 4 <= extensions_end:
+            ext_type = view[pos] << 8 | view[pos + 1]
+            ext_length = view[pos + 2] << 8 | view[pos + 3]
+            pos += 4
+            if ext_type == TLS_EXT_SERVER_NAME:
+                # server_name_list: длина(2), тип имени(1), длина имени(2), имя
+                name_length = view[pos + 3] << 8 | view[pos + 4]
+                name_offset = pos + 5
+                if name_offset + name_length > end:
+                    return False
+                sni = str(view[name_offset:name_offset + name_length], 'ascii', 'replace')
+                return ClientHello(record_length, sni, name_offset, name_length)
+            pos += ext_length
+    except IndexError:
+        return False
+    return ClientHello(record_length)
+
+
+class SniFragmenter:
+    """Режем первый пакет клиента так, чтобы DPI не увидел имя сервера целиком.
+
+    record     - две TLS записи вместо одной, в одном TCP сегменте
+    tcp        - одна запись, но два TCP сегмента с разрезом посреди SNI
+    record+tcp - две записи, каждая в своём сегменте
+    delay      - пауза между сегментами в секундах
+    """
+
+    def __init__(self, strategy='none', delay=0.0):
+        self.strategy = strategy
+        self.delay = delay
+
+    @property
+    def enabled(self):
+        return self.strategy != 'none'
+
+    def split(self, view):
+        """Куски для отправки отдельными write; None - нужно больше данных"""
+        hello = parse_client_hello(view)
+        if hello is None:
+            if len(view) < TLS_MAX_RECORD:
+                return None
+            hello = False
+        if not hello or hello.sni is None or not self.enabled:
+            return [view]
+        end = 5 + hello.record_length
+        cut = hello.sni_offset + hello.sni_length // 2
+        tail = view[end:]
+        if self.strategy == 'tcp':
+            return [view[:cut], view[cut:]]
+        # Тот же тип и версия, новые длины
+        first = bytes(view[:3]) + (cut - 5).to_bytes(2, 'big')
+        second = bytes(view[:3]) + (end - cut).to_bytes(2, 'big')
+        if self.strategy == 'record':
+            return [b''.join((first, view[5:cut], second, view[cut:end], tail))]
+        return [first + view[5:cut], b''.join((second, view[cut:end], tail))]
+
+
+def pump(src, dst, buffer_size=BUFFER_SIZE):
+    """Копируем src -> dst через один заранее выделенный буфер"""
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        n = src.recv_into(buffer)
+        if not n:
+            break
+        dst.sendall(view[:n])
+
+def splice_pump(src, dst, buffer_size=BUFFER_SIZE):
+    """Linux: сокет -> pipe -> сокет, данные не копируются в userspace"""
+    pipe_r, pipe_w = os.pipe()
+    try:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
         while True:
-            response = remote_socket.recv(4096)
-            if not response:
+            n = os.splice(src_fd, pipe_w, buffer_size, flags=SPLICE_FLAGS)
+            if not n:
                 break
-            client_socket.send(response)
-    except:
+            while n:
+                n -= os.splice(pipe_r, dst_fd, n, flags=SPLICE_FLAGS)
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+
+def pump_half(src, dst, use_splice):
+    """Одно направление туннеля; по EOF полузакрываем получателя"""
+    try:
+        if use_splice:
+            splice_pump(src, dst)
+        else:
+            pump(src, dst)
+    except OSError:
+        pass
+    try:
+        dst.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+def send_first_flight(client_socket, remote_socket, fragmenter):
+    """Дочитываем ClientHello и отправляем его кусками"""
+    remote_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    data = b''
+    while True:
+        chunk = client_socket.recv(BUFFER_SIZE)
+        data += chunk
+        chunks = fragmenter.split(memoryview(data)) if chunk else [data]
+        if chunks is not None:
+            break
+    for i, chunk in enumerate(chunks):
+        if i and fragmenter.delay:
+            time.sleep(fragmenter.delay)
+        remote_socket.sendall(chunk)
+
+def handle_client(client_socket, remote=(REMOTE_HOST, REMOTE_PORT), use_splice=SPLICE_AVAILABLE,
+                  fragmenter=None):
+    remote_socket = None
+    try:
+        # Просто перенаправляем трафик, в обе стороны одновременно
+        remote_socket = socket.create_connection(remote)
+        if fragmenter is not None and fragmenter.enabled:
+            send_first_flight(client_socket, remote_socket, fragmenter)
+        upstream = threading.Thread(target=pump_half,
+                                    args=(remote_socket, client_socket, use_splice))
+        upstream.start()
+        pump_half(client_socket, remote_socket, use_splice)
+        upstream.join()
+    except OSError:
         pass
     finally:
         client_socket.close()
+        if remote_socket is not None:
+            remote_socket.close()
 
-def main():
+def make_listener(host, port, backlog=LISTEN_BACKLOG, reuse_port=False):
+    """Слушающий сокет; с reuse_port несколько процессов делят один порт"""
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((LOCAL_HOST, LOCAL_PORT))
-    server.listen(5)
-    
-    print(f" ✅ Успешно подключено к {LOCAL_HOST}:{LOCAL_PORT}")
-    
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((host, port))
+    server.listen(backlog)
+    return server
+
+def serve_threaded(server, remote, use_splice=SPLICE_AVAILABLE, fragmenter=None):
+    """Старый режим: отдельный поток на каждое соединение"""
+    host, port = server.getsockname()[:2]
+    print(f" ✅ Успешно подключено к {host}:{port}")
+
     while True:
         client, addr = server.accept()
-        thread = threading.Thread(target=handle_client, args=(client,))
+        thread = threading.Thread(target=handle_client, args=(client, remote, use_splice, fragmenter))
         thread.start()
 
+
+# --- asyncio режим: все сокеты на одном цикле событий ---
+
+class Timer:
+    __slots__ = ('expires', 'slot', 'callback')
+
+    def __init__(self, expires, slot, callback):
+        self.expires = expires
+        self.slot = slot
+        self.callback = callback
+
+
+class TimerWheel:
+    """Хешированное колесо таймеров: постановка и отмена за O(1).
+
+    Один call_later на всё колесо вместо таймера на каждое соединение;
+    за тик просматривается только одна ячейка. Таймеры дальше одного
+    оборота лежат в той же ячейке и ждут своего круга.
+    """
+
+    def __init__(self, tick=TIMER_TICK, slots=TIMER_SLOTS):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.now = 0
+        self.start = None
+        self.reaped = collections.Counter()
+
+    def schedule(self, delay, callback):
+        ticks = max(1, -int(-delay // self.tick))
+        expires = self.now + ticks
+        timer = Timer(expires, expires % len(self.slots), callback)
+        self.slots[timer.slot].add(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer is not None:
+            self.slots[timer.slot].discard(timer)
+
+    def run(self):
+        loop = asyncio.get_running_loop()
+        self.start = loop.time()
+        loop.call_later(self.tick, self.advance)
+
+    def advance(self):
+        loop = asyncio.get_running_loop()
+        # Догоняем по часам цикла, а не по числу вызовов: call_later запаздывает
+        target = int((loop.time() - self.start) / self.tick)
+        try:
+            while self.now < target:
+                self.now += 1
+                slot = self.slots[self.now % len(self.slots)]
+                expired = [timer for timer in slot if timer.expires <= self.now]
+                for timer in expired:
+                    slot.discard(timer)
+                    timer.callback()
+        finally:
+            loop.call_at(self.start + (self.now + 1) * self.tick, self.advance)
+
+    def stats(self):
+        stats = {f'reaped_{reason}': self.reaped[reason]
+                 for reason in ('connect', 'handshake', 'idle', 'lifetime')}
+        stats['timers'] = sum(len(slot) for slot in self.slots)
+        return stats
+
+
+def bucket_label(bound):
+    return '+Inf' if bound == float('inf') else str(bound)
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин, как в Prometheus"""
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=METRICS_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        """Верхняя граница корзины, в которую попал квантиль q; None - за последней"""
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound if bound != float('inf') else None
+        return None
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'p50': self.quantile(0.5) if self.count else None,
+            'p99': self.quantile(0.99) if self.count else None,
+            'buckets': {bucket_label(bound): total for bound, total in self.cumulative()},
+        }
+
+
+def error_class(exc):
+    """Короткое имя класса ошибки для метрик"""
+    for kind, name in ((socket.gaierror, 'dns'), (ConnectionRefusedError, 'refused'),
+                       (ConnectionResetError, 'reset'), (ConnectionAbortedError, 'reset'),
+                       (BrokenPipeError, 'reset'), (TimeoutError, 'timeout'),
+                       (ConnectionError, 'proxy'), (OSError, 'os'), (ValueError, 'host')):
+        if isinstance(exc, kind):
+            return name
+    return type(exc).__name__
+
+
+class Metrics:
+    """Счётчики и гистограммы релея.
+
+    На горячем пути только целые счётчики в самих протоколах (received);
+    суммы по живым соединениям собираются при запросе снимка, а закрытые
+    соединения добавляют свои байты в общий итог в connection_lost.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.clients = set()
+        self.accepted = 0
+        self.bytes_in = 0     # от клиентов к серверам
+        self.bytes_out = 0    # от серверов к клиентам
+        self.errors = collections.Counter()
+        self.accepts = collections.deque(maxlen=ACCEPT_WINDOW + 1)  # [секунда, принято]
+        self.connect = Histogram()
+        self.ttfb = Histogram()
+
+    def opened(self, client):
+        self.accepted += 1
+        self.clients.add(client)
+        second = int(client.started)
+        if self.accepts and self.accepts[-1][0] == second:
+            self.accepts[-1][1] += 1
+        else:
+            self.accepts.append([second, 1])
+
+    def closed(self, client):
+        if client not in self.clients:
+            return
+        self.clients.discard(client)
+        self.bytes_in += client.received
+        if client.peer is not None:
+            self.bytes_out += client.peer.received
+
+    def accept_rate(self):
+        now = int(time.monotonic())
+        recent = sum(count for second, count in self.accepts if now - ACCEPT_WINDOW <= second < now)
+        return recent / ACCEPT_WINDOW
+
+    def snapshot(self):
+        bytes_in = self.bytes_in + sum(client.received for client in self.clients)
+        bytes_out = self.bytes_out + sum(client.peer.received for client in self.clients
+                                         if client.peer is not None)
+        return {
+            'uptime': round(time.monotonic() - self.started, 3),
+            'active': len(self.clients),
+            'accepted': self.accepted,
+            'accept_rate': self.accept_rate(),
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'errors': dict(self.errors),
+            'connect_seconds': self.connect.snapshot(),
+            'ttfb_seconds': self.ttfb.snapshot(),
+        }
+
+    def prometheus(self, stats):
+        """Текстовый формат Prometheus; stats - прочие числа релея (пул, буферы, таймеры)"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP relay_{name} {help_text}")
+            lines.append(f"# TYPE relay_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"relay_{name}{labels} {value}")
+
+        metric('connections_active', 'gauge', "Open client connections",
+               [('', snapshot['active'])])
+        metric('connections_accepted_total', 'counter', "Accepted client connections",
+               [('', snapshot['accepted'])])
+        metric('bytes_total', 'counter', "Bytes relayed",
+               [('{direction="in"}', snapshot['bytes_in']),
+                ('{direction="out"}', snapshot['bytes_out'])])
+        metric('errors_total', 'counter', "Failed connections by error class",
+               [(f'{{class="{name}"}}', count) for name, count in sorted(self.errors.items())])
+        for name, histogram, help_text in (
+                ('connect_seconds', self.connect, "Upstream connect latency"),
+                ('ttfb_seconds', self.ttfb, "Accept to first upstream byte")):
+            samples = [(f'{{le="{bucket_label(bound)}"}}', total)
+                       for bound, total in histogram.cumulative()]
+            lines.append(f"# HELP relay_{name} {help_text}")
+            lines.append(f"# TYPE relay_{name} histogram")
+            lines.extend(f"relay_{name}_bucket{labels} {total}" for labels, total in samples)
+            lines.append(f"relay_{name}_sum {histogram.sum}")
+            lines.append(f"relay_{name}_count {histogram.count}")
+        for key, value in stats.items():
+            if key.startswith(METRICS_COUNTERS):
+                metric(key + '_total', 'counter', key.replace('_', ' '), [('', value)])
+            else:
+                metric(key, 'gauge', key.replace('_', ' '), [('', value)])
+        return '\n'.join(lines) + '\n'
+
+
+class BufferPool:
+    """Общий пул буферов чтения фиксированного размера с жёстким лимитом памяти.
+
+    Все соединения читают в один «горячий» буфер. Если сосед не смог сразу
+    отправить данные, его транспорт держит ссылку на хвост (с Python 3.12),
+    поэтому горячий буфер числится за соседом, пока тот не опустошит очередь
+    записи, а читать дальше будем в другой буфер из пула. В непустую очередь
+    данные уходят копией, так что за каждым соседом не больше одного буфера:
+    медленные читатели не выбирают пул, их память ограничивают водяные знаки.
+    Когда буферов больше нет, чтение приостанавливается у всех соединений
+    до их возврата.
+    """
+
+    def __init__(self, size=BUFFER_SIZE, limit=MEMORY_LIMIT,
+                 high_water=HIGH_WATER, low_water=LOW_WATER):
+        self.size = size
+        self.count = max(2, limit // size)
+        self.high_water = high_water
+        self.low_water = low_water
+        self.free = []
+        self.allocated = 0
+        self.protocols = set()
+        self.holders = set()
+        self.starved = False
+        self.starvations = 0
+        self.view = self.take()
+
+    def take(self):
+        if self.free:
+            return self.free.pop()
+        if self.allocated < self.count:
+            self.allocated += 1
+            return memoryview(bytearray(self.size))
+        return None
+
+    def register(self, protocol):
+        self.protocols.add(protocol)
+        if self.starved:
+            protocol.pause('memory')
+
+    def unregister(self, protocol):
+        self.protocols.discard(protocol)
+        self.reclaim(protocol)
+
+    def lend(self, holder):
+        """Горячий буфер остаётся в очереди записи holder, берём новый"""
+        holder.lent.append(self.view)
+        self.holders.add(holder)
+        view = self.take()
+        if view is None:
+            self.sweep()
+            view = self.take()
+        if view is None:
+            self.starve()
+        else:
+            self.view = view
+
+    def reclaim(self, holder):
+        """Очередь записи holder пуста - его буферы снова свободны"""
+        if not holder.lent:
+            return
+        self.free.extend(holder.lent)
+        holder.lent.clear()
+        self.holders.discard(holder)
+        if self.starved and len(self.free) * 4 >= self.count:
+            self.recover()
+
+    def sweep(self):
+        for holder in list(self.holders):
+            transport = holder.transport
+            if transport is None or not transport.get_write_buffer_size():
+                self.reclaim(holder)
+
+    def starve(self):
+        # Горячего буфера нет: никто не читает, пока буферы не вернутся
+        self.starved = True
+        self.starvations += 1
+        for protocol in self.protocols:
+            protocol.pause('memory')
+        asyncio.get_running_loop().call_later(STARVE_POLL, self.poll)
+
+    def poll(self):
+        # Очереди ниже low_water не сообщают об опустошении - проверяем сами
+        if not self.starved:
+            return
+        self.sweep()
+        if self.starved:
+            asyncio.get_running_loop().call_later(STARVE_POLL, self.poll)
+
+    def recover(self):
+        self.starved = False
+        self.view = self.take()
+        for protocol in list(self.protocols):
+            protocol.resume('memory')
+
+    def stats(self):
+        return {
+            'buffers_allocated': self.allocated,
+            'buffers_in_use': self.allocated - len(self.free),
+            'buffers_limit': self.count,
+            'starvations': self.starvations,
+            'paused_reading': sum(1 for protocol in self.protocols if protocol.paused),
+        }
+
+
+class RelayProtocol(asyncio.BufferedProtocol):
+    """Одна сторона туннеля: читаем через recv_into, пишем в транспорт соседа.
+
+    Очередь записи ограничена водяными знаками: выше high_water соседу
+    велят не читать (pause_writing), ниже low_water - продолжать.
+    """
+
+    def __init__(self, buffers):
+        self.buffers = buffers
+        self.transport = None
+        self.peer = None
+        self.eof = False
+        self.paused = set()
+        self.lent = []
+        self.last_active = time.monotonic()
+        self.received = 0  # байт, ушедших соседу
+        # Ответ вышестоящего прокси, пока идёт chain_handshake
+        self.reply = None
+        self.reply_parser = None
+        self.reply_waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(self.buffers.high_water, self.buffers.low_water)
+        self.buffers.register(self)
+
+    def get_buffer(self, sizehint):
+        return self.buffers.view
+
+    def pause(self, reason):
+        """Не читать, пока есть хоть одна причина: peer, memory, connect, fragment"""
+        if not self.paused and self.transport is not None:
+            self.transport.pause_reading()
+        self.paused.add(reason)
+
+    def resume(self, reason):
+        self.paused.discard(reason)
+        if not self.paused and self.transport is not None:
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        if self.peer is not None:
+            self.peer.pause('peer')
+
+    def resume_writing(self):
+        if self.transport is not None and not self.transport.get_write_buffer_size():
+            self.buffers.reclaim(self)
+        if self.peer is not None:
+            self.peer.resume('peer')
+
+    async def chain_handshake(self, request, parser):
+        """Рукопожатие с вышестоящим прокси (Tor, I2P) на этом соединении.
+
+        Возвращает байты, пришедшие от сервера сразу после ответа прокси.
+        """
+        self.reply = bytearray()
+        self.reply_parser = parser
+        self.reply_waiter = asyncio.get_running_loop().create_future()
+        self.transport.write(request)
+        try:
+            return await self.reply_waiter
+        finally:
+            self.reply = self.reply_parser = self.reply_waiter = None
+
+    def collect_reply(self, view):
+        self.reply += view
+        try:
+            consumed = self.reply_parser(self.reply)
+        except ProxyError as exc:
+            self.reply_waiter.set_exception(ConnectionError(f"прокси отказал: {exc.reply!r}"))
+            return
+        if consumed is not None:
+            self.reply_waiter.set_result(bytes(self.reply[consumed:]))
+
+    def buffer_updated(self, nbytes):
+        self.last_active = time.monotonic()
+        if self.reply_waiter is not None and not self.reply_waiter.done():
+            self.collect_reply(self.buffers.view[:nbytes])
+            return
+        if self.peer is None:
+            # Соединение из пула не должно ничего получать до выдачи клиенту
+            self.close()
+            return
+        if not self.received:
+            self.peer.first_reply()
+        self.received += nbytes
+        self.forward(self.buffers.view[:nbytes])
+
+    def forward(self, data):
+        peer = self.peer
+        transport = peer.transport
+        if transport is None:
+            return
+        queued = transport.get_write_buffer_size()
+        if peer.lent and not queued:
+            self.buffers.reclaim(peer)
+        hot = (TRANSPORT_KEEPS_VIEWS and isinstance(data, memoryview)
+               and data.obj is self.buffers.view.obj)
+        if hot and queued:
+            # Очередь уже стоит: копия вместо ещё одного буфера из пула
+            data = bytes(data)
+            hot = False
+        transport.write(data)
+        if hot and transport.get_write_buffer_size():
+            # Транспорт хранит ссылку на неотправленный хвост горячего буфера
+            self.buffers.lend(peer)
+
+    def eof_received(self):
+        self.eof = True
+        if self.peer is None or self.peer.transport is None or self.peer.eof:
+            self.close()
+        elif self.peer.transport.can_write_eof():
+            # Полузакрытие: соседу больше нечего ждать, но ответ ещё может идти
+            self.peer.transport.write_eof()
+        return True
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.buffers.unregister(self)
+        if self.reply_waiter is not None and not self.reply_waiter.done():
+            self.reply_waiter.set_exception(exc or ConnectionResetError("прокси закрыл соединение"))
+        self.close()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.close()
+
+    def abort(self):
+        """Закрыть обе стороны сразу, не дожидаясь отправки очередей"""
+        if self.transport is not None:
+            self.transport.abort()
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.abort()
+
+
+class UpstreamPool:
+    """Заранее открытые соединения с серверами, отдельно на каждый адрес.
+
+    Пока адрес используется, в пуле держится не меньше min_size свободных
+    соединений; простаивающие дольше idle_timeout закрываются. Живость
+    проверяется самим циклом событий: закрытое сервером соединение сразу
+    получает connection_lost и при выдаче пропускается.
+    """
+
+    def __init__(self, buffers, min_size=POOL_MIN, max_size=POOL_MAX,
+                 idle_timeout=POOL_IDLE, check_interval=POOL_CHECK,
+                 wheel=None, connect_timeout=CONNECT_TIMEOUT):
+        self.buffers = buffers
+        self.wheel = wheel
+        self.connect_timeout = connect_timeout
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.idle = {}          # адрес -> deque[(время постановки, протокол)]
+        self.connecting = collections.Counter()
+        self.last_used = {}
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.dead = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evicted': self.evicted,
+            'dead': self.dead,
+            'idle': sum(len(queue) for queue in self.idle.values()),
+        }
+
+    async def connect(self, remote):
+        loop = asyncio.get_running_loop()
+        _, upstream = await loop.create_connection(
+            lambda: RelayProtocol(self.buffers), *remote)
+        return upstream
+
+    async def acquire(self, remote):
+        """Свободное соединение из пула или новое, если пул пуст"""
+        self.last_used[remote] = time.monotonic()
+        queue = self.idle.get(remote)
+        while queue:
+            _, upstream = queue.pop()
+            if upstream.transport is not None and not upstream.transport.is_closing():
+                self.hits += 1
+                self.refill(remote)
+                return upstream
+            self.dead += 1
+        self.misses += 1
+        self.refill(remote)
+        return await self.connect(remote)
+
+    def refill(self, remote):
+        if not self.min_size:
+            return
+        queue = self.idle.setdefault(remote, collections.deque())
+        missing = min(self.min_size, self.max_size) - len(queue) - self.connecting[remote]
+        for _ in range(missing):
+            self.connecting[remote] += 1
+            asyncio.ensure_future(self.add(remote))
+
+    async def add(self, remote):
+        timer = None
+        if self.wheel is not None and self.connect_timeout:
+            timer = self.wheel.schedule(self.connect_timeout, asyncio.current_task().cancel)
+        try:
+            upstream = await self.connect(remote)
+        except (OSError, asyncio.CancelledError):
+            return
+        finally:
+            if self.wheel is not None:
+                self.wheel.cancel(timer)
+            self.connecting[remote] -= 1
+        queue = self.idle.setdefault(remote, collections.deque())
+        if len(queue) >= self.max_size:
+            upstream.close()
+            return
+        queue.append((time.monotonic(), upstream))
+
+    async def maintain(self):
+        """Фоновое обслуживание: выкидываем мёртвые и старые, доливаем до минимума"""
+        while True:
+            await asyncio.sleep(self.check_interval)
+            now = time.monotonic()
+            for remote, queue in list(self.idle.items()):
+                alive = collections.deque()
+                for since, upstream in queue:
+                    if upstream.transport is None or upstream.transport.is_closing():
+                        self.dead += 1
+                    elif now - since > self.idle_timeout:
+                        self.evicted += 1
+                        upstream.close()
+                    else:
+                        alive.append((since, upstream))
+                self.idle[remote] = alive
+                if now - self.last_used.get(remote, 0) <= self.idle_timeout:
+                    self.refill(remote)
+                elif not alive and not self.connecting[remote]:
+                    # Адресом давно не пользуются - забываем его
+                    del self.idle[remote]
+                    self.last_used.pop(remote, None)
+
+
+class ProxyError(Exception):
+    """Ошибка рукопожатия; reply - что ответить клиенту перед закрытием"""
+
+    def __init__(self, reply):
+        super().__init__(reply)
+        self.reply = reply
+
+
+def socks_reply(code):
+    # BND.ADDR клиенты не используют, отвечаем 0.0.0.0:0
+    return bytes((SOCKS_VERSION, code, 0, 1, 0, 0, 0, 0, 0, 0))
+
+
+def parse_socks_greeting(buf):
+    """VER NMETHODS METHODS; возвращает длину приветствия или None"""
+    if len(buf) < 2 or len(buf) < 2 + buf[1]:
+        return None
+    if SOCKS_NO_AUTH not in buf[2:2 + buf[1]]:
+        raise ProxyError(bytes((SOCKS_VERSION, 0xFF)))
+    return 2 + buf[1]
+
+
+def parse_socks_request(buf):
+    """VER CMD RSV ATYP DST.ADDR DST.PORT; возвращает (длина, хост, порт) или None"""
+    if len(buf) < 5:
+        return None
+    if buf[0] != SOCKS_VERSION:
+        raise ProxyError(socks_reply(0x01))
+    if buf[1] != SOCKS_CMD_CONNECT:
+        raise ProxyError(socks_reply(0x07))
+    atyp = buf[3]
+    if atyp == 0x01:
+        end = 4 + 4
+    elif atyp == 0x03:
+        # Имя резолвит сам релей (удалённый DNS, как socks5h)
+        end = 5 + buf[4]
+    elif atyp == 0x04:
+        end = 4 + 16
+    else:
+        raise ProxyError(socks_reply(0x08))
+    if len(buf) < end + 2:
+        return None
+    if atyp == 0x01:
+        host = socket.inet_ntop(socket.AF_INET, bytes(buf[4:end]))
+    elif atyp == 0x04:
+        host = socket.inet_ntop(socket.AF_INET6, bytes(buf[4:end]))
+    else:
+        try:
+            host = decode_host(bytes(buf[5:end]))
+        except UnicodeError:
+            raise ProxyError(socks_reply(0x01))
+    port = buf[end] << 8 | buf[end + 1]
+    return end + 2, host, port
+
+
+def parse_http_connect(buf):
+    """CONNECT host:port HTTP/1.1 и заголовки; возвращает (длина, хост, порт) или None"""
+    end = buf.find(b'\r\n\r\n')
+    if end < 0:
+        if len(buf) > HTTP_MAX_HEADER:
+            raise ProxyError(b'HTTP/1.1 431 Request Header Fields Too Large\r\n\r\n')
+        return None
+    request_line = bytes(buf[:buf.find(b'\r\n')]).decode('latin-1')
+    try:
+        method, authority, _ = request_line.split(' ', 2)
+        host, _, port = authority.rpartition(':')
+        port = int(port)
+    except ValueError:
+        raise ProxyError(b'HTTP/1.1 400 Bad Request\r\n\r\n')
+    if method != 'CONNECT' or not host:
+        raise ProxyError(b'HTTP/1.1 405 Method Not Allowed\r\n\r\n')
+    return end + 4, host.strip('[]'), port
+
+
+def connect_error_reply(kind, exc):
+    if kind == 'http':
+        return b'HTTP/1.1 502 Bad Gateway\r\n\r\n'
+    if isinstance(exc, ConnectionRefusedError):
+        return socks_reply(0x05)
+    if isinstance(exc, (socket.gaierror, TimeoutError)):
+        return socks_reply(0x04)
+    return socks_reply(0x01)
+
+
+def encode_host(host):
+    """Имя для вышестоящего прокси: ASCII как есть (метки .b32.i2p длиннее
+    63 символов idna не пропускает), иначе punycode; UnicodeError - если
+    имя не кодируется"""
+    try:
+        return host.encode('ascii')
+    except UnicodeEncodeError:
+        return host.encode('idna')
+
+
+def decode_host(name):
+    try:
+        return name.decode('ascii')
+    except UnicodeDecodeError:
+        return name.decode('idna')
+
+
+def socks_client_request(host, port):
+    """Приветствие и CONNECT одним пакетом: Tor понимает такой конвейер"""
+    name = encode_host(host)
+    if len(name) > 255:
+        raise ValueError(f"имя длиннее 255 байт: {host[:64]}...")
+    return (bytes((SOCKS_VERSION, 1, SOCKS_NO_AUTH, SOCKS_VERSION, SOCKS_CMD_CONNECT, 0, 3,
+                   len(name))) + name + port.to_bytes(2, 'big'))
+
+
+def parse_socks_client_reply(buf):
+    """Ответ SOCKS5 сервера на socks_client_request; длина или None"""
+    if len(buf) < 2:
+        return None
+    if buf[1] != SOCKS_NO_AUTH:
+        raise ProxyError(bytes(buf[:2]))
+    if len(buf) < 7:
+        return None
+    if buf[3] != 0x00:
+        raise ProxyError(bytes(buf[2:4]))
+    atyp = buf[5]
+    end = 2 + {0x01: 4 + 4, 0x03: 5 + buf[6], 0x04: 4 + 16}.get(atyp, 0) + 2
+    if end == 4:
+        raise ProxyError(bytes(buf[2:6]))
+    return end if len(buf) >= end else None
+
+
+def http_connect_request(host, port):
+    name = encode_host(host).decode('ascii')
+    authority = f'[{name}]:{port}' if ':' in name else f'{name}:{port}'
+    return f'CONNECT {authority} HTTP/1.1\r\nHost: {authority}\r\n\r\n'.encode('ascii')
+
+
+def parse_http_connect_reply(buf):
+    end = buf.find(b'\r\n\r\n')
+    if end < 0:
+        if len(buf) > HTTP_MAX_HEADER:
+            raise ProxyError(bytes(buf[:64]))
+        return None
+    status = bytes(buf[:buf.find(b'\r\n')]).split(b' ', 2)
+    if len(status) < 2 or status[1] != b'200':
+        raise ProxyError(bytes(buf[:buf.find(b'\r\n')]))
+    return end + 4
+
+
+class Router:
+    """Куда отправить соединение: direct, tor или i2p по имени назначения.
+
+    Правила - суффиксы доменов ("example.com" совпадает и с "www.example.com",
+    "*" - маршрут по умолчанию). Они собраны в дерево по меткам с конца
+    имени, поэтому поиск занимает O(число меток) при любом числе правил,
+    а готовые решения кэшируются в LRU.
+    """
+
+    def __init__(self, rules_text='', cache_size=ROUTE_CACHE):
+        self.root = {}
+        self.default = 'direct'
+        self.rules = 0
+        self.counts = collections.Counter()
+        # Правила из файла дополняют и перекрывают встроенные
+        self.load(DEFAULT_RULES)
+        self.load(rules_text)
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self.match)
+
+    @classmethod
+    def from_file(cls, path, cache_size=ROUTE_CACHE):
+        with open(path, encoding='utf-8') as f:
+            return cls(f.read(), cache_size)
+
+    def load(self, text):
+        for number, line in enumerate(text.splitlines(), 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                pattern, route = line.split()
+            except ValueError:
+                raise ValueError(f"строка {number}: ожидается 'домен маршрут': {line!r}")
+            if route not in ROUTES:
+                raise ValueError(f"строка {number}: неизвестный маршрут {route!r}")
+            self.add(pattern, route)
+
+    def add(self, pattern, route):
+        if pattern == '*':
+            self.default = route
+            return
+        node = self.root
+        for label in reversed(pattern.strip('.').lower().split('.')):
+            node = node.setdefault(label, {})
+        node[None] = route
+        self.rules += 1
+
+    def match(self, host):
+        """Самый длинный совпавший суффикс, иначе маршрут по умолчанию"""
+        route = self.default
+        node = self.root
+        for label in reversed(host.rstrip('.').lower().split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            route = node.get(None, route)
+        return route
+
+    def route(self, host):
+        route = self.lookup(host)
+        self.counts[route] += 1
+        return route
+
+    def stats(self):
+        info = self.lookup.cache_info()
+        stats = {f'route_{route}': self.counts[route] for route in ROUTES}
+        stats.update(rules=self.rules, cache_hits=info.hits, cache_misses=info.misses)
+        return stats
+
+
+class ClientProtocol(RelayProtocol):
+    """Сторона клиента: рукопожатие SOCKS5/HTTP CONNECT, затем туннель.
+
+    Первые байты решают, кто пришёл: 0x05 - SOCKS5, "CONNECT " - HTTP прокси,
+    всё остальное уходит на фиксированный --remote, как раньше.
+    Рукопожатие разбирается в buffer_updated по мере прихода данных,
+    без потоков и без лишних обменов.
+    """
+
+    def __init__(self, relay):
+        super().__init__(relay.buffers)
+        self.relay = relay
+        self.kind = None
+        self.handshake = bytearray()
+        # Первый пакет клиента идёт через этап фрагментации ClientHello
+        self.first_flight = relay.fragmenter.enabled
+        self.hello_buffer = None
+        # Таймауты: одна запись в колесе на соединение, фаза решает какой
+        self.phase = 'handshake'
+        self.started = time.monotonic()
+        self.timer = None
+        self.connect_task = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.relay.metrics.opened(self)
+        self.set_timer(self.relay.handshake_timeout)
+
+    def first_reply(self):
+        self.relay.metrics.ttfb.observe(time.monotonic() - self.started)
+
+    def set_timer(self, delay):
+        wheel = self.relay.wheel
+        wheel.cancel(self.timer)
+        self.timer = wheel.schedule(delay, self.check_timeouts) if delay else None
+
+    def check_timeouts(self):
+        self.timer = None
+        if self.transport is None:
+            return
+        relay = self.relay
+        if self.phase == 'handshake':
+            self.reap('handshake')
+        elif self.phase == 'connect':
+            self.connect_task.cancel()
+            self.reap('connect')
+        else:
+            now = time.monotonic()
+            left = []
+            if relay.lifetime:
+                left.append(relay.lifetime - (now - self.started))
+                if left[-1] <= 0:
+                    return self.reap('lifetime')
+            if relay.idle_timeout:
+                active = max(self.last_active, self.peer.last_active)
+                left.append(relay.idle_timeout - (now - active))
+                if left[-1] <= 0:
+                    return self.reap('idle')
+            if left:
+                self.set_timer(min(left))
+
+    def reap(self, reason):
+        self.relay.wheel.reaped[reason] += 1
+        self.abort()
+
+    def relay_timeout(self):
+        limits = [limit for limit in (self.relay.idle_timeout, self.relay.lifetime) if limit]
+        return min(limits) if limits else 0
+
+    def connection_lost(self, exc):
+        self.relay.wheel.cancel(self.timer)
+        self.timer = None
+        if exc is not None:
+            self.relay.metrics.errors[error_class(exc)] += 1
+        self.relay.metrics.closed(self)
+        super().connection_lost(exc)
+
+    async def connect_upstream(self, remote, leftover):
+        metrics = self.relay.metrics
+        started = time.monotonic()
+        try:
+            # Фиксированный --remote не маршрутизируем: правила только для прокси
+            upstream, early = await self.relay.open_upstream(remote, self.kind != 'fixed')
+        except (OSError, ValueError) as exc:
+            # ValueError (в том числе UnicodeError) - имя не кодируется для прокси
+            metrics.errors[error_class(exc)] += 1
+            if self.transport is not None and self.kind in ('socks', 'http'):
+                self.transport.write(connect_error_reply(self.kind, exc))
+            self.close()
+            return
+        except asyncio.CancelledError:
+            # Истёк таймаут соединения с сервером
+            self.abort()
+            return
+        if self.transport is None:
+            upstream.close()
+            return
+        metrics.connect.observe(time.monotonic() - started)
+        upstream.peer = self
+        self.peer = upstream
+        self.phase = 'relay'
+        self.set_timer(self.relay_timeout())
+        if self.kind == 'socks':
+            self.transport.write(socks_reply(0x00))
+        elif self.kind == 'http':
+            self.transport.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+        if early:
+            upstream.received += len(early)
+            self.first_reply()
+            self.transport.write(early)
+        self.resume('connect')
+        if leftover:
+            # Клиент не дождался ответа и уже прислал данные туннеля
+            self.received += len(leftover)
+            self.receive(memoryview(leftover))
+
+    def buffer_updated(self, nbytes):
+        self.last_active = time.monotonic()
+        view = self.buffers.view[:nbytes]
+        if self.peer is None:
+            self.handshake += view
+            try:
+                self.advance_handshake()
+            except ProxyError as exc:
+                self.relay.metrics.errors['handshake'] += 1
+                self.transport.write(exc.reply)
+                self.close()
+        else:
+            self.received += nbytes
+            self.receive(view)
+
+    def advance_handshake(self):
+        buf = self.handshake
+        if self.kind is None:
+            if buf[0] == SOCKS_VERSION:
+                self.kind = 'socks-greeting'
+            elif buf[:8] == HTTP_CONNECT_PREFIX[:len(buf)]:
+                if len(buf) < len(HTTP_CONNECT_PREFIX):
+                    return
+                self.kind = 'http'
+            else:
+                self.kind = 'fixed'
+                self.start_upstream(self.relay.remote, 0)
+                return
+        if self.kind == 'socks-greeting':
+            consumed = parse_socks_greeting(buf)
+            if consumed is None:
+                return
+            del buf[:consumed]
+            self.kind = 'socks'
+            self.transport.write(bytes((SOCKS_VERSION, SOCKS_NO_AUTH)))
+            if not buf:
+                return
+        parser = parse_socks_request if self.kind == 'socks' else parse_http_connect
+        parsed = parser(buf)
+        if parsed is not None:
+            consumed, host, port = parsed
+            self.start_upstream((host, port), consumed)
+
+    def start_upstream(self, remote, consumed):
+        # Пока нет соединения с сервером, данные клиента ждут в ядре
+        self.pause('connect')
+        leftover = bytes(self.handshake[consumed:])
+        self.handshake = None
+        self.phase = 'connect'
+        self.set_timer(self.relay.connect_timeout)
+        self.connect_task = asyncio.ensure_future(self.connect_upstream(remote, leftover))
+
+    def receive(self, view):
+        if self.first_flight:
+            self.collect_hello(view)
+        else:
+            self.forward(view)
+
+    def collect_hello(self, view):
+        if self.hello_buffer is not None:
+            self.hello_buffer += view
+            view = memoryview(self.hello_buffer)
+        chunks = self.relay.fragmenter.split(view)
+        if chunks is None:
+            # ClientHello пришёл не целиком - это редкость, копируем
+            if self.hello_buffer is None:
+                self.hello_buffer = bytearray(view)
+            return
+        self.first_flight = False
+        self.hello_buffer = None
+        self.send_fragments(chunks)
+
+    def send_fragments(self, chunks):
+        delay = self.relay.fragmenter.delay
+        self.forward(chunks[0])
+        if len(chunks) == 1:
+            return
+        if not delay:
+            for chunk in chunks[1:]:
+                self.forward(chunk)
+            return
+        # До отправки последнего куска новые данные клиента не читаем
+        self.pause('fragment')
+        rest = [bytes(chunk) for chunk in chunks[1:]]
+        asyncio.get_running_loop().call_later(delay, self.send_delayed, rest)
+
+    def send_delayed(self, chunks):
+        if self.transport is None:
+            return
+        self.forward(chunks.pop(0))
+        if chunks:
+            asyncio.get_running_loop().call_later(
+                self.relay.fragmenter.delay, self.send_delayed, chunks)
+        else:
+            self.resume('fragment')
+
+    def eof_received(self):
+        if self.hello_buffer is not None:
+            # Клиент закрылся, не дослав ClientHello - отдаём что есть
+            self.first_flight = False
+            self.forward(self.hello_buffer)
+            self.hello_buffer = None
+        return super().eof_received()
+
+
+class Relay:
+    """Общее состояние asyncio-релея: буферы, пул соединений, настройки"""
+
+    def __init__(self, remote, pool_min=POOL_MIN, pool_max=POOL_MAX, pool_idle=POOL_IDLE,
+                 pool_report=0, fragmenter=None, router=None, tor=TOR_SOCKS, i2p=I2P_HTTP,
+                 buffers=None, connect_timeout=CONNECT_TIMEOUT,
+                 handshake_timeout=HANDSHAKE_TIMEOUT, idle_timeout=IDLE_TIMEOUT,
+                 lifetime=LIFETIME, metrics_port=0):
+        self.remote = remote
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.fragmenter = fragmenter or SniFragmenter()
+        self.buffers = buffers or BufferPool()
+        self.wheel = TimerWheel()
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.lifetime = lifetime
+        self.pool = UpstreamPool(self.buffers, pool_min, pool_max, pool_idle,
+                                 wheel=self.wheel, connect_timeout=connect_timeout)
+        self.pool_report = pool_report
+        self.router = router
+        # Маршрут -> (адрес прокси, запрос, разбор ответа)
+        self.chains = {
+            'tor': (tor, socks_client_request, parse_socks_client_reply),
+            'i2p': (i2p, http_connect_request, parse_http_connect_reply),
+        }
+
+    async def open_upstream(self, remote, routed=True):
+        """Соединение до remote по маршруту из правил (без routed - напрямую);
+        (протокол, ранние байты)"""
+        route = self.router.route(remote[0]) if self.router is not None and routed else 'direct'
+        if route == 'direct':
+            return await self.pool.acquire(remote), b''
+        proxy, request, parser = self.chains[route]
+        upstream = await self.pool.acquire(proxy)
+        try:
+            early = await upstream.chain_handshake(request(*remote), parser)
+        except BaseException:
+            upstream.close()
+            raise
+        return upstream, early
+
+    def stats(self):
+        stats = self.pool.stats()
+        stats.update(self.buffers.stats())
+        stats.update(self.wheel.stats())
+        if self.router is not None:
+            stats.update(self.router.stats())
+        return stats
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.pool_report)
+            stats = self.stats()
+            print("Пул: " + ' '.join(f"{key}={value}" for key, value in stats.items()))
+
+    async def handle_metrics(self, reader, writer):
+        """GET /metrics - Prometheus, GET /metrics.json - снимок в JSON"""
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5.0)
+            path = request.split(b' ', 2)[1].decode('latin-1') if b' ' in request else ''
+            if path == '/metrics':
+                status, kind = '200 OK', 'text/plain; version=0.0.4'
+                body = self.metrics.prometheus(self.stats()).encode()
+            elif path == '/metrics.json':
+                snapshot = self.metrics.snapshot()
+                snapshot['relay'] = self.stats()
+                status, kind = '200 OK', 'application/json'
+                body = json.dumps(snapshot).encode()
+            else:
+                status, kind, body = '404 Not Found', 'text/plain', b'not found\n'
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {kind}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                         + body)
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, sock):
+        """Новый режим: один поток, все соединения мультиплексирует asyncio"""
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: ClientProtocol(self), sock=sock)
+        host, port = sock.getsockname()[:2]
+        print(f" ✅ Успешно подключено к {host}:{port}")
+        self.wheel.run()
+        tasks = [asyncio.ensure_future(self.pool.maintain())]
+        if self.pool.min_size:
+            # Прогреваем --remote и, если есть правила, соединения с Tor и I2P
+            warm = [self.remote]
+            if self.router is not None:
+                warm += [proxy for proxy, _, _ in self.chains.values()]
+            for remote in warm:
+                self.pool.last_used[remote] = time.monotonic()
+                self.pool.refill(remote)
+        if self.pool_report:
+            tasks.append(asyncio.ensure_future(self.report()))
+        metrics_server = None
+        if self.metrics_port:
+            metrics_server = await asyncio.start_server(self.handle_metrics, host, self.metrics_port)
+            print(f"Метрики: http://{host}:{self.metrics_port}/metrics")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
+
+
+def parse_address(value):
+    host, _, port = value.rpartition(':')
+    return host, int(port)
+
+def run_worker(args, reuse_port=False, index=0):
+    """Один процесс релея со своим циклом accept; index - номер воркера"""
+    server = make_listener(args.host, args.port, args.backlog, reuse_port)
+    fragmenter = SniFragmenter(args.fragment, args.fragment_delay)
+    if args.mode == 'threaded':
+        serve_threaded(server, args.remote, SPLICE_AVAILABLE and not args.no_splice, fragmenter)
+    else:
+        router = Router.from_file(args.rules) if args.rules else None
+        buffers = BufferPool(BUFFER_SIZE, args.mem_limit << 20,
+                             args.high_water << 10, args.low_water << 10)
+        relay = Relay(args.remote, args.pool_min, args.pool_max, args.pool_idle,
+                      args.pool_report, fragmenter, router, args.tor, args.i2p, buffers,
+                      args.connect_timeout, args.handshake_timeout, args.idle_timeout,
+                      args.lifetime, args.metrics_port + index if args.metrics_port else 0)
+        asyncio.run(relay.serve(server))
+
+def supervise(args):
+    """Родитель: держит args.workers процессов на одном порту, упавшие перезапускает"""
+    children = {}
+    started = {}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            # Останавливает воркеров только родитель
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(args, reuse_port=True, index=index)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+        started[index] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for index in range(args.workers):
+        spawn(index)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print(f"Запущено воркеров: {args.workers}")
+
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        restarts += 1
+        print(f"Воркер {index} (pid {pid}) завершился с кодом "
+              f"{os.waitstatus_to_exitcode(status)}, перезапускаем (всего {restarts})")
+        # Не крутимся в цикле, если воркер падает сразу после старта
+        if time.monotonic() - started[index] < 1.0:
+            time.sleep(1.0)
+        if not stopping:
+            spawn(index)
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный релей для обхода DPI")
+    parser.add_argument('--host', default=LOCAL_HOST)
+    parser.add_argument('--port', type=int, default=LOCAL_PORT)
+    parser.add_argument('--remote', type=parse_address, default=(REMOTE_HOST, REMOTE_PORT),
+                        help="куда отправлять клиентов, которые пришли не через SOCKS5/CONNECT")
+    parser.add_argument('--mode', choices=('asyncio', 'threaded'), default='asyncio',
+                        help="asyncio - один цикл событий, SOCKS5/CONNECT; "
+                             "threaded - поток на соединение, только --remote")
+    parser.add_argument('--no-splice', action='store_true',
+                        help="threaded: копировать через recv_into вместо os.splice")
+    parser.add_argument('--pool-min', type=int, default=POOL_MIN,
+                        help="asyncio: сколько соединений с сервером держать открытыми заранее")
+    parser.add_argument('--pool-max', type=int, default=POOL_MAX)
+    parser.add_argument('--pool-idle', type=float, default=POOL_IDLE,
+                        help="секунд простоя до закрытия соединения из пула")
+    parser.add_argument('--pool-report', type=float, default=0,
+                        help="раз в сколько секунд печатать попадания/промахи пула")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="число процессов на одном порту (SO_REUSEPORT)")
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG,
+                        help="очередь ещё не принятых соединений")
+    parser.add_argument('--fragment', choices=FRAGMENT_STRATEGIES, default='none',
+                        help="как резать TLS ClientHello, чтобы спрятать SNI от DPI")
+    parser.add_argument('--fragment-delay', type=float, default=0.0,
+                        help="пауза между кусками ClientHello, секунды")
+    parser.add_argument('--rules', help="файл правил маршрутизации: 'домен direct|tor|i2p'; "
+                                        "без него всё идёт напрямую; --remote - всегда напрямую")
+    parser.add_argument('--tor', type=parse_address, default=TOR_SOCKS,
+                        help="SOCKS5 порт Tor для маршрута tor")
+    parser.add_argument('--i2p', type=parse_address, default=I2P_HTTP,
+                        help="HTTP прокси I2P для маршрута i2p")
+    parser.add_argument('--mem-limit', type=int, default=MEMORY_LIMIT >> 20,
+                        help="МБ на буферы всех соединений; при исчерпании чтение встаёт")
+    parser.add_argument('--high-water', type=int, default=HIGH_WATER >> 10,
+                        help="КБ в очереди записи, после которых соседа перестаём читать")
+    parser.add_argument('--low-water', type=int, default=LOW_WATER >> 10,
+                        help="КБ в очереди записи, ниже которых соседа снова читаем")
+    parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT,
+                        help="секунд на соединение с сервером (0 - без ограничения)")
+    parser.add_argument('--handshake-timeout', type=float, default=HANDSHAKE_TIMEOUT,
+                        help="секунд на рукопожатие клиента")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="секунд тишины до закрытия соединения")
+    parser.add_argument('--lifetime', type=float, default=LIFETIME,
+                        help="максимальная длительность соединения, секунд")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="порт HTTP с метриками (/metrics, /metrics.json) на --host; "
+                             "у воркеров port+номер")
+    args = parser.parse_args()
+
+    try:
+        if args.workers > 1:
+            supervise(args)
+        else:
+            run_worker(args)
+    except KeyboardInterrupt:
+        pass
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,67 +1,1095 @@
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import os
+import random
+import re
 import requests
+import socket
+import socketserver
+import ssl
 import subprocess
+import sys
+import threading
 import time
+import urllib.parse
+
+TOR_SOCKS_PORT = 9050
+TOR_CONTROL_PORT = 9051
+BOOTSTRAP_DEADLINE = 120.0  # холодный старт без кэша бывает долгим
+BOOTSTRAP_POLL = 0.25       # период опроса управляющего порта
+LOG_TAIL = 200              # строк лога Tor в памяти
+# Пул Tor: порты base, base+1, ...; у каждого процесса свой каталог данных
+POOL_BASE_PORT = 9060
+POOL_DATA_ROOT = os.path.expanduser('~/.tor_pool')
+POOL_MODES = ('instances', 'ports')
+# Замер цепочек: куда ходим и какая задержка считается медленной
+CIRCUIT_TARGET = 'http://check.torproject.org/'
+CIRCUIT_THRESHOLD = 1.5   # секунд от запроса до первого байта ответа
+CIRCUIT_CANDIDATES = 4    # цепочек проверяем за раз
+CIRCUIT_KEEP = 3          # сколько лучших замеров помнить
+NEWNYM_WAIT = 10.0        # Tor принимает NEWNYM не чаще раза в 10 секунд
+# Проверка IP: адрес сервиса (можно локальную заглушку) и сколько помнить ответ
+IP_CHECK_URL = 'https://api.ipify.org'
+IP_CACHE_TTL = 60.0
+# Надзор за процессом tor
+PROBE_INTERVAL = 5.0      # период проверки SOCKS порта
+PROBE_TIMEOUT = 2.0
+PROBE_FAILURES = 2        # подряд неудачных проверок до перезапуска
+BACKOFF_BASE = 1.0        # пауза перед перезапуском, удваивается при каждом подряд
+BACKOFF_MAX = 60.0
+STABLE_UPTIME = 60.0      # проработал столько - пауза снова с BACKOFF_BASE
+# "Bootstrapped 45% (requesting_descriptors): Asking for relay descriptors"
+# в старых версиях без тега: "Bootstrapped 80%: Connecting to the Tor network"
+BOOTSTRAP_RE = re.compile(r'Bootstrapped (\d+)%(?: \(([\w-]+)\))?: (.*)')
+# PROGRESS=100 TAG=done SUMMARY="Done"
+BOOTSTRAP_PHASE_RE = re.compile(r'PROGRESS=(\d+) TAG=(\S+) SUMMARY="([^"]*)"')
+
+# Заглушка Tor для офлайн проверок (--stub)
+STUB_BOOTSTRAP = 2.0          # секунд от старта до 100%
+STUB_LATENCY = (0.05, 2.5)    # RTT цепочки выбирается случайно из этого диапазона
+STUB_NEWNYM_WAIT = 0.1        # заглушке не нужны 10 секунд между NEWNYM
+STUB_PHASES = (
+    (0, 'starting', "Starting"),
+    (5, 'conn', "Connecting to a relay"),
+    (14, 'handshake', "Handshaking with a relay"),
+    (50, 'loading_descriptors', "Loading relay descriptors"),
+    (75, 'enough_dirinfo', "Loaded enough directory info to build circuits"),
+    (90, 'ap_handshake_done', "Handshake finished with a relay to build circuits"),
+    (100, 'done', "Done"),
+)
+
+
+class TorControlError(Exception):
+    pass
+
+
+class TorControl:
+    """Минимальный клиент управляющего порта Tor (текстовый протокол control-spec)"""
+
+    def __init__(self, host='127.0.0.1', port=TOR_CONTROL_PORT, password='', timeout=5.0):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.file = self.sock.makefile('rb')
+        try:
+            self.authenticate(password)
+        except BaseException:
+            self.close()
+            raise
+
+    def command(self, line):
+        """Отправить команду, вернуть строки ответа без кода; не 2xx - исключение"""
+        self.sock.sendall(line.encode() + b'\r\n')
+        lines = []
+        while True:
+            raw = self.file.readline()
+            if not raw:
+                raise TorControlError("управляющий порт закрыл соединение")
+            reply = raw.decode(errors='replace').rstrip('\r\n')
+            code, separator, text = reply[:3], reply[3:4], reply[4:]
+            if separator == '+':
+                # Многострочное значение до строки "."
+                while (raw := self.file.readline()) and raw.rstrip(b'\r\n') != b'.':
+                    text += '\n' + raw.decode(errors='replace').rstrip('\r\n')
+            lines.append(text)
+            if separator == ' ':
+                break
+        if not code.startswith('2'):
+            raise TorControlError(f"{code} {lines[-1]}")
+        return lines
+
+    def authenticate(self, password):
+        methods, cookie_file = '', None
+        for line in self.command('PROTOCOLINFO 1'):
+            if line.startswith('AUTH '):
+                match = re.search(r'METHODS=(\S+)', line)
+                methods = match[1] if match else ''
+                match = re.search(r'COOKIEFILE="((?:[^"\\]|\\.)*)"', line)
+                cookie_file = match[1] if match else None
+        if password:
+            self.command('AUTHENTICATE "%s"' % password.replace('\\', '\\\\').replace('"', '\\"'))
+        elif 'COOKIE' in methods.split(',') and cookie_file:
+            with open(cookie_file, 'rb') as f:
+                self.command('AUTHENTICATE ' + f.read().hex())
+        else:
+            self.command('AUTHENTICATE')
+
+    def getinfo(self, key):
+        for line in self.command('GETINFO ' + key):
+            name, _, value = line.partition('=')
+            if name == key:
+                return value
+        raise TorControlError(f"нет ответа на GETINFO {key}")
+
+    def bootstrap_phase(self):
+        """(процент, тег, описание) из status/bootstrap-phase"""
+        match = BOOTSTRAP_PHASE_RE.search(self.getinfo('status/bootstrap-phase'))
+        if match is None:
+            raise TorControlError("не разобрали status/bootstrap-phase")
+        return int(match[1]), match[2], match[3]
+
+    def signal(self, name):
+        self.command('SIGNAL ' + name)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class Bootstrap:
+    """Фазы загрузки Tor: (процент, тег, описание, секунд от старта)"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = []
+        self.finished = threading.Event()
+
+    def update(self, percent, tag, summary):
+        if self.phases and self.phases[-1][0] >= percent:
+            return
+        self.phases.append((percent, tag, summary, time.monotonic() - self.started))
+        if percent == 100:
+            self.finished.set()
+
+    @property
+    def done(self):
+        return bool(self.phases) and self.phases[-1][0] == 100
+
+    def wait(self, timeout):
+        self.finished.wait(timeout)
+        return self.done
+
+    def report(self):
+        previous = 0.0
+        for percent, tag, summary, elapsed in self.phases:
+            print(f"  {percent:>3}% {tag:<24} {elapsed:7.2f} с (+{elapsed - previous:.2f})  {summary}")
+            previous = elapsed
+
+
+class TorProcess:
+    """Процесс tor, чей stdout всё время читает отдельный поток.
+
+    Из лога берём прогресс загрузки; последние строки держим в кольцевом
+    буфере. Без постоянного чтения tor рано или поздно встанет на
+    переполненном pipe.
+    """
+
+    def __init__(self, command, tail_size=LOG_TAIL):
+        self.bootstrap = Bootstrap()
+        self.tail = collections.deque(maxlen=tail_size)
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        text=True, errors='replace')
+        self.reader = threading.Thread(target=self.read_log, daemon=True)
+        self.reader.start()
+
+    def read_log(self):
+        for line in self.process.stdout:
+            line = line.rstrip()
+            self.tail.append(line)
+            match = BOOTSTRAP_RE.search(line)
+            if match:
+                self.bootstrap.update(int(match[1]), match[2] or '', match[3])
+        # stdout закрыт - tor завершился, ждать больше нечего
+        self.bootstrap.finished.set()
+
+    def running(self):
+        return self.process.poll() is None
+
+    def stop(self, timeout=5.0):
+        if self.running():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+
+def tor_command(socks_port=TOR_SOCKS_PORT, control_port=None, data_dir=None, extra_ports=(),
+                torrc=None):
+    command = ['tor', '--SocksPort', str(socks_port), '--Log', 'notice stdout']
+    if torrc:
+        command += ['-f', torrc]
+    for port in extra_ports:
+        # "+" добавляет порт к списку вместо замены
+        command += ['+SocksPort', str(port)]
+    if control_port:
+        command += ['--ControlPort', str(control_port), '--CookieAuthentication', '1']
+    if data_dir:
+        command += ['--DataDirectory', data_dir]
+    return command
+
+def tor_running():
+    # -x: только процесс с именем ровно "tor", а не всё, где встречается "tor"
+    try:
+        return subprocess.run(['pgrep', '-x', 'tor'], capture_output=True).returncode == 0
+    except OSError:
+        return False
+
+def poll_bootstrap(bootstrap, port=TOR_CONTROL_PORT, password='', deadline=BOOTSTRAP_DEADLINE,
+                   interval=BOOTSTRAP_POLL):
+    """Опрашиваем status/bootstrap-phase, пока не 100% или не истёк deadline"""
+    stop = time.monotonic() + deadline
+    control = None
+    try:
+        while time.monotonic() < stop:
+            try:
+                if control is None:
+                    control = TorControl(port=port, password=password)
+                bootstrap.update(*control.bootstrap_phase())
+            except (OSError, TorControlError):
+                # Порт ещё не открыт или соединение оборвалось - пробуем снова
+                if control is not None:
+                    control.close()
+                    control = None
+            if bootstrap.done:
+                return True
+            time.sleep(interval)
+        return False
+    finally:
+        if control is not None:
+            control.close()
 
 # Автоматически запускаем Tor если он не запущен
-def start_tor():
+def start_tor(deadline=BOOTSTRAP_DEADLINE, control_port=None, password=''):
+    """Ждём не фиксированное время, а "Bootstrapped 100%" в логе или на управляющем порту"""
     print("Проверяем Tor...")
-    
-    # Проверяем, запущен ли Tor
-    try:
-        result = subprocess.run(['pgrep', 'tor'], capture_output=True, text=True)
-        if result.returncode == 0:
-            print("✓ Tor уже запущен")
+
+    if tor_running():
+        print("✓ Tor уже запущен")
+        if not control_port:
             return True
-    except:
-        pass
-    
+        # Чужой tor: его лог нам не виден, спрашиваем управляющий порт
+        bootstrap = Bootstrap()
+        ready = poll_bootstrap(bootstrap, control_port, password, deadline)
+        bootstrap.report()
+        if not ready:
+            print(f"✗ Tor не закончил загрузку за {deadline:g} с")
+        return ready
+
     # Запускаем Tor
     print("Запускаем Tor...")
     try:
-        # Фоновый запуск Tor
-        subprocess.Popen(['tor'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        print("Tor запускается...")
-        time.sleep(10)  # Ждем запуска
-        print("✓ Tor запущен")
-        return True
-    except Exception as e:
+        tor = TorProcess(tor_command(TOR_SOCKS_PORT, control_port))
+    except OSError as e:
         print(f"✗ Ошибка запуска Tor: {e}")
         print("Установите Tor: sudo apt install tor")
         return False
 
-# Проверяем IP
-def check_ip():
-    # Сначала без Tor
+    print("Tor запускается...")
+    ready = tor.bootstrap.wait(deadline)
+    tor.bootstrap.report()
+    if ready:
+        print(f"✓ Tor запущен за {tor.bootstrap.phases[-1][3]:.1f} с")
+    else:
+        report_failure(tor, deadline)
+    return ready
+
+def report_failure(tor, deadline):
+    if not tor.running():
+        print(f"✗ Tor завершился с кодом {tor.process.returncode}, последние строки лога:")
+        for line in list(tor.tail)[-10:]:
+            print("  " + line)
+    else:
+        print(f"✗ Tor не закончил загрузку за {deadline:g} с")
+
+
+class TorPool:
+    """Несколько независимых выходов в Tor для параллельной работы.
+
+    instances - N процессов tor, у каждого свой SocksPort и DataDirectory;
+    ports - один процесс с N портами: потоки с разных SocksPort Tor
+    никогда не сажает на одну цепочку. Запрос получает порт с наименьшим
+    числом незавершённых запросов, а уникальные логин/пароль SOCKS
+    (IsolateSOCKSAuth, включено по умолчанию) изолируют и запросы на одном порту.
+    """
+
+    def __init__(self, size, base_port=POOL_BASE_PORT, mode='instances', data_root=POOL_DATA_ROOT):
+        self.ports = [base_port + index for index in range(size)]
+        self.mode = mode
+        self.data_root = data_root
+        self.processes = []
+        self.lock = threading.Lock()
+        self.outstanding = [0] * size
+        self.served = [0] * size
+        self.leases = itertools.count(1)
+
+    def start(self, deadline=BOOTSTRAP_DEADLINE):
+        """Запустить процессы и дождаться загрузки всех; False, если хоть один не готов"""
+        if self.mode == 'ports':
+            commands = [tor_command(self.ports[0], data_dir=self.data_dir(0),
+                                    extra_ports=self.ports[1:], torrc=os.devnull)]
+        else:
+            # Без системного torrc: его ControlPort и прочее у N процессов столкнутся
+            commands = [tor_command(port, data_dir=self.data_dir(index), torrc=os.devnull)
+                        for index, port in enumerate(self.ports)]
+        for command in commands:
+            self.processes.append(TorProcess(command))
+        # Процессы грузятся параллельно, общий срок на всех
+        stop = time.monotonic() + deadline
+        ready = True
+        for index, tor in enumerate(self.processes):
+            if tor.bootstrap.wait(max(0.0, stop - time.monotonic())):
+                print(f"✓ Tor #{index} готов за {tor.bootstrap.phases[-1][3]:.1f} с")
+            else:
+                report_failure(tor, deadline)
+                ready = False
+        return ready
+
+    def data_dir(self, index):
+        path = os.path.join(self.data_root, str(index))
+        # Tor откажется работать с каталогом, доступным другим пользователям
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        return path
+
+    def stop(self):
+        for tor in self.processes:
+            tor.stop()
+        self.processes = []
+
+    def acquire(self):
+        """Индекс порта с наименьшим числом незавершённых запросов"""
+        with self.lock:
+            index = min(range(len(self.ports)),
+                        key=lambda i: (self.outstanding[i], self.served[i]))
+            self.outstanding[index] += 1
+            self.served[index] += 1
+            return index
+
+    def release(self, index):
+        with self.lock:
+            self.outstanding[index] -= 1
+
+    @contextlib.contextmanager
+    def proxy(self):
+        """Прокси для requests на время одного задания; цепочки не делятся с другими"""
+        index = self.acquire()
+        lease = next(self.leases)
+        url = f'socks5h://lease{lease}:x@127.0.0.1:{self.ports[index]}'
+        try:
+            yield {'http': url, 'https': url}
+        finally:
+            self.release(index)
+
+    def stats(self):
+        return [{'port': port, 'outstanding': self.outstanding[index], 'served': self.served[index]}
+                for index, port in enumerate(self.ports)]
+
+
+def pool_fetch(pool, url, count, workers, timeout=30):
+    """count запросов к url через пул из workers потоков; сколько успели и за сколько"""
+    def fetch(_):
+        with pool.proxy() as proxies:
+            try:
+                return len(requests.get(url, proxies=proxies, timeout=timeout).content)
+            except requests.RequestException:
+                return None
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        sizes = list(executor.map(fetch, range(count)))
+    elapsed = time.monotonic() - start
+    done = [size for size in sizes if size is not None]
+    print(f"Пул: {len(done)}/{count} запросов за {elapsed:.1f} с "
+          f"({len(done) / elapsed:.2f} запр/с, {sum(done) / 1024 / elapsed:.1f} КБ/с)")
+    for member in pool.stats():
+        print(f"  порт {member['port']}: запросов {member['served']}")
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("SOCKS: соединение закрыто")
+        data += chunk
+    return data
+
+def socks5_connect(sock, host, port, username='', password=''):
+    """SOCKS5 CONNECT по имени (DNS делает Tor); логин - ключ изоляции цепочки"""
+    method = 0x02 if username else 0x00
+    sock.sendall(bytes((0x05, 0x01, method)))
+    if recv_exact(sock, 2) != bytes((0x05, method)):
+        raise ConnectionError("SOCKS: метод аутентификации не принят")
+    if username:
+        user, secret = username.encode(), (password or 'x').encode()
+        sock.sendall(bytes((0x01, len(user))) + user + bytes((len(secret),)) + secret)
+        if recv_exact(sock, 2)[1] != 0x00:
+            raise ConnectionError("SOCKS: логин отклонён")
+    name = host.encode('idna')
+    sock.sendall(bytes((0x05, 0x01, 0x00, 0x03, len(name))) + name + port.to_bytes(2, 'big'))
+    reply = recv_exact(sock, 4)
+    if reply[1] != 0x00:
+        raise ConnectionError(f"SOCKS: отказ {reply[1]:#04x}")
+    # Адрес из ответа не нужен, но его надо дочитать
+    if reply[3] == 0x01:
+        recv_exact(sock, 4 + 2)
+    elif reply[3] == 0x04:
+        recv_exact(sock, 16 + 2)
+    else:
+        recv_exact(sock, recv_exact(sock, 1)[0] + 2)
+
+
+class CircuitSample:
+    """Один замер цепочки; время в секундах, скорость в байтах в секунду"""
+    __slots__ = ('username', 'connect', 'rtt', 'size', 'throughput', 'measured')
+
+    def __init__(self, username, connect, rtt, size, throughput):
+        self.username = username
+        self.connect = connect          # SOCKS CONNECT: построение цепочки и потока
+        self.rtt = rtt                  # запрос -> первый байт ответа
+        self.size = size
+        self.throughput = throughput
+        self.measured = time.monotonic()
+
+    def __str__(self):
+        return (f"{self.username}: соединение {self.connect * 1000:.0f} мс, "
+                f"RTT {self.rtt * 1000:.0f} мс, {self.throughput / 1024:.1f} КБ/с")
+
+
+def measure_circuit(url, socks_port=TOR_SOCKS_PORT, username='', timeout=30.0):
+    """Один GET к url через SOCKS порт Tor с замером каждой фазы"""
+    parts = urllib.parse.urlsplit(url)
+    secure = parts.scheme == 'https'
+    host = parts.hostname
+    port = parts.port or (443 if secure else 80)
+    path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+    request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode()
+
+    start = time.monotonic()
+    sock = socket.create_connection(('127.0.0.1', socks_port), timeout)
     try:
-        normal_ip = requests.get('https://api.ipify.org', timeout=5).text
-        print(f"Мой реальный IP: {normal_ip}")
-    except:
+        socks5_connect(sock, host, port, username)
+        connected = time.monotonic()
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+        sent = time.monotonic()
+        sock.sendall(request)
+        size = len(sock.recv(65536))
+        first_byte = time.monotonic()
+        while chunk := sock.recv(65536):
+            size += len(chunk)
+        end = time.monotonic()
+    finally:
+        sock.close()
+    return CircuitSample(username, connected - start, first_byte - sent, size,
+                         size / max(end - sent, 1e-6))
+
+
+class CircuitSelector:
+    """Держим сессию на быстрой цепочке Tor.
+
+    При IsolateSOCKSAuth (по умолчанию) каждый логин SOCKS получает свою
+    цепочку и живёт на ней до MaxCircuitDirtiness. Проверяем несколько
+    логинов сразу, запоминаем лучшие замеры и отдаём прокси с самым быстрым.
+    Если даже лучший медленнее порога - NEWNYM и новые цепочки.
+    """
+
+    def __init__(self, url=CIRCUIT_TARGET, socks_port=TOR_SOCKS_PORT, control_port=None,
+                 password='', threshold=CIRCUIT_THRESHOLD, candidates=CIRCUIT_CANDIDATES,
+                 keep=CIRCUIT_KEEP, newnym_wait=NEWNYM_WAIT):
+        self.url = url
+        self.socks_port = socks_port
+        self.control_port = control_port
+        self.password = password
+        self.threshold = threshold
+        self.candidates = candidates
+        self.keep = keep
+        self.newnym_wait = newnym_wait
+        self.best = []          # лучшие замеры по возрастанию RTT
+        self.generation = 0     # сколько раз просили NEWNYM
+        self.probes = itertools.count(1)
+
+    def measure(self, username):
+        try:
+            return measure_circuit(self.url, self.socks_port, username)
+        except (OSError, ssl.SSLError):
+            return None
+
+    def probe(self):
+        """Замерить текущих лучших и candidates новых цепочек параллельно"""
+        usernames = [sample.username for sample in self.best]
+        usernames += [f'circuit{self.generation}-{next(self.probes)}'
+                      for _ in range(self.candidates)]
+        with concurrent.futures.ThreadPoolExecutor(len(usernames)) as executor:
+            samples = [sample for sample in executor.map(self.measure, usernames) if sample]
+        self.best = sorted(samples, key=lambda sample: sample.rtt)[:self.keep]
+        return samples
+
+    def newnym(self):
+        """Новые цепочки для всех новых потоков; старые замеры больше не про них"""
+        control = TorControl(port=self.control_port, password=self.password)
+        try:
+            control.signal('NEWNYM')
+        finally:
+            control.close()
+        self.generation += 1
+        self.best = []
+        time.sleep(self.newnym_wait)
+
+    def select(self, attempts=3):
+        """Лучший замер не хуже порога, иначе лучший из найденных (или None)"""
+        for attempt in range(attempts):
+            self.probe()
+            if self.best and self.best[0].rtt <= self.threshold:
+                break
+            if attempt == attempts - 1 or not self.control_port:
+                break
+            try:
+                self.newnym()
+            except (OSError, TorControlError) as e:
+                print(f"NEWNYM не удался: {e}")
+                break
+        return self.best[0] if self.best else None
+
+    def proxies(self):
+        """Прокси для requests на самой быстрой известной цепочке"""
+        if not self.best:
+            return None
+        url = f'socks5h://{self.best[0].username}:x@127.0.0.1:{self.socks_port}'
+        return {'http': url, 'https': url}
+
+
+def run_circuits(args, socks_port=TOR_SOCKS_PORT, newnym_wait=NEWNYM_WAIT):
+    selector = CircuitSelector(args.circuits, socks_port, args.control_port,
+                               args.control_password, args.threshold, args.candidates,
+                               newnym_wait=newnym_wait)
+    print(f"Ищем цепочку с RTT до {args.threshold * 1000:.0f} мс ({args.circuits})...")
+    best = selector.select(args.attempts)
+    if best is None:
+        print("✗ Ни одна цепочка не ответила")
+        return
+    for sample in selector.best:
+        print("  " + str(sample))
+    verdict = "✓" if best.rtt <= args.threshold else "✗ быстрее порога не нашли, лучшая:"
+    print(f"{verdict} {best} (NEWNYM: {selector.generation})")
+
+class IpChecker:
+    """Реальный IP и IP через Tor.
+
+    Оба запроса идут параллельно, каждый через свою requests.Session:
+    соединение (и TLS через Tor) живёт между проверками. Ответ помним
+    ttl секунд, поэтому частые проверки здоровья сеть вообще не трогают.
+    """
+
+    def __init__(self, url=IP_CHECK_URL, socks_port=TOR_SOCKS_PORT, ttl=IP_CACHE_TTL):
+        self.url = url
+        self.ttl = ttl
+        tor = requests.Session()
+        tor.proxies = {
+            'http': f'socks5://localhost:{socks_port}',
+            'https': f'socks5://localhost:{socks_port}'
+        }
+        # имя -> (сессия, таймаут)
+        self.sessions = {'direct': (requests.Session(), 5), 'tor': (tor, 10)}
+        self.cache = {}     # имя -> (время ответа, IP)
+        self.locks = {name: threading.Lock() for name in self.sessions}
+        self.executor = concurrent.futures.ThreadPoolExecutor(len(self.sessions))
+
+    def lookup(self, name):
+        # Одновременные проверки одного пути ждут один запрос, а не шлют свои
+        with self.locks[name]:
+            cached = self.cache.get(name)
+            if cached and time.monotonic() - cached[0] < self.ttl:
+                return cached[1]
+            session, timeout = self.sessions[name]
+            response = session.get(self.url, timeout=timeout)
+            response.raise_for_status()
+            ip = response.text.strip()
+            self.cache[name] = (time.monotonic(), ip)
+            return ip
+
+    def check(self):
+        """{'direct': IP или исключение, 'tor': IP или исключение}"""
+        futures = {name: self.executor.submit(self.lookup, name) for name in self.sessions}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except requests.RequestException as e:
+                results[name] = e
+        return results
+
+    def close(self):
+        self.executor.shutdown()
+        for session, _ in self.sessions.values():
+            session.close()
+
+
+# Проверяем IP
+def check_ip(checker=None):
+    if checker is None:
+        # Свой проверяльщик - свои сессии и потоки, их и закрываем
+        checker = IpChecker()
+        try:
+            return check_ip(checker)
+        finally:
+            checker.close()
+    results = checker.check()
+
+    if isinstance(results['direct'], Exception):
         print("Не могу получить реальный IP")
+    else:
+        print(f"Мой реальный IP: {results['direct']}")
 
-    # Через Tor
-    proxies = {
-        'http': 'socks5://localhost:9050',
-        'https': 'socks5://localhost:9050'
-    }
-    
-    try:
-        tor_ip = requests.get('https://api.ipify.org', proxies=proxies, timeout=10).text
-        print(f"Мой IP через Tor: {tor_ip}")
-    except Exception as e:
-        print(f"Не могу подключиться через Tor: {e}")
+    if isinstance(results['tor'], Exception):
+        print(f"Не могу подключиться через Tor: {results['tor']}")
         print("Убедитесь что Tor установлен: sudo apt install tor")
+    else:
+        print(f"Мой IP через Tor: {results['tor']}")
+
+def probe_socks(port=TOR_SOCKS_PORT, timeout=PROBE_TIMEOUT):
+    """Дешёвая проверка: SOCKS порт принимает соединение и отвечает на приветствие.
+    Возвращает задержку в секундах или бросает OSError"""
+    start = time.monotonic()
+    with socket.create_connection(('127.0.0.1', port), timeout) as sock:
+        sock.sendall(b'\x05\x01\x00')
+        if recv_exact(sock, 2) != b'\x05\x00':
+            raise ConnectionError("SOCKS: неожиданный ответ на приветствие")
+    return time.monotonic() - start
+
+
+class TorSupervisor:
+    """Владеет процессом tor: проверяет SOCKS порт и перезапускает упавший или зависший.
+
+    Перезапуск после PROBE_FAILURES неудачных проверок подряд или сразу,
+    если процесс завершился. Пауза перед перезапуском растёт вдвое до
+    BACKOFF_MAX и сбрасывается, когда tor проработал STABLE_UPTIME.
+    """
+
+    def __init__(self, socks_port=TOR_SOCKS_PORT, control_port=None, data_dir=None,
+                 interval=PROBE_INTERVAL, failures=PROBE_FAILURES, deadline=BOOTSTRAP_DEADLINE,
+                 command=None):
+        self.socks_port = socks_port
+        self.control_port = control_port
+        self.data_dir = data_dir
+        # Своя команда вместо tor, например заглушка из stub_command()
+        self.command = command or tor_command(socks_port, control_port, data_dir)
+        self.interval = interval
+        self.failures = failures
+        self.deadline = deadline
+        self.tor = None
+        self.started = None
+        self.restarts = 0
+        self.backoff = 0.0
+        self.failed_probes = 0
+        self.probe_latency = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def launch(self):
+        """Запустить tor и дождаться загрузки; False - не загрузился или нас
+        остановили. Ошибка запуска идёт тем же путём, что и падение tor"""
+        self.started = time.monotonic()
+        self.failed_probes = 0
+        self.probe_latency = None
+        try:
+            self.tor = TorProcess(self.command)
+        except OSError as e:
+            self.tor = None
+            print(f"✗ Не удалось запустить tor: {e}")
+            return False
+        # Ждём кусками, чтобы stop() не висел до конца срока загрузки
+        bootstrap = self.tor.bootstrap
+        end = self.started + self.deadline
+        while not bootstrap.finished.is_set() and not self.stopping.is_set():
+            left = end - time.monotonic()
+            if left <= 0:
+                break
+            bootstrap.finished.wait(min(0.2, left))
+        if bootstrap.done:
+            return True
+        if not self.stopping.is_set():
+            report_failure(self.tor, self.deadline)
+        return False
+
+    def start(self):
+        ready = self.launch()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+        return ready
+
+    def watch(self):
+        while not self.stopping.wait(self.interval):
+            if self.tor is None:
+                self.restart()
+                continue
+            if not self.tor.running():
+                print(f"✗ Tor завершился с кодом {self.tor.process.returncode}")
+                self.restart()
+                continue
+            try:
+                self.probe_latency = probe_socks(self.socks_port)
+                self.failed_probes = 0
+            except OSError as e:
+                self.failed_probes += 1
+                print(f"✗ SOCKS порт {self.socks_port} не отвечает ({self.failed_probes}): {e}")
+                if self.failed_probes >= self.failures:
+                    self.restart()
+
+    def restart(self):
+        if time.monotonic() - self.started >= STABLE_UPTIME:
+            self.backoff = 0.0
+        self.backoff = min(BACKOFF_MAX, self.backoff * 2 or BACKOFF_BASE)
+        if self.tor is not None:
+            self.tor.stop()
+        print(f"Перезапускаем Tor через {self.backoff:g} с...")
+        if self.stopping.wait(self.backoff):
+            return
+        self.restarts += 1
+        if self.launch():
+            print(f"✓ Tor перезапущен за {self.tor.bootstrap.phases[-1][3]:.1f} с "
+                  f"(перезапусков: {self.restarts})")
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.tor is not None:
+            self.tor.stop()
+
+    def stats(self):
+        return {
+            'pid': self.tor.process.pid if self.tor else None,
+            'uptime': round(time.monotonic() - self.started, 1) if self.started else 0.0,
+            'restarts': self.restarts,
+            'bootstrapped': bool(self.tor and self.tor.bootstrap.done),
+            'probe_ms': round(self.probe_latency * 1000, 1) if self.probe_latency is not None else None,
+            'failed_probes': self.failed_probes,
+        }
+
+
+def run_supervisor(args, socks_port=TOR_SOCKS_PORT, command=None):
+    if command is None and tor_running():
+        print("✗ Tor уже запущен: надзор работает только со своим процессом")
+        return
+    supervisor = TorSupervisor(socks_port, args.control_port, interval=args.probe_interval,
+                               deadline=args.deadline, command=command)
+    print("Запускаем Tor под надзором...")
+    try:
+        if supervisor.start():
+            print(f"✓ Tor запущен за {supervisor.tor.bootstrap.phases[-1][3]:.1f} с, Ctrl+C - остановить")
+        while True:
+            time.sleep(args.status_interval)
+            print("Tor: " + ' '.join(f"{key}={value}" for key, value in supervisor.stats().items()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+
+def run_pool(args):
+    pool = TorPool(args.pool, args.pool_port, args.pool_mode, args.pool_data)
+    print(f"Запускаем пул Tor: {args.pool} ({args.pool_mode}), порты "
+          f"{pool.ports[0]}-{pool.ports[-1]}...")
+    try:
+        if not pool.start(args.deadline):
+            print("\nНе удалось запустить пул Tor")
+            return
+        if args.pool_fetch:
+            pool_fetch(pool, args.pool_fetch, args.requests, args.pool)
+            return
+        print("Пул работает, Ctrl+C - остановить")
+        while all(tor.running() for tor in pool.processes):
+            time.sleep(1)
+        print("Один из процессов tor завершился, останавливаем пул")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+
+
+class StubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, stub, port, handler):
+        self.stub = stub
+        super().__init__(('127.0.0.1', port), handler)
+
+
+class StubSocksHandler(socketserver.BaseRequestHandler):
+    """SOCKS5 заглушки: приветствие, логин/пароль, CONNECT. Дальше вместо
+    выхода в сеть сама отвечает на HTTP запрос IP выхода цепочки с RTT цепочки"""
+
+    def handle(self):
+        stub = self.server.stub
+        sock = self.request
+        try:
+            version, count = recv_exact(sock, 2)
+            methods = recv_exact(sock, count)
+            if version != 0x05:
+                return
+            username = ''
+            if 0x02 in methods:
+                sock.sendall(b'\x05\x02')
+                recv_exact(sock, 1)
+                username = recv_exact(sock, recv_exact(sock, 1)[0]).decode(errors='replace')
+                recv_exact(sock, recv_exact(sock, 1)[0])
+                sock.sendall(b'\x01\x00')
+            elif 0x00 in methods:
+                sock.sendall(b'\x05\x00')
+            else:
+                sock.sendall(b'\x05\xff')
+                return
+            _, command, _, kind = recv_exact(sock, 4)
+            if kind == 0x03:
+                recv_exact(sock, recv_exact(sock, 1)[0] + 2)
+            else:
+                recv_exact(sock, (4 if kind == 0x01 else 16) + 2)
+            if command != 0x01:
+                code = 0x07     # команда не поддерживается
+            elif stub.phase()[0] < 100:
+                code = 0x01     # цепочек ещё нет
+            else:
+                code = 0x00
+            if code:
+                sock.sendall(bytes((0x05, code, 0x00, 0x01)) + bytes(6))
+                return
+            rtt, exit_ip = stub.circuit(username)
+            time.sleep(rtt)     # построение потока
+            sock.sendall(b'\x05\x00\x00\x01' + bytes(6))
+            request = b''
+            while b'\r\n\r\n' not in request and len(request) < 8192:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    return
+                request += chunk
+            time.sleep(rtt)
+            body = exit_ip.encode() + b'\n'
+            sock.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nConnection: close\r\n'
+                         b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        except OSError:
+            pass
+
+
+class StubControlHandler(socketserver.StreamRequestHandler):
+    """Управляющий порт заглушки: PROTOCOLINFO, AUTHENTICATE, GETINFO
+    status/bootstrap-phase, SIGNAL NEWNYM, QUIT"""
+
+    def reply(self, *lines):
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode())
+
+    def handle(self):
+        stub = self.server.stub
+        authenticated = False
+        try:
+            for raw in self.rfile:
+                command, _, argument = raw.decode(errors='replace').strip().partition(' ')
+                command = command.upper()
+                if command == 'PROTOCOLINFO':
+                    methods = 'HASHEDPASSWORD' if stub.password else 'NULL'
+                    self.reply('250-PROTOCOLINFO 1', f'250-AUTH METHODS={methods}',
+                               '250-VERSION Tor="0.4.8.0-stub"', '250 OK')
+                elif command == 'AUTHENTICATE':
+                    password = re.sub(r'\\(.)', r'\1', argument[1:-1]) if argument.startswith('"') else ''
+                    if stub.password and password != stub.password:
+                        self.reply('515 Authentication failed: Password did not match')
+                        return
+                    authenticated = True
+                    self.reply('250 OK')
+                elif command == 'QUIT':
+                    self.reply('250 closing connection')
+                    return
+                elif not authenticated:
+                    self.reply('514 Authentication required.')
+                    return
+                elif command == 'GETINFO':
+                    values = {'status/bootstrap-phase': 'NOTICE BOOTSTRAP PROGRESS=%d TAG=%s SUMMARY="%s"'
+                                                        % stub.phase(),
+                              'version': '0.4.8.0-stub'}
+                    unknown = [key for key in argument.split() if key not in values]
+                    if unknown:
+                        self.reply(f'552 Unrecognized key "{unknown[0]}"')
+                    else:
+                        self.reply(*[f'250-{key}={values[key]}' for key in argument.split()], '250 OK')
+                elif command == 'SIGNAL':
+                    if argument.strip().upper() != 'NEWNYM':
+                        self.reply(f'552 Unrecognized signal code "{argument.strip()}"')
+                    else:
+                        stub.newnym()
+                        self.reply('250 OK')
+                else:
+                    self.reply(f'510 Unrecognized command "{command}"')
+        except OSError:
+            pass
+
+
+class TorStub:
+    """Локальная заглушка Tor для проверок без сети: SOCKS5 и управляющий порт.
+
+    Загрузка проходит STUB_PHASES за bootstrap секунд. Каждый логин SOCKS
+    (как при IsolateSOCKSAuth) получает свою цепочку со случайным RTT из
+    latency и своим IP выхода; NEWNYM начинает новое поколение цепочек.
+    Ответ на любой HTTP запрос через SOCKS - IP выхода цепочки.
+    """
+
+    def __init__(self, socks_port=0, control_port=0, password='', bootstrap=STUB_BOOTSTRAP,
+                 latency=STUB_LATENCY, seed=None):
+        self.password = password
+        self.bootstrap = bootstrap
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.circuits = {}      # (поколение, логин) -> (RTT, IP выхода)
+        self.started = time.monotonic()
+        self.servers = [StubServer(self, socks_port, StubSocksHandler),
+                        StubServer(self, control_port, StubControlHandler)]
+
+    def start(self):
+        """Запустить серверы; возвращает (SOCKS порт, управляющий порт)"""
+        self.started = time.monotonic()
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return tuple(server.server_address[1] for server in self.servers)
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def phase(self):
+        """(процент, тег, описание) текущей фазы загрузки"""
+        if self.bootstrap <= 0:
+            return STUB_PHASES[-1]
+        elapsed = time.monotonic() - self.started
+        return STUB_PHASES[min(len(STUB_PHASES) - 1,
+                               int(elapsed / self.bootstrap * (len(STUB_PHASES) - 1)))]
+
+    def circuit(self, username):
+        with self.lock:
+            key = (self.generation, username)
+            if key not in self.circuits:
+                number = len(self.circuits) + 1
+                self.circuits[key] = (self.random.uniform(*self.latency),
+                                      f'10.{self.generation % 256}.{number >> 8 & 255}.{number & 255}')
+            return self.circuits[key]
+
+    def newnym(self):
+        with self.lock:
+            self.generation += 1
+
+    def serve(self):
+        """Работать как процесс tor: печатать фазы загрузки в формате его лога и ждать"""
+        self.start()
+        printed = -1
+        while True:
+            percent, tag, summary = self.phase()
+            if percent != printed:
+                print(f"[notice] Bootstrapped {percent}% ({tag}): {summary}", flush=True)
+                printed = percent
+            time.sleep(0.05 if percent < 100 else 3600)
+
+
+def stub_command(socks_port, control_port):
+    """Команда для TorSupervisor: заглушка в отдельном процессе вместо tor"""
+    return [sys.executable, os.path.abspath(__file__), '--stub-serve', str(socks_port), str(control_port)]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def run_stub(args):
+    """Офлайн: загрузка по управляющему порту, проверка SOCKS и выбор цепочки
+    (или надзор с --supervise) против TorStub вместо настоящего Tor"""
+    if args.supervise:
+        socks_port = free_port()
+        print(f"Заглушка Tor под надзором: SOCKS {socks_port}")
+        run_supervisor(args, socks_port, stub_command(socks_port, free_port()))
+        return
+    stub = TorStub(password=args.control_password)
+    socks_port, control_port = stub.start()
+    print(f"Заглушка Tor: SOCKS {socks_port}, управляющий порт {control_port}")
+    try:
+        bootstrap = Bootstrap()
+        ready = poll_bootstrap(bootstrap, control_port, args.control_password, args.deadline)
+        bootstrap.report()
+        if not ready:
+            print(f"✗ Заглушка не закончила загрузку за {args.deadline:g} с")
+            return
+        print(f"✓ SOCKS порт отвечает за {probe_socks(socks_port) * 1000:.1f} мс\n")
+        args.circuits = args.circuits or CIRCUIT_TARGET
+        args.control_port = control_port
+        run_circuits(args, socks_port, STUB_NEWNYM_WAIT)
+    finally:
+        stub.stop()
 
 # Основной скрипт
 def main():
+    parser = argparse.ArgumentParser(description="Запуск Tor и проверка IP")
+    parser.add_argument('--deadline', type=float, default=BOOTSTRAP_DEADLINE,
+                        help="сколько секунд ждать Bootstrapped 100%%")
+    parser.add_argument('--control-port', type=int, default=None,
+                        help="управляющий порт Tor; нужен, чтобы дождаться уже запущенного tor")
+    parser.add_argument('--control-password', default='',
+                        help="пароль управляющего порта (HashedControlPassword)")
+    parser.add_argument('--supervise', action='store_true',
+                        help="держать tor запущенным: проверки SOCKS порта и перезапуск")
+    parser.add_argument('--probe-interval', type=float, default=PROBE_INTERVAL,
+                        help="период проверки SOCKS порта под надзором, секунды")
+    parser.add_argument('--status-interval', type=float, default=30.0,
+                        help="раз в сколько секунд печатать состояние под надзором")
+    parser.add_argument('--pool', type=int, default=0,
+                        help="запустить пул из N выходов Tor вместо одного")
+    parser.add_argument('--pool-mode', choices=POOL_MODES, default='instances',
+                        help="instances - N процессов tor; ports - N SocksPort одного процесса")
+    parser.add_argument('--pool-port', type=int, default=POOL_BASE_PORT,
+                        help="первый SocksPort пула, дальше подряд")
+    parser.add_argument('--pool-data', default=POOL_DATA_ROOT,
+                        help="каталог для DataDirectory процессов пула")
+    parser.add_argument('--pool-fetch', metavar='URL',
+                        help="прогнать запросы к URL через пул и показать скорость")
+    parser.add_argument('--requests', type=int, default=20,
+                        help="сколько запросов в --pool-fetch")
+    parser.add_argument('--ip-url', default=IP_CHECK_URL,
+                        help="сервис, который возвращает IP текстом (можно локальную заглушку)")
+    parser.add_argument('--ip-ttl', type=float, default=IP_CACHE_TTL,
+                        help="сколько секунд помнить результат проверки IP")
+    parser.add_argument('--circuits', nargs='?', const=CIRCUIT_TARGET, metavar='URL',
+                        help="замерить цепочки через SOCKS порт и выбрать быструю")
+    parser.add_argument('--threshold', type=float, default=CIRCUIT_THRESHOLD,
+                        help="RTT в секундах, выше которого просим NEWNYM")
+    parser.add_argument('--candidates', type=int, default=CIRCUIT_CANDIDATES,
+                        help="сколько цепочек замерять за раз")
+    parser.add_argument('--attempts', type=int, default=3,
+                        help="сколько раз пробовать NEWNYM, пока не найдём быструю")
+    parser.add_argument('--stub', action='store_true',
+                        help="офлайн: загрузка, SOCKS и цепочки (или --supervise) против локальной заглушки Tor")
+    parser.add_argument('--stub-serve', nargs=2, type=int, metavar=('SOCKS', 'CONTROL'),
+                        help="поднять заглушку Tor на этих портах и печатать лог загрузки, как tor")
+    args = parser.parse_args()
+
+    if args.stub_serve:
+        try:
+            TorStub(*args.stub_serve, password=args.control_password).serve()
+        except KeyboardInterrupt:
+            pass
+        return
+    if args.stub:
+        run_stub(args)
+        return
+    if args.supervise:
+        run_supervisor(args)
+        return
+    if args.pool:
+        run_pool(args)
+        return
+
     print("=== Простой Tor скрипт ===\n")
-    
+
     # Запускаем Tor
-    if start_tor():
+    if start_tor(args.deadline, args.control_port, args.control_password):
         # Проверяем IP
         print("\nПроверяем IP-адреса...")
-        check_ip()
+        check_ip(IpChecker(args.ip_url, TOR_SOCKS_PORT, args.ip_ttl))
+        if args.circuits:
+            print()
+            run_circuits(args)
     else:
         print("\nНе удалось запустить Tor")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
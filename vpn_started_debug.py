@@ -1,12 +1,806 @@
+import argparse
+import asyncio
+import base64
+import collections
+import json
 import os
+import re
+import shutil
+import socket
+import socketserver
+import statistics
 import subprocess
+import tempfile
+import threading
 import time
+import tracemalloc
 import requests
 import random
 
+VPNGATE_URL = 'https://www.vpngate.net/api/iphone/'
+CHUNK_SIZE = 65536
+# HostName,IP,Score,Ping,Speed,CountryLong,CountryShort,NumVpnSessions,Uptime,
+# TotalUsers,TotalTraffic,LogType,Operator,Message,OpenVPN_ConfigData_Base64
+VPNGATE_FIELDS = 15
+# Кэш списка серверов на диске: при свежем кэше сеть не нужна вовсе
+CACHE_PATH = os.path.expanduser('~/.cache/yufus-security/vpngate.json')
+CACHE_TTL = 3600.0
+# Запуск OpenVPN: ждём строку готовности в логе, а не фиксированное время
+OPENVPN_BINARY = 'openvpn'
+OPENVPN_DEADLINE = 30.0
+OPENVPN_LOG_TAIL = 200
+# Фазы подключения по строкам лога, в порядке появления
+OPENVPN_PHASES = (
+    ('link', re.compile(r'TCP connection established|link remote:')),
+    ('tls', re.compile(r'Peer Connection Initiated')),
+    ('config', re.compile(r'PUSH: Received control message')),
+    ('tun', re.compile(r'TUN/TAP device (\S+) opened')),
+    ('ready', re.compile(r'Initialization Sequence Completed')),
+)
+OPENVPN_FATAL = re.compile(r'AUTH_FAILED|Exiting due to fatal error|Options error|'
+                           r'Cannot resolve host address|Cannot open TUN/TAP')
+# Параллельные попытки (happy eyeballs) и переключение на запасной туннель
+HAPPY_ATTEMPTS = 3        # сколько лучших серверов пробовать
+HAPPY_STAGGER = 0.5       # пауза между запусками попыток, секунды
+HAPPY_SPARES = 1          # сколько поднятых туннелей держать в запасе
+HEALTH_TARGET = ('1.1.1.1', 443)
+HEALTH_INTERVAL = 0.5
+HEALTH_TIMEOUT = 0.5
+HEALTH_FAILURES = 2       # неудачных проверок подряд до переключения
+# Признаки того, что туннель уже не работает, хотя процесс жив
+OPENVPN_LOST = re.compile(r'Inactivity timeout|Connection reset, restarting|'
+                          r'SIGUSR1\[soft,[^\]]*\] received, process restarting')
+# Замер туннеля: задержка, установка соединения и скорость до своего сервера
+BENCH_STORE = os.path.expanduser('~/.cache/yufus-security/vpn_bench.json')
+BENCH_KEEP = 10           # сколько последних замеров хранить на сервер
+BENCH_SECONDS = 3.0       # длительность замера скорости в каждую сторону
+BENCH_SAMPLES = 20        # замеров RTT и установки соединения
+BENCH_TIMEOUT = 5.0
+BENCH_CHUNK = b'\0' * 65536
+# Ранжирование: сколько лучших по score проверять, таймаут и параллельность проверки
+RANK_TOP_K = 20
+PROBE_TIMEOUT = 1.0
+PROBE_CONCURRENCY = 50
+# Веса в итоговой оценке: измеренный RTT, скорость и score из списка
+RANK_WEIGHTS = {'rtt': 0.6, 'speed': 0.25, 'score': 0.15}
+
+
+class VpnServer:
+    """Одна строка списка VPN Gate. Конфиг хранится как base64 и
+    раскодируется только для выбранного сервера"""
+    __slots__ = ('host', 'ip', 'score', 'ping', 'speed', 'country', 'country_code', 'config_b64',
+                 'rtt')
+
+    def __init__(self, host, ip, score, ping, speed, country, country_code, config_b64):
+        self.host = host
+        self.ip = ip
+        self.score = score
+        self.ping = ping          # мс, как его видит VPN Gate
+        self.speed = speed        # бит/с
+        self.country = country
+        self.country_code = country_code
+        self.config_b64 = config_b64
+        self.rtt = None           # измеренное время TCP connect, секунды
+
+    def config(self):
+        return base64.b64decode(self.config_b64).decode('utf-8')
+
+    def remote(self):
+        """(адрес, порт, протокол) из строк remote/proto конфига"""
+        host, port, proto = self.ip, 1194, 'udp'
+        for line in self.config().splitlines():
+            words = line.split()
+            if len(words) >= 2 and words[0] == 'proto':
+                proto = words[1]
+            elif len(words) >= 2 and words[0] == 'remote':
+                host = words[1]
+                if len(words) >= 3:
+                    port = int(words[2])
+                if len(words) >= 4:
+                    proto = words[3]
+        return host, port, proto.replace('-client', '')
+
+    def save_config(self, path='vpn_config.ovpn'):
+        """Пишем конфиг, только если он отличается от уже лежащего на диске"""
+        config = self.config()
+        try:
+            with open(path) as f:
+                if f.read() == config:
+                    return False
+        except OSError:
+            pass
+        with open(path, 'w') as f:
+            f.write(config)
+        return True
+
+    def to_row(self):
+        return [self.host, self.ip, self.score, self.ping, self.speed, self.country,
+                self.country_code, self.config_b64.decode('ascii')]
+
+    @classmethod
+    def from_row(cls, row):
+        *fields, config_b64 = row
+        return cls(*fields, config_b64.encode('ascii'))
+
+    def __str__(self):
+        rtt = f" rtt={self.rtt * 1000:.0f} мс" if self.rtt is not None else ""
+        return (f"{self.host} ({self.ip}, {self.country}) score={self.score} "
+                f"ping={self.ping} мс speed={self.speed / 1e6:.1f} Мбит/с{rtt}")
+
+
+def parse_server_line(line):
+    """VpnServer из строки CSV (bytes) или None для заголовков и битых строк"""
+    if not line or line[:1] in (b'*', b'#'):
+        return None
+    fields = line.rstrip(b'\r').split(b',', VPNGATE_FIELDS - 1)
+    if len(fields) != VPNGATE_FIELDS:
+        return None
+    try:
+        return VpnServer(fields[0].decode(), fields[1].decode(), int(fields[2]),
+                         int(fields[3] or 0), int(fields[4]), fields[5].decode(),
+                         fields[6].decode(), fields[14])
+    except ValueError:
+        return None
+
+def iter_servers(chunks):
+    """Разбираем CSV по мере прихода кусков, не держа весь ответ в памяти"""
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        # Последняя строка может быть не дочитана - ждём следующего куска
+        pending = lines.pop()
+        for line in lines:
+            server = parse_server_line(line)
+            if server is not None:
+                yield server
+    server = parse_server_line(pending)
+    if server is not None:
+        yield server
+
+
+class ServerCache:
+    """Разобранный список VPN Gate на диске с индексами по стране и score.
+
+    Рядом со списком храним время загрузки, ETag и Last-Modified: устаревший
+    кэш обновляется условным запросом, и на 304 список не качается заново.
+    Без сети работаем с тем, что есть, каким бы старым оно ни было.
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, url=VPNGATE_URL):
+        self.path = path
+        self.ttl = ttl
+        self.url = url
+        self.fetched = 0.0
+        self.etag = None
+        self.last_modified = None
+        self.set_servers([])
+
+    def set_servers(self, servers):
+        self.servers = sorted(servers, key=lambda server: server.score, reverse=True)
+        self.countries = {}
+        for server in self.servers:
+            self.countries.setdefault(server.country_code, []).append(server)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('url') != self.url:
+            return False
+        self.fetched = data['fetched']
+        self.etag = data.get('etag')
+        self.last_modified = data.get('last_modified')
+        self.set_servers([VpnServer.from_row(row) for row in data['servers']])
+        return True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = {
+            'url': self.url,
+            'fetched': self.fetched,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'servers': [server.to_row() for server in self.servers],
+        }
+        # Через временный файл: оборванная запись не испортит старый кэш
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def age(self):
+        return time.time() - self.fetched
+
+    def stale(self):
+        return not self.servers or self.age() >= self.ttl
+
+    def refresh(self, force=False):
+        """Обновить с сервера, если кэш устарел; True - список изменился"""
+        if not force and not self.stale():
+            return False
+        headers = {}
+        if self.servers and self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.servers and self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        with requests.get(self.url, headers=headers, timeout=10, stream=True) as response:
+            if response.status_code == 304:
+                self.fetched = time.time()
+                self.save()
+                return False
+            response.raise_for_status()
+            servers = list(iter_servers(response.iter_content(CHUNK_SIZE)))
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+        self.fetched = time.time()
+        self.set_servers(servers)
+        self.save()
+        return True
+
+    def update(self, force=False, offline=False):
+        """Загрузить кэш и при необходимости обновить; сеть упала - остаёмся на кэше"""
+        self.load()
+        if offline:
+            return self.servers
+        try:
+            if self.refresh(force):
+                print(f"Список серверов обновлён: {len(self.servers)}")
+            else:
+                print(f"Список серверов из кэша: {len(self.servers)}, "
+                      f"возраст {self.age() / 60:.0f} мин")
+        except requests.RequestException as e:
+            if not self.servers:
+                raise
+            print(f"Не удалось обновить список ({e}), используем кэш "
+                  f"возрастом {self.age() / 60:.0f} мин")
+        return self.servers
+
+    def by_country(self, code):
+        """Серверы страны по убыванию score"""
+        return self.countries.get(code.upper(), [])
+
+    def best(self, count=10):
+        return self.servers[:count]
+
+
+async def probe_server(server, semaphore, timeout=PROBE_TIMEOUT):
+    """RTT до OpenVPN порта сервера через TCP connect; None - не ответил, UDP
+    или битый конфиг"""
+    try:
+        host, port, proto = server.remote()
+    except ValueError:
+        return None
+    if proto != 'tcp':
+        return None
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        rtt = loop.time() - start
+        writer.close()
+        return rtt
+
+async def probe_servers(servers, timeout=PROBE_TIMEOUT, concurrency=PROBE_CONCURRENCY):
+    semaphore = asyncio.Semaphore(concurrency)
+    rtts = await asyncio.gather(*(probe_server(server, semaphore, timeout) for server in servers))
+    for server, rtt in zip(servers, rtts):
+        server.rtt = rtt
+
+def rank_servers(servers, top_k=RANK_TOP_K, timeout=PROBE_TIMEOUT, concurrency=PROBE_CONCURRENCY,
+                 measured=None):
+    """Проверяем top_k лучших по score и сортируем по оценке: меньше - лучше.
+
+    Каждая величина делится на лучшую среди ответивших, так что RTT,
+    скорость и score сравнимы между собой. Не ответившие идут в конец.
+    Скорость из своих замеров (measured, {хост: бит/с}) важнее заявленной.
+    """
+    measured = measured or {}
+    candidates = sorted(servers, key=lambda server: server.score, reverse=True)[:top_k]
+    asyncio.run(probe_servers(candidates, timeout, concurrency))
+    alive = [server for server in candidates if server.rtt is not None]
+    silent = [server for server in candidates if server.rtt is None]
+    if not alive:
+        return silent
+    best_rtt = max(min(server.rtt for server in alive), 1e-4)
+    speeds = {server.host: measured.get(server.host, server.speed) for server in alive}
+    best_speed = max(speeds.values()) or 1
+    best_score = max(server.score for server in alive) or 1
+
+    def cost(server):
+        return (RANK_WEIGHTS['rtt'] * server.rtt / best_rtt
+                + RANK_WEIGHTS['speed'] * best_speed / max(speeds[server.host], 1)
+                + RANK_WEIGHTS['score'] * best_score / max(server.score, 1))
+
+    return sorted(alive, key=cost) + silent
+
+
+class OpenVpnProcess:
+    """Процесс openvpn, чей вывод всё время читает отдельный поток.
+
+    Строки лога идут в кольцевой буфер и размечают фазы подключения;
+    ожидание заканчивается на "Initialization Sequence Completed",
+    фатальной ошибке или выходе процесса - что раньше.
+    """
+
+    def __init__(self, command, tail_size=OPENVPN_LOG_TAIL):
+        self.started = time.monotonic()
+        self.phases = []        # (фаза, секунд от запуска)
+        self.tail = collections.deque(maxlen=tail_size)
+        self.result = None      # 'ready', 'fatal' или 'exited'
+        self.error = None
+        self.device = None      # tun-устройство из лога
+        self.lost = threading.Event()
+        self.finished = threading.Event()
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        text=True, errors='replace')
+        self.reader = threading.Thread(target=self.read_log, daemon=True)
+        self.reader.start()
+
+    def read_log(self):
+        seen = set()
+        for line in self.process.stdout:
+            line = line.rstrip()
+            self.tail.append(line)
+            for name, pattern in OPENVPN_PHASES:
+                match = name not in seen and pattern.search(line)
+                if match:
+                    seen.add(name)
+                    self.phases.append((name, time.monotonic() - self.started))
+                    if name == 'tun':
+                        self.device = match[1]
+                    elif name == 'ready':
+                        self.finish('ready')
+            if OPENVPN_FATAL.search(line):
+                # Причина - первая фатальная строка, дальше идёт "Exiting due to..."
+                if self.error is None:
+                    self.error = line
+                self.finish('fatal')
+                self.lost.set()
+            elif OPENVPN_LOST.search(line):
+                self.lost.set()
+        self.finish('exited')
+        self.lost.set()
+
+    def finish(self, result):
+        if self.result is None:
+            self.result = result
+            self.finished.set()
+
+    def wait(self, timeout):
+        self.finished.wait(timeout)
+        return self.result == 'ready'
+
+    def running(self):
+        return self.process.poll() is None
+
+    def stop(self, timeout=5.0):
+        if self.running():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def report(self):
+        previous = 0.0
+        for name, elapsed in self.phases:
+            print(f"  {name:<8} {elapsed:7.2f} с (+{elapsed - previous:.2f})")
+            previous = elapsed
+
+
+def default_gateway():
+    """(шлюз, устройство) маршрута по умолчанию до подключения VPN"""
+    output = subprocess.run(['ip', 'route', 'show', 'default'], capture_output=True,
+                            text=True).stdout.split()
+    gateway = output[output.index('via') + 1] if 'via' in output else None
+    device = output[output.index('dev') + 1] if 'dev' in output else None
+    return gateway, device
+
+def tunnel_alive(device, target=HEALTH_TARGET, timeout=HEALTH_TIMEOUT):
+    """TCP connect к target строго через tun-устройство (SO_BINDTODEVICE, нужен root)"""
+    with socket.socket() as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, device.encode())
+        sock.settimeout(timeout)
+        try:
+            sock.connect(target)
+        except OSError:
+            return False
+    return True
+
+
+class TunnelAttempt:
+    """Один openvpn к одному серверу; маршруты он сам не трогает (--route-noexec)"""
+
+    def __init__(self, server, openvpn, config_dir):
+        self.server = server
+        self.config = os.path.join(config_dir, f'{server.host}.ovpn')
+        server.save_config(self.config)
+        self.host = server.remote()[0]
+        self.vpn = OpenVpnProcess([openvpn, '--config', self.config, '--route-noexec'])
+
+    def age(self):
+        return time.monotonic() - self.vpn.started
+
+    def ready(self):
+        """Поднялся и назвал tun-устройство: без него не на что вести маршруты"""
+        return self.vpn.result == 'ready' and self.vpn.device is not None
+
+    def usable(self):
+        return self.ready() and self.vpn.running() and not self.vpn.lost.is_set()
+
+
+class TunnelManager:
+    """Happy eyeballs для OpenVPN и быстрое переключение на запасной туннель.
+
+    Попытки к лучшим серверам запускаются с паузой stagger; первый
+    поднявшийся туннель становится основным, ещё spares поднятых остаются
+    в запасе, остальные гасятся. Все openvpn работают с --route-noexec:
+    трафик на свой сервер каждый ведёт мимо туннелей (маршрут /32 через
+    прежний шлюз), а маршруты 0.0.0.0/1 и 128.0.0.0/1 (как redirect-gateway
+    def1) ставим сами. Переключение - это замена двух маршрутов на уже
+    поднятый запасной туннель, без нового рукопожатия.
+    """
+
+    def __init__(self, servers, openvpn=OPENVPN_BINARY, attempts=HAPPY_ATTEMPTS,
+                 stagger=HAPPY_STAGGER, spares=HAPPY_SPARES, deadline=OPENVPN_DEADLINE,
+                 health_target=HEALTH_TARGET):
+        self.candidates = collections.deque(servers)
+        self.openvpn = openvpn
+        self.attempts = attempts
+        self.stagger = stagger
+        self.spares = spares
+        self.deadline = deadline
+        self.health_target = health_target
+        self.config_dir = tempfile.mkdtemp(prefix='vpn-happy-')
+        self.gateway = default_gateway()
+        self.active = None
+        self.standby = []       # поднятые запасные туннели
+        self.warming = []       # запасные, которые ещё подключаются
+        self.switches = 0
+        self.stopping = threading.Event()
+
+    def run_ip(self, *args):
+        subprocess.run(['ip', *args], check=False, capture_output=True)
+
+    def launch(self):
+        server = self.candidates.popleft()
+        attempt = TunnelAttempt(server, self.openvpn, self.config_dir)
+        gateway, device = self.gateway
+        if gateway:
+            self.run_ip('route', 'replace', f'{attempt.host}/32', 'via', gateway, 'dev', device)
+        print(f"  попытка: {server}")
+        return attempt
+
+    def discard(self, attempt):
+        attempt.vpn.stop()
+        if self.gateway[0]:
+            self.run_ip('route', 'del', f'{attempt.host}/32')
+
+    def race(self, count):
+        """Запускаем до count попыток с паузой stagger до первой поднявшейся.
+
+        Возвращает (поднявшиеся, ещё идущие) - идущие не гасим, из них
+        набирается запас."""
+        pending, ready = [], []
+        next_launch = time.monotonic()
+        stop = time.monotonic() + self.deadline
+        while not ready and time.monotonic() < stop and not self.stopping.is_set():
+            if count and self.candidates and time.monotonic() >= next_launch:
+                pending.append(self.launch())
+                count -= 1
+                next_launch = time.monotonic() + self.stagger
+            ready, pending = self.collect(pending)
+            if not pending and not (count and self.candidates):
+                break
+            time.sleep(0.05)
+        if not ready:
+            for attempt in pending:
+                self.discard(attempt)
+            pending = []
+        return ready, pending
+
+    def collect(self, attempts):
+        """Разобрать попытки на (поднявшиеся, ещё идущие); упавшие и просроченные гасим"""
+        ready, pending = [], []
+        for attempt in attempts:
+            if attempt.ready():
+                ready.append(attempt)
+            elif attempt.vpn.result is None and attempt.age() < self.deadline:
+                pending.append(attempt)
+            else:
+                if attempt.vpn.result == 'ready':
+                    print(f"  ✗ {attempt.server.host}: в логе нет TUN/TAP устройства")
+                self.discard(attempt)
+        return ready, pending
+
+    def promote(self, attempt):
+        device = attempt.vpn.device
+        for network in ('0.0.0.0/1', '128.0.0.0/1'):
+            self.run_ip('route', 'replace', network, 'dev', device)
+        self.active = attempt
+
+    def connect(self):
+        """Поднять основной туннель; False - ни одна попытка не удалась"""
+        print(f"Запускаем до {self.attempts} попыток с паузой {self.stagger:g} с...")
+        while self.candidates and not self.stopping.is_set():
+            ready, pending = self.race(self.attempts)
+            if ready:
+                winner = ready.pop(0)
+                self.promote(winner)
+                self.warming.extend(ready + pending)
+                self.replenish()
+                print(f"✓ Туннель {winner.vpn.device} через {winner.server.host} "
+                      f"за {winner.vpn.phases[-1][1]:.1f} с")
+                return True
+        return False
+
+    def prune_standby(self):
+        """Убрать из запаса умершие и перезапускающиеся туннели, погасив их"""
+        alive = []
+        for attempt in self.standby:
+            if attempt.usable():
+                alive.append(attempt)
+            else:
+                self.discard(attempt)
+        self.standby = alive
+
+    def replenish(self):
+        """Поднявшиеся попытки - в запас, лишние гасим, недостающие запускаем"""
+        ready, self.warming = self.collect(self.warming)
+        self.prune_standby()
+        for attempt in ready:
+            if len(self.standby) < self.spares:
+                self.standby.append(attempt)
+            else:
+                self.discard(attempt)
+        while len(self.standby) + len(self.warming) > self.spares and self.warming:
+            self.discard(self.warming.pop())
+        if len(self.standby) + len(self.warming) < self.spares and self.candidates:
+            self.warming.append(self.launch())
+
+    def failover(self):
+        """Основной туннель умер: переводим маршруты на запасной"""
+        start = time.monotonic()
+        dead = self.active
+        self.active = None
+        self.prune_standby()
+        if self.standby:
+            self.promote(self.standby.pop(0))
+            print(f"↪ Переключились на {self.active.server.host} ({self.active.vpn.device}) "
+                  f"за {(time.monotonic() - start) * 1000:.0f} мс")
+        else:
+            for attempt in self.warming:
+                self.discard(attempt)
+            self.warming = []
+            if not self.connect():
+                print("✗ Не осталось серверов для переключения")
+        self.discard(dead)
+        self.switches += 1
+
+    def monitor(self):
+        """Проверяем основной туннель; на смерть процесса реагируем сразу"""
+        failures = 0
+        while self.active is not None and not self.stopping.is_set():
+            active = self.active
+            if active.vpn.lost.wait(HEALTH_INTERVAL):
+                print(f"✗ Туннель через {active.server.host} потерян")
+                self.failover()
+                failures = 0
+            elif not tunnel_alive(active.vpn.device, self.health_target):
+                failures += 1
+                if failures >= HEALTH_FAILURES:
+                    print(f"✗ Туннель через {active.server.host} не пропускает трафик")
+                    self.failover()
+                    failures = 0
+            else:
+                failures = 0
+            if self.active is not None:
+                self.replenish()
+
+    def stop(self):
+        self.stopping.set()
+        for network in ('0.0.0.0/1', '128.0.0.0/1'):
+            self.run_ip('route', 'del', network)
+        for attempt in [self.active, *self.standby, *self.warming]:
+            if attempt is not None:
+                self.discard(attempt)
+        self.active = None
+        self.standby = []
+        self.warming = []
+        shutil.rmtree(self.config_dir, ignore_errors=True)
+
+
+class SinkHandler(socketserver.BaseRequestHandler):
+    """Первый байт - режим: E - эхо (RTT), U - принять всё до EOF и ответить
+    числом байт, D - отдавать данные, пока клиент не закроет соединение"""
+
+    def handle(self):
+        sock = self.request
+        try:
+            mode = sock.recv(1)
+            if mode == b'E':
+                while data := sock.recv(65536):
+                    sock.sendall(data)
+            elif mode == b'U':
+                total = 0
+                while data := sock.recv(262144):
+                    total += len(data)
+                sock.sendall(total.to_bytes(8, 'big'))
+            elif mode == b'D':
+                while True:
+                    sock.sendall(BENCH_CHUNK)
+        except OSError:
+            pass
+
+
+class BenchSink(socketserver.ThreadingTCPServer):
+    """Сервер для замеров: на своей машине снаружи (--bench-sink) или локально офлайн"""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        super().__init__(address, SinkHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def bench_connect(target, device=None, timeout=BENCH_TIMEOUT):
+    """Соединение с target; с device - строго через tun-устройство"""
+    family, kind, proto, _, address = socket.getaddrinfo(*target, type=socket.SOCK_STREAM)[0]
+    sock = socket.socket(family, kind, proto)
+    try:
+        if device:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, device.encode())
+        sock.settimeout(timeout)
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def percentiles(values):
+    """p50/p95/p99 в миллисекундах"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {f'p{q}': round(ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))] * 1000, 2)
+            for q in (50, 95, 99)}
+
+def bench_setup(target, device, samples):
+    times = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        with bench_connect(target, device):
+            times.append(time.perf_counter() - start)
+    return times
+
+def bench_rtt(target, device, samples, size=64):
+    times = []
+    payload = os.urandom(size)
+    with bench_connect(target, device) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(b'E')
+        for _ in range(samples):
+            start = time.perf_counter()
+            sock.sendall(payload)
+            received = 0
+            while received < size:
+                data = sock.recv(size - received)
+                if not data:
+                    raise ConnectionError("сервер закрыл соединение")
+                received += len(data)
+            times.append(time.perf_counter() - start)
+    return times
+
+def bench_upload(target, device, seconds):
+    """Бит/с от нас к серверу: считаем по числу байт, которое он подтвердил"""
+    with bench_connect(target, device) as sock:
+        sock.sendall(b'U')
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            sock.sendall(BENCH_CHUNK)
+        sock.shutdown(socket.SHUT_WR)
+        reply = b''
+        while len(reply) < 8:
+            data = sock.recv(8 - len(reply))
+            if not data:
+                raise ConnectionError("сервер не подтвердил приём")
+            reply += data
+        elapsed = time.perf_counter() - start
+    return int.from_bytes(reply, 'big') * 8 / elapsed
+
+def bench_download(target, device, seconds):
+    buffer = bytearray(262144)
+    total = 0
+    with bench_connect(target, device) as sock:
+        sock.sendall(b'D')
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            received = sock.recv_into(buffer)
+            if not received:
+                break
+            total += received
+        elapsed = time.perf_counter() - start
+    return total * 8 / elapsed
+
+def bench_tunnel(target, device=None, seconds=BENCH_SECONDS, samples=BENCH_SAMPLES):
+    """Полный замер до target; без device - по обычному маршруту"""
+    setup = bench_setup(target, device, samples)
+    rtt = bench_rtt(target, device, samples)
+    return {
+        'time': time.time(),
+        'target': f'{target[0]}:{target[1]}',
+        'device': device,
+        'setup_ms': percentiles(setup),
+        'rtt_ms': percentiles(rtt),
+        'upload_bps': round(bench_upload(target, device, seconds)),
+        'download_bps': round(bench_download(target, device, seconds)),
+    }
+
+def print_bench(result):
+    setup, rtt = result['setup_ms'], result['rtt_ms']
+    print(f"Замер до {result['target']} через {result['device'] or 'обычный маршрут'}:")
+    print(f"  соединение: p50 {setup['p50']} мс, p95 {setup['p95']} мс, p99 {setup['p99']} мс")
+    print(f"  RTT:        p50 {rtt['p50']} мс, p95 {rtt['p95']} мс, p99 {rtt['p99']} мс")
+    print(f"  отдача {result['upload_bps'] / 1e6:.1f} Мбит/с, "
+          f"приём {result['download_bps'] / 1e6:.1f} Мбит/с")
+
+
+class BenchStore:
+    """Последние замеры по каждому серверу VPN Gate; медиана скорости приёма
+    заменяет заявленную скорость при выборе сервера"""
+
+    def __init__(self, path=BENCH_STORE, keep=BENCH_KEEP):
+        self.path = path
+        self.keep = keep
+        self.results = {}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.results = json.load(f)
+        except (OSError, ValueError):
+            self.results = {}
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.results, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def add(self, host, result):
+        history = self.results.setdefault(host, [])
+        history.append(result)
+        del history[:-self.keep]
+        self.save()
+
+    def measured(self):
+        """{хост: медиана скорости приёма, бит/с}"""
+        return {host: statistics.median(result['download_bps'] for result in history)
+                for host, history in self.results.items() if history}
+
+
 class SimpleVPN:
-    def __init__(self):
+    def __init__(self, openvpn=OPENVPN_BINARY):
         self.vpn_process = None
+        self.vpn = None
+        self.openvpn = openvpn
+        self.original_ip = None
         
     def get_free_vpn_configs(self):
         """Получаем список бесплатных VPN серверов"""
@@ -25,6 +819,12 @@ class SimpleVPN:
         ]
         return vpn_servers
     
+    def fetch_vpngate_servers(self, url=VPNGATE_URL):
+        """Список серверов VPN Gate, разобранный на лету из потока ответа"""
+        with requests.get(url, timeout=10, stream=True) as response:
+            response.raise_for_status()
+            return list(iter_servers(response.iter_content(CHUNK_SIZE)))
+
     def download_openvpn_config(self, url):
         """Скачиваем OpenVPN конфигурацию"""
         try:
@@ -42,7 +842,7 @@ class SimpleVPN:
             print(f"Ошибка скачивания: {e}")
             return False
     
-    def connect_openvpn(self, config_file='vpn_config.ovpn'):
+    def connect_openvpn(self, config_file='vpn_config.ovpn', deadline=OPENVPN_DEADLINE):
         """Подключаемся через OpenVPN"""
         try:
             print("Подключаемся к VPN...")
@@ -53,15 +853,24 @@ class SimpleVPN:
                 print("Запустите: sudo python3 script.py")
                 return False
             
-            # Запускаем OpenVPN
-            self.vpn_process = subprocess.Popen(
-                ['openvpn', '--config', config_file],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
+            # IP без VPN запоминаем до подключения, потом его уже не узнать
+            try:
+                self.original_ip = requests.get('https://api.ipify.org', timeout=5).text
+            except requests.RequestException:
+                self.original_ip = None
+            
+            # Запускаем OpenVPN, его вывод читает OpenVpnProcess
+            self.vpn = OpenVpnProcess([self.openvpn, '--config', config_file])
+            self.vpn_process = self.vpn.process
             
             print("Ждем подключения...")
-            time.sleep(10)
+            ready = self.vpn.wait(deadline)
+            self.vpn.report()
+            if not ready:
+                self.report_failure(deadline)
+                self.disconnect()
+                return False
+            print(f"✓ Туннель поднят за {self.vpn.phases[-1][1]:.1f} с")
             
             # Проверяем IP
             self.check_connection()
@@ -71,17 +880,26 @@ class SimpleVPN:
             print(f"Ошибка подключения: {e}")
             return False
     
+    def report_failure(self, deadline):
+        if self.vpn.result == 'fatal':
+            print(f"✗ OpenVPN: {self.vpn.error}")
+        elif self.vpn.result == 'exited':
+            print(f"✗ OpenVPN завершился с кодом {self.vpn.process.wait()}, последние строки лога:")
+            for line in list(self.vpn.tail)[-10:]:
+                print("  " + line)
+        else:
+            print(f"✗ OpenVPN не подключился за {deadline:g} с")
+    
     def check_connection(self):
         """Проверяем подключение"""
         try:
             print("\nПроверяем соединение...")
             
             # Без VPN
-            original_ip = requests.get('https://api.ipify.org', timeout=5).text
+            original_ip = self.original_ip or requests.get('https://api.ipify.org', timeout=5).text
             print(f"Оригинальный IP: {original_ip}")
             
-            # Через VPN (ждем немного)
-            time.sleep(3)
+            # Через VPN: туннель уже готов, ждать не нужно
             vpn_ip = requests.get('https://api.ipify.org', timeout=10).text
             print(f"IP через VPN: {vpn_ip}")
             
@@ -97,12 +915,214 @@ class SimpleVPN:
         """Отключаем VPN"""
         if self.vpn_process:
             print("Отключаем VPN...")
-            self.vpn_process.terminate()
+            self.vpn.stop()
             self.vpn_process = None
+            self.vpn = None
             print("VPN отключен")
 
+    def benchmark(self, target, seconds=BENCH_SECONDS, samples=BENCH_SAMPLES, device=None):
+        """Замер через поднятый туннель; None - замер не удался"""
+        if device is None and self.vpn:
+            device = self.vpn.device
+        print("\nЗамеряем туннель...")
+        try:
+            result = bench_tunnel(target, device, seconds, samples)
+        except OSError as e:
+            print(f"✗ Замер не удался: {e}")
+            return None
+        print_bench(result)
+        return result
+
+def synthetic_config(host, port, size=2400):
+    """base64 конфига OpenVPN; сертификат - случайные байты нужного размера"""
+    cert = base64.encodebytes(os.urandom(size * 3 // 4)).decode()
+    text = (f"client\ndev tun\nproto tcp\nremote {host} {port}\n"
+            f"<ca>\n-----BEGIN CERTIFICATE-----\n{cert}-----END CERTIFICATE-----\n</ca>\n")
+    return base64.b64encode(text.encode()).decode()
+
+def synthetic_vpngate_csv(path, rows=200, config_size=2400):
+    """CSV в формате VPN Gate для офлайн-замеров"""
+    config = synthetic_config('10.0.0.1', 443, config_size)
+    with open(path, 'w') as f:
+        f.write('*vpn_servers\n')
+        f.write('#HostName,IP,Score,Ping,Speed,CountryLong,CountryShort,NumVpnSessions,Uptime,'
+                'TotalUsers,TotalTraffic,LogType,Operator,Message,OpenVPN_ConfigData_Base64\n')
+        for i in range(rows):
+            f.write(f'public-vpn-{i},10.{i // 256}.{i % 256}.1,{random.randint(1, 3000000)},'
+                    f'{random.randint(1, 300)},{random.randint(1, 10 ** 9)},Japan,JP,{i},1000,'
+                    f'100,100000,2weeks,Academic Use Only,,{config}\n')
+        f.write('*\n')
+
+def measure(label, parse):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = parse()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{label:<12} {count:>7} {elapsed * 1000:>10.1f} {peak / 2 ** 20:>10.2f}")
+
+def bench_parse(path=None, rows=200):
+    """Старый разбор (весь ответ строкой, split) против потокового; без
+    файла - синтетический список во временном каталоге"""
+    if path is not None:
+        compare_parsers(path)
+        return
+    with tempfile.TemporaryDirectory(prefix='vpngate-bench-') as tmp:
+        path = os.path.join(tmp, 'vpngate_bench.csv')
+        synthetic_vpngate_csv(path, rows)
+        compare_parsers(path)
+
+def compare_parsers(path):
+    print(f"Файл {path}: {os.path.getsize(path) / 2 ** 20:.2f} МБ")
+
+    def whole():
+        with open(path, 'rb') as f:
+            text = f.read().decode('utf-8')
+        lines = text.split('\n')[1:]
+        return len([line.split(',') for line in lines if line and line[0] not in '*#'])
+
+    def streaming():
+        with open(path, 'rb') as f:
+            servers = list(iter_servers(iter(lambda: f.read(CHUNK_SIZE), b'')))
+        return len(servers)
+
+    print(f"{'разбор':<12} {'строк':>7} {'время, мс':>10} {'пик, МБ':>10}")
+    measure('весь ответ', whole)
+    measure('потоковый', streaming)
+
+def bench_rank(count, timeout=PROBE_TIMEOUT, concurrency=PROBE_CONCURRENCY):
+    """count локальных заглушек: треть отвечает, треть отказывает, треть молчит
+    (очередь accept забита, SYN теряются). Проверка должна занять около
+    одного таймаута, а не count таймаутов"""
+    listener = socket.create_server(('127.0.0.1', 0), backlog=count)
+    silent = socket.create_server(('127.0.0.1', 0), backlog=0)
+    with socket.socket() as closed:
+        closed.bind(('127.0.0.1', 0))
+        ports = [listener.getsockname()[1], closed.getsockname()[1], silent.getsockname()[1]]
+    servers = []
+    for i in range(count):
+        servers.append(VpnServer(f'local-{i}', '127.0.0.1', random.randint(1, 3000000),
+                                 random.randint(1, 300), random.randint(1, 10 ** 9),
+                                 'Local', 'LO', synthetic_config('127.0.0.1', ports[i % 3], 256)))
+    start = time.perf_counter()
+    ranked = rank_servers(servers, top_k=count, timeout=timeout, concurrency=concurrency)
+    elapsed = time.perf_counter() - start
+    listener.close()
+    silent.close()
+    alive = sum(server.rtt is not None for server in ranked)
+    print(f"Проверено {count} серверов за {elapsed:.2f} с (таймаут {timeout:g} с, "
+          f"параллельно {concurrency}), ответили {alive}")
+    for server in ranked[:3]:
+        print(f"  {server}")
+
+def parse_address(value):
+    host, _, port = value.rpartition(':')
+    return host, int(port)
+
+def run_bench(args, vpn, host=None, device=None):
+    """Замер через туннель с сохранением по серверу; без цели - офлайн против
+    локального сервера, ничего не сохраняем"""
+    sink = None
+    target = args.bench_tunnel
+    if target is True:
+        sink = BenchSink()
+        target = sink.start()
+    try:
+        result = vpn.benchmark(target, args.bench_seconds, args.bench_samples, device)
+    finally:
+        if sink:
+            sink.stop()
+    if result and host and sink is None:
+        BenchStore(args.bench_store).load().add(host, result)
+        print(f"Замер сохранён для {host}")
+    return result
+
+def run_happy(servers, args):
+    if os.geteuid() != 0:
+        print("Для OpenVPN нужны права root!")
+        return
+    manager = TunnelManager(servers, args.openvpn, args.happy, args.stagger, args.spares,
+                            args.connect_deadline, args.health_target)
+    try:
+        if not manager.connect():
+            print("Не удалось подключиться ни к одному серверу")
+            return
+        if args.bench_tunnel:
+            run_bench(args, SimpleVPN(args.openvpn), manager.active.server.host,
+                      manager.active.vpn.device)
+        print("VPN работает, Ctrl+C - отключить")
+        manager.monitor()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.stop()
+        print(f"VPN отключен (переключений: {manager.switches})")
+
 def main():
-    vpn = SimpleVPN()
+    parser = argparse.ArgumentParser(description="VPN через OpenVPN и VPN Gate")
+    parser.add_argument('--bench-parse', nargs='?', const='', metavar='CSV',
+                        help="сравнить разбор списка VPN Gate (без файла - синтетический)")
+    parser.add_argument('--rows', type=int, default=200,
+                        help="строк в синтетическом списке для --bench-parse")
+    parser.add_argument('--country', help="только серверы страны (код, например JP)")
+    parser.add_argument('--cache', default=CACHE_PATH, help="файл кэша списка серверов")
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL,
+                        help="через сколько секунд кэш считается устаревшим")
+    parser.add_argument('--refresh', action='store_true',
+                        help="обновить список, даже если кэш свежий")
+    parser.add_argument('--offline', action='store_true',
+                        help="не ходить в сеть за списком, только кэш")
+    parser.add_argument('--openvpn', default=OPENVPN_BINARY, help="путь к openvpn")
+    parser.add_argument('--connect-deadline', type=float, default=OPENVPN_DEADLINE,
+                        help="сколько секунд ждать Initialization Sequence Completed")
+    parser.add_argument('--happy', type=int, nargs='?', const=HAPPY_ATTEMPTS, default=0,
+                        metavar='N', help="пробовать N лучших серверов параллельно, "
+                                          "держать запасной туннель и переключаться на него")
+    parser.add_argument('--stagger', type=float, default=HAPPY_STAGGER,
+                        help="пауза между запусками попыток, секунды")
+    parser.add_argument('--spares', type=int, default=HAPPY_SPARES,
+                        help="сколько поднятых туннелей держать в запасе")
+    parser.add_argument('--health-target', type=parse_address,
+                        default=HEALTH_TARGET, help="куда проверять TCP connect через туннель")
+    parser.add_argument('--top', type=int, default=RANK_TOP_K,
+                        help="сколько лучших по score серверов проверять перед выбором")
+    parser.add_argument('--probe-timeout', type=float, default=PROBE_TIMEOUT,
+                        help="таймаут TCP connect к серверу, секунды")
+    parser.add_argument('--probe-concurrency', type=int, default=PROBE_CONCURRENCY)
+    parser.add_argument('--bench-rank', type=int, metavar='N',
+                        help="проверить N локальных заглушек и показать время")
+    parser.add_argument('--bench-tunnel', type=parse_address, nargs='?', const=True,
+                        metavar='HOST:PORT', help="после подключения замерить туннель до своего "
+                                                  "--bench-sink; без адреса - офлайн локально")
+    parser.add_argument('--bench-sink', type=int, metavar='PORT',
+                        help="запустить сервер для --bench-tunnel на этой машине")
+    parser.add_argument('--bench-seconds', type=float, default=BENCH_SECONDS,
+                        help="длительность замера скорости в каждую сторону")
+    parser.add_argument('--bench-samples', type=int, default=BENCH_SAMPLES,
+                        help="замеров RTT и установки соединения")
+    parser.add_argument('--bench-store', default=BENCH_STORE, help="файл с замерами серверов")
+    args = parser.parse_args()
+
+    if args.bench_sink:
+        sink = BenchSink(('0.0.0.0', args.bench_sink))
+        print(f"Сервер замеров слушает порт {args.bench_sink}, Ctrl+C - остановить")
+        try:
+            sink.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+    if args.bench_tunnel is True:
+        run_bench(args, SimpleVPN(args.openvpn))
+        return
+    if args.bench_parse is not None:
+        bench_parse(args.bench_parse or None, args.rows)
+        return
+    if args.bench_rank:
+        bench_rank(args.bench_rank, args.probe_timeout, args.probe_concurrency)
+        return
+
+    vpn = SimpleVPN(args.openvpn)
     
     print("=== VPN Security by Юфус ===\n")
     
@@ -117,23 +1137,32 @@ def main():
         
         if choice == 1:
             print("\nИспользуем VPN Gate (Япония)")
-            # Скачиваем конфигурацию
-            config_data = requests.get('https://www.vpngate.net/api/iphone/').text
-            servers = config_data.split('\n')[1:]  # Пропускаем заголовок
+            # Список серверов: из кэша на диске, с сервера - только если устарел
+            cache = ServerCache(args.cache, args.cache_ttl)
+            servers = cache.update(args.refresh, args.offline)
+            if args.country:
+                servers = cache.by_country(args.country)
             
             if servers:
-                # Берем первый рабочий сервер
-                server_config = servers[0].split(',')[-1]
-                import base64
-                config = base64.b64decode(server_config).decode('utf-8')
-                
-                with open('vpn_config.ovpn', 'w') as f:
-                    f.write(config)
+                print(f"Проверяем {min(args.top, len(servers))} лучших серверов...")
+                ranked = rank_servers(servers, args.top, args.probe_timeout,
+                                      args.probe_concurrency,
+                                      BenchStore(args.bench_store).load().measured())
+                for server in ranked[:5]:
+                    print(f"  {server}")
+                if args.happy:
+                    run_happy(ranked or servers, args)
+                    return
+                # Лучший по оценке, если никто не ответил - первый из списка
+                server = ranked[0] if ranked else servers[0]
+                print(f"Сервер: {server}")
+                server.save_config('vpn_config.ovpn')
                 
                 print("Конфигурация загружена")
                 
                 # Запускаем VPN
-                vpn.connect_openvpn()
+                if vpn.connect_openvpn(deadline=args.connect_deadline) and args.bench_tunnel:
+                    run_bench(args, vpn, server.host)
             else:
                 print("Не удалось получить серверы")
                 